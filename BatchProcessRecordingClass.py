@@ -36,7 +36,7 @@ def ReadOneDaySession (parent_folder,TargetfolderName='SyncRecording', IsTrackin
         for i in range (1):
             LFP_channel='LFP_'+str(i+2)
             #LFP_channel='LFP_4'
-            theta_part,non_theta_part=Recording1.pynacollada_label_theta (LFP_channel,Low_thres=0.5,High_thres=10)
+            theta_ranges,non_theta_ranges=Recording1.pynacollada_label_theta (LFP_channel,Low_thres=0.5,High_thres=10)
     
             '''THETA PEAK DETECTION
             For a rigid threshold to get larger amplitude theta events: Low_thres=1, for more ripple events, Low_thres=0.5'''
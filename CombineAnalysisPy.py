@@ -113,17 +113,17 @@ lags,Corr_mean,Corr_std=Recording1.get_mean_corr_two_traces (spad_low,lfp_low,co
 #%%
 Fs=10000
 
-#theta_part,non_theta_part=Recording1.pynacollada_label_theta (LFP_channel,Low_thres=-0.5,High_thres=8,save=False,plot_theta=True)
-LFP_theta=Recording1.theta_part[LFP_channel]
-LFP_nontheta=Recording1.non_theta_part[LFP_channel]
+#theta_ranges,non_theta_ranges=Recording1.pynacollada_label_theta (LFP_channel,Low_thres=-0.5,High_thres=8,save=False,plot_theta=True)
+LFP_theta=Recording1.get_theta_part()[LFP_channel]
+LFP_nontheta=Recording1.get_non_theta_part()[LFP_channel]
 
 fig, ax = plt.subplots(1, 1, figsize=(3, 6))
 
 OpticalAnlaysis.PSD_plot (LFP_nontheta/1000,fs=Fs,method="welch",color='black', xlim=[0,100],linewidth=2,linestyle='--',label='LFP-rest',ax=ax)
 OpticalAnlaysis.PSD_plot (LFP_theta/1000,fs=Fs,method="welch",color='black', xlim=[0,100],linewidth=2,linestyle='-',label='LFP-move',ax=ax)
 
-optical_theta=Recording1.theta_part['zscore_raw']
-optical_nontheta=Recording1.non_theta_part['zscore_raw']
+optical_theta=Recording1.get_theta_part()['zscore_raw']
+optical_nontheta=Recording1.get_non_theta_part()['zscore_raw']
 
 fig, ax = plt.subplots(1, 1, figsize=(3, 6))
 OpticalAnlaysis.PSD_plot (optical_nontheta,fs=Fs,method="welch",color='tab:green', xlim=[0,100],linewidth=2,linestyle='--',label='rest',ax=ax)
@@ -147,8 +147,8 @@ from tensorpac import Pac
 # Example data (replace these with your actual data)
 fs = 10000  # Sampling frequency in Hz
 
-LFP = Recording1.theta_part[LFP_channel] # Example LFP signal
-SPAD=Recording1.theta_part['zscore_raw'] 
+LFP = Recording1.get_theta_part()[LFP_channel] # Example LFP signal
+SPAD=Recording1.get_theta_part()['zscore_raw'] 
 LFP=LFP.to_numpy()
 SPAD=SPAD.to_numpy()
 # Define a Pac object
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Batched cross-correlation between the optical signal and the LFP.
+
+Many equal-length windows (sliding windows of a session, or event epochs) are correlated
+together with one real FFT along the last axis, instead of one signal.correlate per window.
+Output can be restricted to |lag| <= max_lag. Each window is z-scored and the correlation
+is divided by the window length, same as OE.calculate_correlation.
+
+Whole-session envelope correlations (e.g. LFP vs optical gamma power) are computed on envelopes
+decimated to a few hundred Hz, with streaming Pearson sums, binned-rank Spearman and a 2-D histogram.
+"""
+import numpy as np
+from scipy import fft as sp_fft
+from numpy.lib.stride_tricks import sliding_window_view
+import EpochTools as Epoch
+
+def get_lags(n, max_lag=None):
+    '''Lags in samples, same order as signal.correlation_lags(n,n,mode='full') when max_lag is None.'''
+    if max_lag is None:
+        max_lag = n - 1
+    max_lag = int(min(max_lag, n - 1))
+    return np.arange(-max_lag, max_lag + 1)
+
+def crop_lags(corr, n_lags):
+    '''Keep the central n_lags columns of a (events x lags) array, e.g. to pool arrays computed with different max_lag.'''
+    corr = np.atleast_2d(corr)
+    start = (corr.shape[-1] - n_lags) // 2
+    return corr[:, start:start + n_lags]
+
+def batched_cross_correlation(x, y, max_lag=None, dtype=float):
+    '''Normalised cross-correlation of every row of x with the same row of y.
+    x,y: (windows x samples) arrays (1-D is treated as one window).
+    Returns lags (samples) and (windows x lags), row i equals OE.calculate_correlation(x[i],y[i]) at those lags.'''
+    x = np.atleast_2d(np.asarray(x, dtype=float))
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    n = x.shape[-1]
+    lags = get_lags(n, max_lag)
+    max_lag = lags[-1]
+    x = Epoch.normalise_epochs(x, axis=-1)
+    y = Epoch.normalise_epochs(y, axis=-1)
+    'Zero padding to n+max_lag avoids circular wrap-around for the lags we keep'
+    n_fft = sp_fft.next_fast_len(n + max_lag)
+    spectrum = sp_fft.rfft(x, n=n_fft, axis=-1) * np.conj(sp_fft.rfft(y, n=n_fft, axis=-1))
+    circular = sp_fft.irfft(spectrum, n=n_fft, axis=-1, workers=-1)
+    'Positive lags are at the start of the circular result, negative lags at the end'
+    corr = np.concatenate((circular[:, n_fft - max_lag:], circular[:, :max_lag + 1]), axis=-1) / n
+    return lags, corr.astype(dtype, copy=False)
+
+def sliding_window_correlation(x, y, window_len, step, max_lag=None, chunk_size=256, dtype=float):
+    '''Cross-correlation in windows of window_len samples every step samples over two whole traces.
+    The windows are strided views of the traces, correlated chunk_size windows at a time.
+    Returns lags (samples) and (windows x lags).'''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x_windows = sliding_window_view(x, window_len)[::step]
+    y_windows = sliding_window_view(y, window_len)[::step]
+    lags = get_lags(window_len, max_lag)
+    corr = np.empty((len(x_windows), len(lags)), dtype=dtype)
+    for start in range(0, len(x_windows), chunk_size):
+        stop = start + chunk_size
+        _, corr[start:stop] = batched_cross_correlation(x_windows[start:stop], y_windows[start:stop], max_lag, dtype)
+    return lags, corr
+
+def sliding_window_correlation_stats(x, y, window_len, step, max_lag=None, CI_method='t'):
+    '''Mean, std and 95% CI across windows of the sliding-window cross-correlation.
+    Returns lags (samples), mean, std, CI and the (windows x lags) correlation matrix.'''
+    lags, corr = sliding_window_correlation(x, y, window_len, step, max_lag)
+    mean_corr, std_corr, CI_corr = Epoch.calculate_epoch_statistics(corr, CI_method=CI_method)
+    return lags, mean_corr, std_corr, CI_corr, corr
+
+def decimate_by_mean(x, fs, target_fs=200):
+    '''Average x in blocks of fs//target_fs samples (drops the incomplete last block), e.g. gamma envelopes at 10 kHz to 200 Hz.
+    Returns the decimated signal and its sampling rate.'''
+    x = np.asarray(x, dtype=float)
+    q = max(1, int(fs // target_fs))
+    n_blocks = len(x) // q
+    return x[:n_blocks * q].reshape(n_blocks, q).mean(axis=1), fs / q
+
+def pearson_sums(x, y, shift=(0, 0), chunk_size=2**20):
+    '''Sums needed for the Pearson correlation and the regression line, accumulated chunk_size samples at a time.
+    Values are shifted (e.g. by the first samples) before summing to avoid cancellation. Sums can be added across recordings.'''
+    sums = {'n': 0, 'x': 0., 'y': 0., 'xx': 0., 'yy': 0., 'xy': 0.}
+    for start in range(0, len(x), chunk_size):
+        dx = np.asarray(x[start:start + chunk_size], dtype=float) - shift[0]
+        dy = np.asarray(y[start:start + chunk_size], dtype=float) - shift[1]
+        sums['n'] += len(dx)
+        sums['x'] += dx.sum()
+        sums['y'] += dy.sum()
+        sums['xx'] += dx @ dx
+        sums['yy'] += dy @ dy
+        sums['xy'] += dx @ dy
+    return sums
+
+def pearson_from_sums(sums, shift=(0, 0)):
+    '''Pearson r, slope and intercept of the least squares line y=slope*x+intercept from pearson_sums.'''
+    n = sums['n']
+    cov = sums['xy'] - sums['x'] * sums['y'] / n
+    var_x = sums['xx'] - sums['x'] ** 2 / n
+    var_y = sums['yy'] - sums['y'] ** 2 / n
+    r = cov / np.sqrt(var_x * var_y)
+    slope = cov / var_x
+    intercept = shift[1] + sums['y'] / n - slope * (shift[0] + sums['x'] / n)
+    return r, slope, intercept
+
+def streaming_pearson(x, y, chunk_size=2**20):
+    shift = (float(x[0]), float(y[0]))
+    return pearson_from_sums(pearson_sums(x, y, shift, chunk_size), shift)
+
+def binned_rank(x, n_bins=1000, n_sample=100000, seed=0):
+    '''Approximate rank of every sample: samples are put in n_bins bins with (about) equal counts,
+    edges taken from a random subsample, and get the mid-rank of their bin. No full argsort is needed,
+    and the rank error is about len(x)/n_bins.'''
+    x = np.asarray(x, dtype=float)
+    rng = np.random.default_rng(seed)
+    sample = x if len(x) <= n_sample else rng.choice(x, n_sample, replace=False)
+    edges = np.unique(np.quantile(sample, np.linspace(0, 1, n_bins + 1)[1:-1]))
+    bin_index = np.searchsorted(edges, x, side='right')
+    count = np.bincount(bin_index, minlength=len(edges) + 1)
+    mid_rank = np.cumsum(count) - (count - 1) / 2
+    return mid_rank[bin_index]
+
+def approximate_spearman(x, y, n_bins=1000):
+    '''Spearman correlation as the Pearson correlation of the binned ranks, see binned_rank.'''
+    r, _, _ = streaming_pearson(binned_rank(x, n_bins), binned_rank(y, n_bins))
+    return r
+
+def envelope_correlation(x, y, fs, target_fs=200, n_bins=1000, hist_bins=50):
+    '''Pearson and (binned-rank) Spearman correlation of two envelopes after decimating to target_fs,
+    and the 2-D histogram of (x, y) so a density plot costs the same for any recording length.
+    Returns a dict with pearson, spearman, slope, intercept, histogram (x bins x y bins), x_edges, y_edges.'''
+    n = min(len(x), len(y))
+    x, fs_decimated = decimate_by_mean(np.asarray(x)[:n], fs, target_fs)
+    y, _ = decimate_by_mean(np.asarray(y)[:n], fs, target_fs)
+    pearson, slope, intercept = streaming_pearson(x, y)
+    histogram, x_edges, y_edges = np.histogram2d(x, y, bins=hist_bins)
+    return {'pearson': pearson, 'spearman': approximate_spearman(x, y, n_bins), 'slope': slope, 'intercept': intercept,
+            'histogram': histogram, 'x_edges': x_edges, 'y_edges': y_edges, 'fs': fs_decimated}
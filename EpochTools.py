@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Functions to extract event-locked epochs (ripple/theta/gamma peaks) from the aligned recording
+and process them as a batch.
+
+Events are mapped to sample indices with one searchsorted on the uniform timebase,
+then the epochs are gathered as an (events x window x channels) array from a strided view,
+so the session DataFrame is never modified and no per-event slicing is needed.
+Statistics (mean/std/CI, peaks) are computed across the event axis of the same arrays.
+"""
+import numpy as np
+from scipy import stats
+from scipy import ndimage
+from numpy.lib.stride_tricks import sliding_window_view
+
+def event_times_to_index(timestamps, event_times):
+    '''Index of the closest sample for each event time, same result as abs(timestamps-t).idxmin().
+    timestamps must be sorted.'''
+    timestamps = np.asarray(timestamps)
+    event_times = np.atleast_1d(np.asarray(event_times, dtype=float))
+    right = np.clip(np.searchsorted(timestamps, event_times, side='left'), 1, len(timestamps) - 1)
+    left = right - 1
+    use_left = np.abs(event_times - timestamps[left]) <= np.abs(timestamps[right] - event_times)
+    return np.where(use_left, left, right).astype(np.int64)
+
+def get_event_index(timestamps, event_times, half_window, fs=10000):
+    '''Closest sample index for events that have a full half_window (seconds) on both sides.'''
+    timestamps = np.asarray(timestamps)
+    event_times = np.atleast_1d(np.asarray(event_times, dtype=float))
+    half_window_len = int(half_window * fs)
+    inside = (event_times - timestamps[0] >= half_window) & (event_times <= timestamps[-1] - half_window)
+    centre_index = event_times_to_index(timestamps, event_times[inside])
+    in_bound = (centre_index - half_window_len >= 0) & (centre_index + half_window_len <= len(timestamps))
+    return centre_index[in_bound]
+
+def extract_event_epochs(data, centre_index, half_window_len, window_len=None):
+    '''Gather epochs [centre-half_window_len, centre-half_window_len+window_len) around each centre index,
+    window_len defaults to 2*half_window_len.
+    data: 1-D array (samples) or 2-D array (samples x channels), or a list of 1-D arrays (one per channel).
+    Returns (events x window) for 1-D data, otherwise (events x window x channels).'''
+    if isinstance(data, (list, tuple)):
+        return np.stack([extract_event_epochs(channel, centre_index, half_window_len, window_len) for channel in data], axis=-1)
+    data = np.asarray(data)
+    if window_len is None:
+        window_len = 2 * half_window_len
+    windows = sliding_window_view(data, window_len, axis=0)  # (starts, [channels,] window) view, no copy
+    epochs = windows[np.asarray(centre_index, dtype=np.int64) - half_window_len]
+    if data.ndim == 2:
+        epochs = np.swapaxes(epochs, 1, 2)
+    return np.array(epochs, dtype=float)
+
+def find_phase_troughs(phase, threshold=-3.13):
+    '''Trough index of the band-passed signal from its Hilbert phase: local minima of the phase below threshold,
+    i.e. the sample just after the phase wraps from pi to -pi. Same as the pandas shift comparison in OE.calculate_theta_trough_index.'''
+    phase = np.asarray(phase, dtype=float)
+    centre = phase[1:-1]
+    is_trough = (centre < phase[:-2]) & (centre < phase[2:]) & (centre < threshold)
+    return np.flatnonzero(is_trough) + 1
+
+def find_phase_peaks(phase):
+    '''Peak index of the band-passed signal from its Hilbert phase, where the phase crosses zero upwards.'''
+    phase = np.asarray(phase, dtype=float)
+    return np.flatnonzero((phase[:-1] < 0) & (phase[1:] >= 0)) + 1
+
+def get_cycle_index(trough_index, n_samples, half_window_len):
+    '''Troughs with the whole window [trough-half_window_len, trough+half_window_len] inside the recording,
+    edge cycles are dropped by index arithmetic instead of checking the length of every slice.'''
+    trough_index = np.asarray(trough_index, dtype=np.int64)
+    inside = (trough_index - half_window_len >= 0) & (trough_index + half_window_len < n_samples)
+    return trough_index[inside]
+
+def extract_cycle_epochs(data, trough_index, half_window_len):
+    '''(cycles x samples [x channels]) array of the windows [trough-half_window_len, trough+half_window_len],
+    end inclusive like the .loc slices it replaces (2*half_window_len+1 samples).
+    data as in extract_event_epochs. Returns the array and the trough index of the cycles that were kept.'''
+    n_samples = len(data[0]) if isinstance(data, (list, tuple)) else len(data)
+    trough_index = get_cycle_index(trough_index, n_samples, half_window_len)
+    cycles = extract_event_epochs(data, trough_index, half_window_len, window_len=2 * half_window_len + 1)
+    return cycles, trough_index
+
+SMOOTH_WINDOWS = {'hanning': np.hanning, 'hamming': np.hamming, 'bartlett': np.bartlett, 'blackman': np.blackman}
+
+def smooth_epochs(epochs, window_len, axis=1, window='flat'):
+    '''Moving-window smoothing of every epoch (or channel) along axis, with reflected edges.
+    flat is a running-sum moving average, so the cost does not depend on window_len; hanning, hamming, bartlett
+    and blackman use the normalised window as weights. Edges are reflected by the filter itself, no padded copy is made.
+    Same alignment as OE.smooth_signal(...,window='flat') for even window_len, the output has the input shape.'''
+    epochs = np.asarray(epochs, dtype=float)
+    if window_len < 3:
+        return epochs
+    if window == 'flat':
+        return ndimage.uniform_filter1d(epochs, window_len, axis=axis, mode='mirror')
+    if window not in SMOOTH_WINDOWS:
+        raise ValueError("Window is one of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'")
+    weights = SMOOTH_WINDOWS[window](window_len)
+    return ndimage.correlate1d(epochs, weights / weights.sum(), axis=axis, mode='mirror')
+
+def normalise_epochs(epochs, axis=1):
+    '''z-score every epoch along axis, batched version of OE.getNormalised.'''
+    epochs = np.asarray(epochs, dtype=float)
+    mean = np.mean(epochs, axis=axis, keepdims=True)
+    std = np.std(epochs, axis=axis, keepdims=True)
+    return (epochs - mean) / std
+
+def find_epoch_peaks(epochs, half_win_len, mode='max'):
+    '''Peak value, peak index and peak/std for every row of a 2-D (events x samples) array.
+    Batched version of OE.find_peak_and_std, the std is taken in peak_index +/- half_win_len.'''
+    epochs = np.asarray(epochs, dtype=float)
+    n_events, n_samples = epochs.shape
+    if mode == 'max':
+        peak_index = np.argmax(epochs, axis=1)
+    else:
+        peak_index = np.argmin(epochs, axis=1)
+    rows = np.arange(n_events)
+    peak_value = epochs[rows, peak_index]
+    window_start = np.maximum(0, peak_index - half_win_len)
+    window_end = np.minimum(n_samples - 1, peak_index + half_win_len) + 1
+    csum = np.concatenate((np.zeros((n_events, 1)), np.cumsum(epochs, axis=1)), axis=1)
+    csum2 = np.concatenate((np.zeros((n_events, 1)), np.cumsum(epochs ** 2, axis=1)), axis=1)
+    count = window_end - window_start
+    window_mean = (csum[rows, window_end] - csum[rows, window_start]) / count
+    window_var = (csum2[rows, window_end] - csum2[rows, window_start]) / count - window_mean ** 2
+    peak_std = peak_value / np.sqrt(np.maximum(window_var, 0))
+    return peak_value, peak_index, peak_std
+
+def get_peak_latency(peak_index, fs=10000, half_window=0):
+    '''Peak index within the epoch to latency (seconds) relative to the event, i.e. peak_index/fs-half_window.'''
+    return np.asarray(peak_index) / fs - half_window
+
+def align_epochs_to_index(epochs, align_index, midpoint):
+    '''Circularly shift every row so that align_index moves to midpoint, same as np.roll per row.'''
+    epochs = np.asarray(epochs)
+    n_samples = epochs.shape[1]
+    shift = midpoint - np.asarray(align_index, dtype=np.int64)
+    gather_index = (np.arange(n_samples)[None, :] - shift[:, None]) % n_samples
+    return np.take_along_axis(epochs, gather_index, axis=1)
+
+def bootstrap_epoch_ci(epochs, confidence=0.95, n_boot=1000, seed=None, chunk_size=250):
+    '''Percentile bootstrap CI of the mean trace of a 2-D (events x samples) array.
+    Each resample is drawn as a row of multinomial event counts, so the resampled means are
+    one matrix product (counts @ epochs) per chunk instead of a Python loop over resamples.'''
+    epochs = np.asarray(epochs, dtype=float)
+    n_events = epochs.shape[0]
+    rng = np.random.default_rng(seed)
+    boot_means = np.empty((n_boot, epochs.shape[1]))
+    for start in range(0, n_boot, chunk_size):
+        stop = min(start + chunk_size, n_boot)
+        counts = rng.multinomial(n_events, np.full(n_events, 1 / n_events), size=stop - start)
+        boot_means[start:stop] = counts @ epochs / n_events
+    alpha = (1 - confidence) / 2
+    lower, upper = np.percentile(boot_means, [100 * alpha, 100 * (1 - alpha)], axis=0)
+    return lower, upper
+
+def calculate_epoch_statistics(epochs, confidence=0.95, CI_method='t', n_boot=1000, seed=None):
+    '''Mean, std and confidence interval across events (axis 0) of an (events x samples) array.
+    CI_method='t' gives the t-distribution CI (same as OE.calculateStatisticNumpy),
+    CI_method='bootstrap' gives the percentile bootstrap CI.'''
+    epochs = np.asarray(epochs, dtype=float)
+    mean = np.mean(epochs, axis=0)
+    std = np.std(epochs, axis=0)
+    if CI_method == 'bootstrap':
+        confidence_interval = bootstrap_epoch_ci(epochs, confidence, n_boot, seed)
+    else:
+        n_events = len(epochs)
+        sem = np.std(epochs, axis=0, ddof=1) / np.sqrt(n_events)
+        moe = stats.t.ppf(0.5 + confidence / 2, n_events - 1) * sem
+        confidence_interval = mean - moe, mean + moe
+    return mean, std, confidence_interval
@@ -66,4 +66,16 @@ def plot_bar_from_dict(ax,data_dict,plotScatter=True):
         for i, label in enumerate(labels):
             x = [i] * len(data_dict[label])  # x-coordinate for scatter points
             ax.scatter(x, data_dict[label], color='tomato', zorder=5)  # zorder to ensure scatter dots are on top of bars
-    return ax
\ No newline at end of file
+    return ax
+
+def plot_comodulogram(ax,phase_freqs,amp_freqs,pac,pac_pvalue=None,title='PAC comodulogram',p_thres=0.05,label='Modulation index'):
+    '''pac: (phase frequencies x amplitude frequencies), the p<p_thres region is outlined if pac_pvalue is given.
+    label: colorbar label, e.g. 'Mean vector length' for method='mvl'.'''
+    mesh=ax.pcolormesh(phase_freqs,amp_freqs,pac.T,shading='nearest',cmap='viridis')
+    if pac_pvalue is not None:
+        ax.contour(phase_freqs,amp_freqs,pac_pvalue.T,[p_thres],colors='w',linewidths=1)
+    plt.colorbar(mesh,ax=ax,label=label)
+    ax.set_xlabel('Phase frequency (Hz)')
+    ax.set_ylabel('Amplitude frequency (Hz)')
+    ax.set_title(title)
+    return ax
@@ -11,6 +11,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import seaborn as sns
 import OpenEphysTools as OE
+import CorrelationTools as Corr
+import StateLabelTools as StateLabel
 import pynapple as nap
 import pickle
 import MakePlots
@@ -42,6 +44,7 @@ def SeparateTrialsByStateAndSave (parent_folder,LFP_channel='LFP_1'):
     theta_triggered_zscore={'pre_sleep': [], 'pre_awake': [], 'post_sleep': [],'post_awake':[],'openfield_awake':[]}
     theta_triggered_LFP={'pre_sleep': [], 'pre_awake': [], 'post_sleep': [],'post_awake':[],'openfield_awake':[]}
     theta_event_corr={'pre_sleep': [], 'pre_awake': [], 'post_sleep': [],'post_awake':[],'openfield_awake':[]}
+    state_durations={'pre_sleep': [], 'pre_awake': [], 'post_sleep': [],'post_awake':[],'openfield_awake':[]}
     
     all_contents = os.listdir(parent_folder)
     # Filter out directories containing the target string
@@ -88,6 +91,9 @@ def SeparateTrialsByStateAndSave (parent_folder,LFP_channel='LFP_1'):
                 theta_triggered_zscore [column_name].append(Recording1.theta_triggered_zscore_values)
                 #theta_triggered_LFP[column_name].append(Recording1.theta_triggered_LFP_values)
                 theta_event_corr[column_name].append(Recording1.theta_event_corr_array)
+                'Seconds spent in every labelled state (theta, REM...), from the interval sets'
+                state_durations[column_name].append({state: StateLabel.index_ranges_length(index_ranges)/Recording1.fs
+                                                     for state, index_ranges in Recording1.state_index_ranges.items()})
                 
     save_path = os.path.join(parent_folder, 'ripple_triggered_optical_peak_value_'+LFP_channel+'.pkl')
     with open(save_path, 'wb') as file:
@@ -131,12 +137,16 @@ def SeparateTrialsByStateAndSave (parent_folder,LFP_channel='LFP_1'):
     save_path = os.path.join(parent_folder, 'theta_event_corr_'+LFP_channel+'.pkl')
     with open(save_path, 'wb') as file:
         pickle.dump(theta_event_corr, file) 
+    save_path = os.path.join(parent_folder, 'state_durations_'+LFP_channel+'.pkl')
+    with open(save_path, 'wb') as file:
+        pickle.dump(state_durations, file) 
     
     return -1
 
-def PoolDatabyStateAndPlot (parent_folder, LFP_channel, mode='ripple'):
+def PoolDatabyStateAndPlot (parent_folder, LFP_channel, mode='ripple',CI_method='t'):
     '''
     This function will read the saved dictionary files from the above funcion and plot optical transient features according to state.
+    CI_method: 't' or 'bootstrap', statistics are computed on the pooled (events x samples) arrays in one pass.
     '''
     if mode=='ripple':
         half_window=0.1 #seconds, for ripple
@@ -167,10 +177,12 @@ def PoolDatabyStateAndPlot (parent_folder, LFP_channel, mode='ripple'):
             peak_value_i = np.concatenate(peak_value[key])
             zscore_i = np.concatenate(zscore[key])
             LFP_i = np.concatenate(LFP[key])
-            event_corr_i=np.concatenate(event_corr[key])
-            mean_z_score,std_z_score, CI_z_score=OE.calculateStatisticNumpy (zscore_i)
-            mean_LFP,std_LFP, CI_LFP=OE.calculateStatisticNumpy (LFP_i)
-            mean_event_corr,std_event_corr,CI_event_corr=OE.calculateStatisticNumpy (event_corr_i)
+            'Sessions may store different lag ranges (bounded max_lag or full length), pool the common central lags'
+            n_lags=min(np.shape(corr)[-1] for corr in event_corr[key])
+            event_corr_i=np.concatenate([Corr.crop_lags(corr,n_lags) for corr in event_corr[key]])
+            mean_z_score,std_z_score, CI_z_score=OE.calculateStatisticNumpy (zscore_i,CI_method=CI_method)
+            mean_LFP,std_LFP, CI_LFP=OE.calculateStatisticNumpy (LFP_i,CI_method=CI_method)
+            mean_event_corr,std_event_corr,CI_event_corr=OE.calculateStatisticNumpy (event_corr_i,CI_method=CI_method)
             '--plot transient and LFP---'
             x = np.linspace(-half_window, half_window, len(mean_z_score))
             fig, ax = plt.subplots(figsize=(8, 4))
@@ -24,7 +24,9 @@ from mpl_toolkits.axes_grid1 import make_axes_locatable
 from scipy import stats
 from matplotlib.ticker import MaxNLocator
 from tensorpac import Pac
-from scipy.stats import pearsonr, spearmanr
+import EpochTools as Epoch
+import CorrelationTools as Corr
+import PhaseTools as Phase
 
 def butter_filter(data, btype='low', cutoff=10, fs=9938.4, order=5): 
     # cutoff and fs in Hz
@@ -47,38 +49,12 @@ def notchfilter (data,f0=50,bw=10,fs=30000):
     data=signal.filtfilt(b, a, data)
     return data
 
-def smooth_signal(data,Fs,cutoff,window='flat'):
-
-    """smooth the data using a window with requested size.
-    The code taken from: https://scipy-cookbook.readthedocs.io/items/SignalSmooth.html
-    
-    input:
-        x: the input signal 
-        window_len: the dimension of the smoothing window; should be an odd integer
-        window: the type of window from 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'
-                'flat' window will produce a moving average smoothing.
-    output:
-        the smoothed signal        
-    """
+def smooth_signal(data,Fs,cutoff,window='flat',axis=-1):
+    '''Smooth data (1-D, or channels x samples along axis) with a window of int(Fs/cutoff) samples.
+    window: 'flat' (moving average), 'hanning', 'hamming', 'bartlett' or 'blackman', see Epoch.smooth_epochs.
+    Edges are reflected as in https://scipy-cookbook.readthedocs.io/items/SignalSmooth.html, output has the input length.'''
     window_len=int(Fs/cutoff)
-
-    x=data.reset_index(drop=True)
-    if x.ndim != 1:
-        raise(ValueError, "smooth only accepts 1 dimension arrays.")
-    if x.size < window_len:
-        raise(ValueError, "Input vector needs to be bigger than window size.")
-    if window_len<3:
-        return x
-    if not window in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
-        raise(ValueError, "Window is one of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'")
-
-    s=np.r_[x[window_len-1:0:-1],x,x[-2:-window_len-1:-1]]
-    if window == 'flat': # Moving average
-        w=np.ones(window_len,'d')
-    else:
-        w=eval('np.'+window+'(window_len)')
-    y=np.convolve(w/w.sum(),s,mode='valid')
-    return y[(int(window_len/2)-1):-int(window_len/2)]
+    return Epoch.smooth_epochs(np.asarray(data),window_len,axis=axis,window=window)
 
 def readEphysChannel (Directory,recordingNum,Fs=30000):
     '''Read a single recording in a specific session or folder'''
@@ -358,15 +334,18 @@ def get_detrend(data):
      data_detrend = signal.detrend(data)
      return data_detrend
  
-def calculate_correlation (data1,data2):
-    '''normalize'''
+def calculate_correlation (data1,data2,max_lag=None):
+    '''normalize, max_lag (samples) only computes lags within +/- max_lag, data can be (events x samples)'''
+    if max_lag is not None or np.ndim(data1)==2:
+        lags,corr=Corr.batched_cross_correlation(data1,data2,max_lag=max_lag)
+        return lags,(corr if np.ndim(data1)==2 else corr[0])
     s1 = (data1 - np.mean(data1)) / (np.std(data1))
     s2 = (data2 - np.mean(data2)) / (np.std(data2))
     lags=signal.correlation_lags(len(data1), len(data2), mode='full') 
     corr=signal.correlate(s1, s2, mode='full', method='auto')/len(data1)
     return lags,corr
 
-def calculate_correlation_with_detrend (spad_data,lfp_data):
+def calculate_correlation_with_detrend (spad_data,lfp_data,max_lag=None):
     if isinstance(spad_data, (pd.DataFrame, pd.Series)):
         spad_np=spad_data.values
     else:
@@ -376,7 +355,7 @@ def calculate_correlation_with_detrend (spad_data,lfp_data):
     else:
         lfp_np=lfp_data
     #spad_np=get_detrend(spad_np)
-    lags,corr=calculate_correlation (spad_np,lfp_np)
+    lags,corr=calculate_correlation (spad_np,lfp_np,max_lag=max_lag)
     return lags,corr
 
 def plot_trace_nap (ax, pynapple_data,restrict_interval, color, title='LFP raw Trace'):
@@ -608,21 +587,30 @@ def plot_moving_state_heatmap(ax, speed_series,cbar=False,annot=False):
     return -1
         
 
-def Calculate_wavelet(signal_pd,lowpassCutoff=1500,Fs=10000,scale=40):
+def Calculate_wavelet(signal_pd,lowpassCutoff=1500,Fs=10000,scale=40,dtype=complex,freq_range=None,time_bin=0.01):
+    '''signal_pd can be one trace or a 2-D (epochs x samples) array of equal-length epochs,
+    all epochs are transformed in one batch. dtype=np.complex64 halves the memory.
+    freq_range=(low,high) in Hz: only compute scales in this range, each at a decimated rate,
+    and return power averaged in time_bin (seconds) bins, see calculate_wavelet_band_power.'''
     from waveletFunctions import wavelet
     if isinstance(signal_pd, np.ndarray)==False:
         signal=signal_pd.to_numpy()
     else:
         signal=signal_pd
-    sst = butter_filter(signal, btype='low', cutoff=lowpassCutoff, fs=Fs, order=5)
-    sst = sst - np.mean(sst)
+    'butter_filter works along axis 0, so filter epochs as columns'
+    sst = butter_filter(signal.T, btype='low', cutoff=lowpassCutoff, fs=Fs, order=5).T
+    sst = sst - np.mean(sst, axis=-1, keepdims=True)
+    if freq_range is not None:
+        frequency,power=calculate_wavelet_band_power(sst,freq_range,Fs=Fs,time_bin=time_bin,dtype=dtype)
+        global_ws=np.mean(power, axis=-1)
+        return sst,frequency,power,global_ws
     variance = np.std(sst, ddof=1) ** 2
     #print("variance = ", variance)
     # ----------C-O-M-P-U-T-A-T-I-O-N------S-T-A-R-T-S------H-E-R-E---------------
     if 0:
         variance = 1.0
         sst = sst / np.std(sst, ddof=1)
-    n = len(sst)
+    n = sst.shape[-1]
     dt = 1/Fs
 
     pad = 1  # pad the time series with zeroes (recommended)
@@ -633,15 +621,43 @@ def Calculate_wavelet(signal_pd,lowpassCutoff=1500,Fs=10000,scale=40):
     #print("lag1 = ", lag1)
     mother = 'MORLET'
     # Wavelet transform:
-    wave, period, scale, coi = wavelet(sst, dt, pad, dj, s0, j1, mother)
+    wave, period, scale, coi = wavelet(sst, dt, pad, dj, s0, j1, mother, dtype=dtype)
     power = (np.abs(wave)) ** 2  # compute wavelet power spectrum
-    global_ws = (np.sum(power, axis=1) / n)  # time-average over all times
+    global_ws = (np.sum(power, axis=-1) / n)  # time-average over all times
     frequency=1/period
     return sst,frequency,power,global_ws
 
+def calculate_wavelet_band_power(sst,freq_range,Fs=10000,dj=0.25,time_bin=0.01,dtype=np.complex64,oversample=8):
+    '''Morlet wavelet power only for frequencies in freq_range (dj sub-octaves, high to low like Calculate_wavelet).
+    Each frequency is computed on the signal decimated to at least oversample*frequency,
+    and the power is averaged in time_bin bins, so the output is (frequencies x time bins).'''
+    from waveletFunctions import wavelet
+    sst=np.asarray(sst)
+    low_freq,high_freq=freq_range
+    n_scales=int(np.floor(np.log2(high_freq/low_freq)/dj))+1
+    frequency=high_freq*2.**(-np.arange(n_scales)*dj)
+    bin_len=max(1,int(round(time_bin*Fs)))
+    n_bins=sst.shape[-1]//bin_len
+    power=np.empty(sst.shape[:-1]+(n_scales,n_bins))
+    'Decimation factor per frequency, must divide the bin length so the bins stay aligned'
+    divisors=np.array([q for q in range(1,bin_len+1) if bin_len%q==0])
+    factors=np.array([divisors[divisors<=max(1,Fs/(oversample*f))].max() for f in frequency])
+    for q in np.unique(factors):
+        scale_index=np.flatnonzero(factors==q)
+        x=signal.resample_poly(sst,1,q,axis=-1) if q>1 else sst
+        wave,_,_,_=wavelet(x,q/Fs,1,mother='MORLET',freq=frequency[scale_index],dtype=dtype)
+        'Torrence-Compo power scales with 1/dt, multiply by q to match the power at Fs'
+        band_power=q*np.abs(wave[...,:n_bins*(bin_len//q)])**2
+        power[...,scale_index,:]=band_power.reshape(band_power.shape[:-1]+(n_bins,bin_len//q)).mean(axis=-1)
+    return frequency,power
+
 def plot_wavelet(ax,sst,frequency,power,Fs=10000,colorBar=False,logbase=False):
     import matplotlib.ticker as ticker
-    time = np.arange(len(sst)) /Fs   # construct time array
+    'power can be time-binned (from freq_range mode), then the bin centres are used'
+    bin_width=len(sst)/Fs/power.shape[-1]
+    time = np.arange(power.shape[-1])*bin_width   # construct time array
+    if power.shape[-1]!=len(sst):
+        time = time+bin_width/2
     level=8 #level is how many contour levels you want
     CS = ax.contourf(time, frequency, power, level)
     #ax.set_xlabel('Time (seconds)')
@@ -906,35 +922,32 @@ def calculate_theta_phase_angle(channel_data, theta_low=5, theta_high=9):
     return angle
 
 def calculate_theta_trough_index(df,Fs=10000):
-    troughs = (df['theta_angle'] < df['theta_angle'].shift(-1)) & (df['theta_angle'] < df['theta_angle'].shift(1)) & (df['theta_angle']<-3.13)
+    'Troughs are found on the theta phase with NumPy, see EpochTools.find_phase_troughs'
+    troughs = Epoch.find_phase_troughs(df['theta_angle'].to_numpy())
     trough_index = df.index[troughs]
     #trough_time=trough_index/Fs
     return trough_index
 
-def plot_zscore_to_theta_phase (theta_angle,zscore_data):
+def plot_zscore_to_theta_phase (theta_angle,zscore_data,bins=30,offset=None):
+    '''Mean low-passed zscore per theta phase bin, as a histogram and a star plot.
+    The circular statistics (see PhaseTools.phase_modulation_statistics) need a non-negative amplitude,
+    for a signed zscore pass offset (subtracted from the zscore, e.g. offset=-3), otherwise None is returned.'''
     # Create a polar plot of ΔF/F against theta phase
     zscore_data=butter_filter(zscore_data, btype='low', cutoff=50, fs=10000, order=5)
     #zscore_data=smooth_signal(zscore_data, Fs=10000, cutoff=50)
-    bins=30
+    'All bins in one pass, see PhaseTools'
+    phase_sums=Phase.phase_bin_sums(theta_angle,zscore_data,bins=bins)
+    zscore_means,_,_=Phase.phase_bin_statistics(phase_sums)
+    bin_edges,bin_centers=Phase.get_phase_bin_edges(bins)
     plt.figure(figsize=(8, 8))
     ax = plt.subplot(111, polar=True)
-    # Create a histogram of theta phases weighted by zscore_data
-    ax.hist(theta_angle, bins=bins, weights=zscore_data, color='blue', alpha=0.6, edgecolor='black')
+    # Histogram of theta phases weighted by zscore_data
+    ax.bar(bin_centers, phase_sums['sum'][0], width=np.diff(bin_edges), color='blue', alpha=0.6, edgecolor='black')
     ax.set_title("ΔF/F vs Theta Phase (Histogram)", va='bottom')
     plt.show()
     
-    bin_edges = np.linspace(-np.pi, np.pi, bins + 1)
-    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
-    zscore_means = []
-
-    for i in range(len(bin_edges) - 1):
-        indices = (theta_angle >= bin_edges[i]) & (theta_angle < bin_edges[i + 1])
-        zscore_means.append(np.mean(zscore_data[indices]))
-
-    zscore_means = np.array(zscore_means)
-
     # Close the circular data
-    zscore_means = np.append(zscore_means, zscore_means[0])
+    zscore_means = np.append(zscore_means[0], zscore_means[0][0])
     bin_centers = np.append(bin_centers, bin_centers[0])
 
     # Create the polar plot
@@ -944,67 +957,29 @@ def plot_zscore_to_theta_phase (theta_angle,zscore_data):
     #ax.fill(bin_centers, zscore_means, color='blue', alpha=0.3)
     ax.set_title("ΔF/F vs Theta Phase (Star Plot)", va='bottom')
     plt.show()
+    if offset is None and phase_sums['min'][0] < 0:
+        print ('Signed zscore, pass offset to get the phase modulation statistics')
+        return None
+    return Phase.phase_modulation_statistics(phase_sums, 0 if offset is None else offset)
 
 
 def get_theta_cycle_value(df, LFP_channel, trough_index, half_window, fs=10000):
-    df=df.reset_index(drop=True)
-    half_window = half_window  # second
-    # Initialize lists to store cycle data
-    cycle_data_values_zscore = []
-    cycle_data_values_lfp = []
-    #half_cycle_time = pd.to_timedelta(half_window, unit='s')
-    half_cycle_time=half_window
-    zscore_raw_smoothed=smooth_signal(df['zscore_raw'],fs,cutoff=50,window='flat')
-    if len(zscore_raw_smoothed) == len(df['zscore_raw']):
-        zscore_raw_smoothed_series = pd.Series(zscore_raw_smoothed, index=df['zscore_raw'].index)
-    else:
-        print("Error: Mismatched lengths between the smoothed data and the DataFrame.")
-    # Extract A values for each cycle and calculate mean and std
-    # zscore_filtered=band_pass_filter(df['zscore_raw'],4,20,fs)
-    # df['zscore_raw']=zscore_filtered
-    for i in range(len(trough_index)):
-        start = int(trough_index[i] - half_cycle_time*fs)
-        end = int(trough_index[i] + half_cycle_time*fs)
-        cycle_zscore = zscore_raw_smoothed_series.loc[start:end]
-
-        cycle_lfp = df[LFP_channel].loc[start:end]
-        cycle_zscore_np = cycle_zscore.to_numpy()
-        #cycle_zscore_np = cycle_zscore
-        cycle_lfp_np = cycle_lfp.to_numpy()
-        if len(cycle_lfp_np) > half_window * fs * 2:
-            cycle_data_values_zscore.append(cycle_zscore_np)
-            cycle_data_values_lfp.append(cycle_lfp_np)
-    #print(cycle_data_values_zscore)
-    cycle_data_values_zscore_np = np.vstack(cycle_data_values_zscore)
-    cycle_data_values_lfp_np = np.vstack(cycle_data_values_lfp)
+    '''(cycles x samples) zscore and LFP around each theta trough, trough_index are positions in df.
+    zscore_raw is smoothed once on the whole trace, then all cycles are gathered in one go,
+    cycles without a full window at the edges are dropped.'''
+    half_window_len=int(half_window*fs)
+    zscore_raw_smoothed=Epoch.smooth_epochs(df['zscore_raw'].to_numpy(),int(fs/50),axis=0)
+    cycles,_=Epoch.extract_cycle_epochs([zscore_raw_smoothed,df[LFP_channel].to_numpy()],trough_index,half_window_len)
+    cycle_data_values_zscore_np = cycles[:,:,0]
+    cycle_data_values_lfp_np = cycles[:,:,1]
     return cycle_data_values_zscore_np,cycle_data_values_lfp_np
     
 def plot_theta_cycle(df, LFP_channel, trough_index, half_window, fs=10000,plotmode='one'):
-    half_window = half_window  # second
-    # Initialize lists to store cycle data
-    cycle_data_values_zscore = []
-    cycle_data_values_lfp = []
-    #half_cycle_time = pd.to_timedelta(half_window, unit='s')
-    half_cycle_time=half_window
-    # Extract A values for each cycle and calculate mean and std
-    # zscore_filtered=band_pass_filter(df['zscore_raw'],4,20,fs)
-    # df['zscore_raw']=zscore_filtered
-    for i in range(len(trough_index)):
-        start = int(trough_index[i] - half_cycle_time*fs)
-        end = int(trough_index[i] + half_cycle_time*fs)
-        cycle_zscore = df['zscore_raw'].loc[start:end]
-        #print ('length of the cycle',len(cycle_zscore))
-        cycle_zscore=smooth_signal(cycle_zscore,fs,cutoff=50,window='flat')
-        cycle_lfp = df[LFP_channel].loc[start:end]
-        #cycle_zscore_np = cycle_zscore.to_numpy()
-        cycle_zscore_np = cycle_zscore
-        cycle_lfp_np = cycle_lfp.to_numpy()
-        if len(cycle_lfp_np) > half_window * fs * 2:
-            cycle_data_values_zscore.append(cycle_zscore_np)
-            cycle_data_values_lfp.append(cycle_lfp_np)
-    #print(cycle_data_values_zscore)
-    cycle_data_values_zscore_np = np.vstack(cycle_data_values_zscore)
-    cycle_data_values_lfp_np = np.vstack(cycle_data_values_lfp)
+    'All cycles are gathered as one (cycles x samples x channels) array, zscore is smoothed per cycle along axis 1'
+    half_window_len=int(half_window*fs)
+    cycles,_=Epoch.extract_cycle_epochs([df['zscore_raw'].to_numpy(),df[LFP_channel].to_numpy()],trough_index,half_window_len)
+    cycle_data_values_zscore_np = Epoch.smooth_epochs(cycles[:,:,0],int(fs/50))
+    cycle_data_values_lfp_np = cycles[:,:,1]
     
     mean_zscore,std_zscore, CI_zscore=calculateStatisticNumpy (cycle_data_values_zscore_np)
     mean_lfp,std_lfp, CI_LFP=calculateStatisticNumpy (cycle_data_values_lfp_np)
@@ -1045,119 +1020,72 @@ def plot_theta_cycle(df, LFP_channel, trough_index, half_window, fs=10000,plotmo
     return -1
 
 
-def compute_and_plot_gamma_correlation(zscore, gamma_band, fs):
-    # Compute the envelope (power) of gamma-band-filtered LFP
-    gamma_power = np.abs(signal.hilbert(gamma_band))
-
-    # Downsample zscore and gamma_power if necessary to match sampling rates
-    if len(zscore) != len(gamma_power):
-        min_len = min(len(zscore), len(gamma_power))
-        zscore = zscore[:min_len]
-        gamma_power = gamma_power[:min_len]
-
-    # Compute Pearson and Spearman correlations
-    pearson_corr, _ = pearsonr(zscore, gamma_power)
-    spearman_corr, _ = spearmanr(zscore, gamma_power)
-
-    # Print correlation values
-    print(f"Pearson Correlation: {pearson_corr:.3f}")
-    print(f"Spearman Correlation: {spearman_corr:.3f}")
-
-    # Scatter plot with regression line
+def plot_envelope_correlation(correlation,xlabel,ylabel,title):
+    '''Density of the pre-binned 2-D histogram from Corr.envelope_correlation with the regression line.'''
+    print(f"Pearson Correlation: {correlation['pearson']:.3f}")
+    print(f"Spearman Correlation: {correlation['spearman']:.3f}")
     plt.figure(figsize=(8, 6))
-    
-    # Create a hexbin plot to manage dense scatter points
-    hb = plt.hexbin(gamma_power, zscore, gridsize=50, cmap='Blues', mincnt=1)
-    cb = plt.colorbar(hb)
+    'Empty bins are not drawn, like hexbin with mincnt=1'
+    histogram=np.ma.masked_equal(correlation['histogram'],0)
+    mesh = plt.pcolormesh(correlation['x_edges'], correlation['y_edges'], histogram.T, cmap='Blues')
+    cb = plt.colorbar(mesh)
     cb.set_label('Count')
-
-    # Regression line (least squares fit)
-    m, b = np.polyfit(gamma_power, zscore, 1)
-    x = np.linspace(np.min(gamma_power), np.max(gamma_power), 100)
-    plt.plot(x, m * x + b, color='red', label=f'Regression Line (R={pearson_corr:.2f})')
-
-    # Plot details
-    plt.xlabel("Gamma Power (Envelope)")
-    plt.ylabel("ΔF/F (Z-score)")
-    plt.title("Correlation Between Gamma Power and ΔF/F")
+    x = np.linspace(correlation['x_edges'][0], correlation['x_edges'][-1], 100)
+    plt.plot(x, correlation['slope'] * x + correlation['intercept'], color='red', label=f"Regression Line (R={correlation['pearson']:.2f})")
+    plt.xlabel(xlabel)
+    plt.ylabel(ylabel)
+    plt.title(title)
     plt.legend()
     plt.grid(alpha=0.3)
     plt.show()
-    
-def compute_and_plot_gamma_power_correlation(zscore, LFP,gamma_band=(30,80), fs=10000):
-    # Filter for gamma band (30-80 Hz)
-    zscore_gamma_band = band_pass_filter(zscore, gamma_band[0], gamma_band[1], fs)
-    LFP_gamma_band = band_pass_filter(LFP, gamma_band[0], gamma_band[1], fs)
-
-    # Compute the envelope (power) of gamma-band-filtered signals
-    zscore_gamma_power = np.abs(signal.hilbert(zscore_gamma_band))
-    LFP_gamma_power = np.abs(signal.hilbert(LFP_gamma_band))#
-    
-    # Downsample if necessary to match sampling rates
-    if len(zscore_gamma_power) != len(LFP_gamma_power):
-        min_len = min(len(zscore_gamma_power), len(LFP_gamma_power))
-        zscore_gamma_power = zscore_gamma_power[:min_len]
-        LFP_gamma_power = LFP_gamma_power[:min_len]
-
-    # Compute Pearson and Spearman correlations
-    pearson_corr, _ = pearsonr(LFP_gamma_power, zscore_gamma_power)
-    spearman_corr, _ = spearmanr(LFP_gamma_power, zscore_gamma_power)
-
-    # Print correlation values
-    print(f"Pearson Correlation: {pearson_corr:.3f}")
-    print(f"Spearman Correlation: {spearman_corr:.3f}")
+    return -1
 
-    # Scatter plot with regression line
-    plt.figure(figsize=(8, 6))
+def compute_and_plot_gamma_correlation(zscore, gamma_band, fs, target_fs=200):
+    '''Correlation of the gamma envelope with zscore, both decimated to target_fs, see Corr.envelope_correlation.'''
+    # Compute the envelope (power) of gamma-band-filtered LFP
+    gamma_power = np.abs(signal.hilbert(gamma_band))
+    correlation = Corr.envelope_correlation(gamma_power, np.asarray(zscore), fs, target_fs=target_fs)
+    plot_envelope_correlation(correlation, "Gamma Power (Envelope)", "ΔF/F (Z-score)", "Correlation Between Gamma Power and ΔF/F")
+    return correlation
     
-    # Create a hexbin plot to manage dense scatter points
-    hb = plt.hexbin(LFP_gamma_power, zscore_gamma_power, gridsize=50, cmap='Blues', mincnt=1)
-    cb = plt.colorbar(hb)
-    cb.set_label('Count')
-
-    # Regression line (least squares fit)
-    m, b = np.polyfit(LFP_gamma_power, zscore_gamma_power, 1)
-    x = np.linspace(np.min(LFP_gamma_power), np.max(LFP_gamma_power), 100)
-    plt.plot(x, m * x + b, color='red', label=f'Regression Line (R={pearson_corr:.2f})')
-
-    # Plot details
-    plt.xlabel("LFP Gamma Power (Envelope)")
-    plt.ylabel("ΔF/F Gamma Power (Envelope)")
-    plt.title("Correlation Between LFP Gamma Power and ΔF/F Gamma Power")
-    plt.legend()
-    plt.grid(alpha=0.3)
-    plt.show()
+def compute_and_plot_gamma_power_correlation(zscore, LFP,gamma_band=(30,80), fs=10000, target_fs=200):
+    '''Correlation of the LFP and optical gamma envelopes, both decimated to target_fs, see Corr.envelope_correlation.'''
+    min_len = min(len(zscore), len(LFP))
+    # Filter both signals for gamma band (30-80 Hz), as columns in one call
+    gamma_filtered = band_pass_filter(np.column_stack((np.asarray(LFP)[:min_len], np.asarray(zscore)[:min_len])), gamma_band[0], gamma_band[1], fs).T
+    # Compute the envelope (power) of gamma-band-filtered signals
+    LFP_gamma_power, zscore_gamma_power = np.abs(signal.hilbert(gamma_filtered, axis=-1))
+    correlation = Corr.envelope_correlation(LFP_gamma_power, zscore_gamma_power, fs, target_fs=target_fs)
+    plot_envelope_correlation(correlation, "LFP Gamma Power (Envelope)", "ΔF/F Gamma Power (Envelope)",
+                              "Correlation Between LFP Gamma Power and ΔF/F Gamma Power")
+    return correlation
     
-def plot_gamma_amplitude_on_theta_phase(LFP, zscore, fs, theta_band=(4, 12), gamma_band=(30, 80), bins=30):
-    """Plot gamma amplitude averaged over theta phases with a polar plot."""
-    # Filter LFP for theta and gamma bands
-    theta_filtered = band_pass_filter(LFP, theta_band[0], theta_band[1], fs)
-    gamma_filtered_LFP = band_pass_filter(LFP, gamma_band[0], gamma_band[1], fs)
-    gamma_filtered_zscore = band_pass_filter(zscore, gamma_band[0], gamma_band[1], fs)
-
-    # Compute theta phase and gamma amplitude
-    theta_phase = np.angle(signal.hilbert(theta_filtered))
-    gamma_amplitude_LFP = np.abs(signal.hilbert(gamma_filtered_LFP))
-    gamma_amplitude_zscore = np.abs(signal.hilbert(gamma_filtered_zscore))
-
-    # Bin the theta phase and average gamma amplitude within each bin
-    bin_edges = np.linspace(-np.pi, np.pi, bins + 1)
-    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
-
-    gamma_amplitude_avg_LFP = []
-    gamma_amplitude_avg_zscore = []
-
-    for i in range(len(bin_edges) - 1):
-        indices = (theta_phase >= bin_edges[i]) & (theta_phase < bin_edges[i + 1])
-        gamma_amplitude_avg_LFP.append(np.mean(gamma_amplitude_LFP[indices]))
-        gamma_amplitude_avg_zscore.append(np.mean(gamma_amplitude_zscore[indices]))
+def plot_gamma_amplitude_on_theta_phase(LFP, zscore, fs, theta_band=(4, 12), gamma_band=(30, 80), bins=30, chunk_len=None):
+    """Plot gamma amplitude averaged over theta phases with a polar plot.
+    chunk_len (seconds): filter and bin the recording in chunks, for whole sessions.
+    Returns the circular statistics (modulation index, preferred phase...) for [LFP, zscore]."""
+    LFP=np.asarray(LFP)
+    zscore=np.asarray(zscore)
+    if chunk_len is None:
+        # Filter LFP for theta and both signals for gamma (as columns, in one call)
+        theta_filtered = band_pass_filter(LFP, theta_band[0], theta_band[1], fs)
+        gamma_filtered = band_pass_filter(np.column_stack((LFP, zscore)), gamma_band[0], gamma_band[1], fs).T
+        # Compute theta phase and gamma amplitude
+        theta_phase = np.angle(signal.hilbert(theta_filtered))
+        gamma_amplitude = np.abs(signal.hilbert(gamma_filtered, axis=-1))
+        phase_sums = Phase.phase_bin_sums(theta_phase, gamma_amplitude, bins=bins)
+    else:
+        chunks = Phase.iter_phase_amplitude_chunks(LFP, [LFP, zscore], fs, theta_band, gamma_band,
+                                                   band_pass_filter, chunk_len=chunk_len)
+        phase_sums = Phase.accumulate_phase_bins(chunks, bins=bins)
 
-    gamma_amplitude_avg_LFP = np.array(gamma_amplitude_avg_LFP)
-    gamma_amplitude_avg_zscore = np.array(gamma_amplitude_avg_zscore)
+    # Average gamma amplitude within each theta phase bin
+    gamma_amplitude_avg,_,_ = Phase.phase_bin_statistics(phase_sums)
+    _,bin_centers = Phase.get_phase_bin_edges(bins)
 
     # Close the circular data for smooth plotting
-    gamma_amplitude_avg_LFP = np.append(gamma_amplitude_avg_LFP, gamma_amplitude_avg_LFP[0])
-    gamma_amplitude_avg_zscore = np.append(gamma_amplitude_avg_zscore, gamma_amplitude_avg_zscore[0])
+    gamma_amplitude_avg_LFP = np.append(gamma_amplitude_avg[0], gamma_amplitude_avg[0][0])
+    gamma_amplitude_avg_zscore = np.append(gamma_amplitude_avg[1], gamma_amplitude_avg[1][0])
     bin_centers = np.append(bin_centers, bin_centers[0])
 
     # Create polar plot
@@ -1184,76 +1112,82 @@ def plot_gamma_amplitude_on_theta_phase(LFP, zscore, fs, theta_band=(4, 12), gam
 
     # Show plot
     plt.show()
+    return Phase.phase_modulation_statistics(phase_sums)
 
     
+def calculate_cycle_wavelet_power(sst, trough_index, half_window_len, Fs=10000, scale=40, chunk_len=60, pad_len=1, dtype=np.complex64):
+    '''Morlet power (cycles x frequencies x samples) in [trough-half_window_len, trough+half_window_len] for every trough,
+    gathered from the CWT of the continuous trace (same scales as Calculate_wavelet), so there are no per-cycle edge effects.
+    The trace is transformed in chunks of chunk_len seconds, with pad_len seconds plus half a window of neighbouring data.
+    Troughs without a full window are dropped. Returns frequency, power (float32) and the trough index that was kept.'''
+    from waveletFunctions import wavelet
+    from numpy.lib.stride_tricks import sliding_window_view
+    sst=np.asarray(sst,dtype=float)
+    n=len(sst)
+    trough_index=Epoch.get_cycle_index(trough_index,n,half_window_len)
+    window_len=2*half_window_len+1
+    dt=1/Fs
+    dj=0.25
+    chunk=int(chunk_len*Fs)
+    pad=int(pad_len*Fs)+half_window_len
+    frequency,power=None,None
+    for start in range(0,n,chunk):
+        in_chunk=np.flatnonzero((trough_index>=start)&(trough_index<start+chunk))
+        if len(in_chunk)==0:
+            continue
+        lo=max(0,start-pad)
+        hi=min(n,start+chunk+pad)
+        wave,period,_,_=wavelet(sst[lo:hi],dt,1,dj,scale*dt,7/dj,'MORLET',dtype=dtype)
+        if power is None:
+            frequency=1/period
+            power=np.empty((len(trough_index),len(period),window_len),dtype=np.float32)
+        windows=sliding_window_view(np.abs(wave)**2,window_len,axis=-1)  # (scales x starts x window) view
+        power[in_chunk]=np.swapaxes(windows[:,trough_index[in_chunk]-half_window_len-lo],0,1)
+    return frequency,power,trough_index
+
+def calculate_theta_cycle_gamma_power(Fs,df, LFP_channel, trough_index, half_window,gamma_band=(30, 80)):
+    '''Cycle-resolved theta/gamma traces and gamma wavelet power around each theta trough (positions in df).
+    Smoothing, band-pass filters and the CWT run once on the continuous traces, cycles are gathered by index.
+    Returns a dict of (cycles x samples) traces and (cycles x frequencies x samples) power that can be averaged or saved.'''
+    half_window_len=int(half_window*Fs)
+    zscore_raw=df['zscore_raw'].to_numpy()
+    lfp=df[LFP_channel].to_numpy()
+    zscore=Epoch.smooth_epochs(zscore_raw,int(Fs/100),axis=0)
+    zscore_theta=Epoch.smooth_epochs(zscore_raw,int(Fs/15),axis=0)
+    'Same filtering as band_pass_filter followed by the low-pass in Calculate_wavelet, LFP and optical gamma filtered as columns'
+    sst_theta=butter_filter(band_pass_filter(lfp,low_freq=4,high_freq=12,Fs=Fs),btype='low',cutoff=50,fs=Fs,order=5)
+    gamma_filtered=band_pass_filter(np.column_stack((lfp,zscore)),low_freq=gamma_band[0],high_freq=gamma_band[1],Fs=Fs)
+    sst_gamma=butter_filter(gamma_filtered,btype='low',cutoff=100,fs=Fs,order=5).T
+    sst_gamma=sst_gamma-np.mean(sst_gamma,axis=-1,keepdims=True)
+    frequency,gamma_power_lfp,trough_index=calculate_cycle_wavelet_power(sst_gamma[0],trough_index,half_window_len,Fs=Fs)
+    _,gamma_power_spad,_=calculate_cycle_wavelet_power(sst_gamma[1],trough_index,half_window_len,Fs=Fs)
+    cycles,_=Epoch.extract_cycle_epochs([zscore_theta,lfp,sst_theta,sst_gamma[0],sst_gamma[1]],trough_index,half_window_len)
+    theta_cycle_gamma={'trough_index':trough_index,
+                       'time':np.linspace(-half_window,half_window,cycles.shape[1]),
+                       'frequency':frequency,
+                       'zscore':cycles[:,:,0],
+                       'lfp':cycles[:,:,1],
+                       'sst_theta':cycles[:,:,2],
+                       'sst_gamma_lfp':cycles[:,:,3],
+                       'sst_gamma_spad':cycles[:,:,4],
+                       'gamma_power_lfp':gamma_power_lfp,
+                       'gamma_power_spad':gamma_power_spad}
+    return theta_cycle_gamma
+
 def plot_gamma_power_on_theta(Fs,df, LFP_channel, trough_index, half_window,gamma_band=(30, 80)):
-    'plot low gamma'
-    half_window = half_window  # second
-    # Initialize lists to store cycle data
-    cycle_data_values_zscore = []
-    cycle_data_values_lfp = []
-    theta_power_values=[]
-    gamma_power_values=[]
-    gamma_power_values_spad=[]
-    # theta_power_max_values=[]
-    # gamma_power_max_lfp_values=[]
-    # gamma_power_max_spad_values=[]
-    sst_theta_values=[]
-    sst_gamma_lfp_values=[]
-    sst_gamma_spad_values=[]
-    gamma_amp_correlations=[]
-    #half_cycle_time = pd.to_timedelta(half_window, unit='s')
-
-    # Extract A values for each cycle and calculate mean and std
-    for i in range(len(trough_index)):
-        start = int(trough_index[i] - half_window*Fs)
-        end = int(trough_index[i] + half_window*Fs)
-        cycle_zscore_raw = df['zscore_raw'].loc[start:end]
-        #print ('length of the cycle',len(cycle_zscore))
-        cycle_zscore=smooth_signal(cycle_zscore_raw,Fs,cutoff=100,window='flat')
-        cycle_zscore_theta=smooth_signal(cycle_zscore_raw,Fs,cutoff=15,window='flat')
-        cycle_lfp = df[LFP_channel].loc[start:end]
-        #cycle_zscore_np = cycle_zscore.to_numpy()
-        cycle_zscore_np = cycle_zscore
-        cycle_lfp_np = cycle_lfp.to_numpy()
-        theta_band_filtered_cycle_lfp=band_pass_filter(cycle_lfp_np,low_freq=4,high_freq=12,Fs=Fs)
-        sst_theta,theta_frequency,theta_power_cycle,_=Calculate_wavelet(theta_band_filtered_cycle_lfp,lowpassCutoff=50,Fs=Fs,scale=80) 
-        #theta_power_max=theta_power_cycle[16]
-        
-        gamma_band_filtered_cycle_lfp=band_pass_filter(cycle_lfp_np,low_freq=gamma_band[0],high_freq=gamma_band[1],Fs=Fs)
-        sst_gamma_lfp,frequency,power_cycle,_=Calculate_wavelet(gamma_band_filtered_cycle_lfp,lowpassCutoff=100,Fs=Fs,scale=40) 
-        #gamma_power_max_lfp=power_cycle[8]
-        
-        gamma_band_filtered_cycle_spad=band_pass_filter(cycle_zscore_np,low_freq=gamma_band[0],high_freq=gamma_band[1],Fs=Fs)
-        sst_gamma_spad,frequency_spad,power_cycle_spad,_=Calculate_wavelet(gamma_band_filtered_cycle_spad,lowpassCutoff=100,Fs=Fs,scale=40) 
-        #gamma_power_max_spad=power_cycle_spad[8]
-        
-        if len(cycle_lfp_np) > half_window * Fs * 2:
-            cycle_data_values_zscore.append(cycle_zscore_theta)
-            cycle_data_values_lfp.append(cycle_lfp_np)
-            theta_power_values.append(theta_power_cycle)
-            gamma_power_values.append(power_cycle)
-            gamma_power_values_spad.append(power_cycle_spad)
-            # theta_power_max_values.append(theta_power_max)
-            # gamma_power_max_lfp_values.append(gamma_power_max_lfp)
-            # gamma_power_max_spad_values.append(gamma_power_max_spad)
-            sst_theta_values.append(sst_theta)
-            sst_gamma_lfp_values.append(sst_gamma_lfp)
-            sst_gamma_spad_values.append(sst_gamma_spad)
-            
-    cycle_data_values_zscore_np = np.vstack(cycle_data_values_zscore)
-    cycle_data_values_lfp_np = np.vstack(cycle_data_values_lfp)
-    # theta_power_max_values_np=np.vstack(theta_power_max_values)
-    # gamma_power_max_lfp_values_np=np.vstack(gamma_power_max_lfp_values)
-    # gamma_power_max_spad_values_np=np.vstack(gamma_power_max_spad_values)
-    sst_theta_values_np=np.vstack(sst_theta_values)
-    sst_gamma_lfp_values_np=np.vstack(sst_gamma_lfp_values)
-    sst_gamma_spad_values_np=np.vstack(sst_gamma_spad_values)
+    '''plot low gamma. Cycles come from calculate_theta_cycle_gamma_power, which is also returned.'''
+    theta_cycle_gamma=calculate_theta_cycle_gamma_power(Fs,df,LFP_channel,trough_index,half_window,gamma_band=gamma_band)
+    cycle_data_values_zscore_np = theta_cycle_gamma['zscore']
+    cycle_data_values_lfp_np = theta_cycle_gamma['lfp']
+    sst_theta_values_np=theta_cycle_gamma['sst_theta']
+    sst_gamma_lfp_values_np=theta_cycle_gamma['sst_gamma_lfp']
+    sst_gamma_spad_values_np=theta_cycle_gamma['sst_gamma_spad']
+    frequency=frequency_spad=theta_cycle_gamma['frequency']
 
     mean_zscore,std_zscore, CI_zscore=calculateStatisticNumpy (cycle_data_values_zscore_np)
     mean_lfp,std_lfp, CI_LFP=calculateStatisticNumpy (cycle_data_values_lfp_np)
-    average_gamma_powerSpectrum = np.mean(gamma_power_values, axis=0)
-    average_gamma_powerSpectrum_spad = np.mean(gamma_power_values_spad, axis=0)
+    average_gamma_powerSpectrum = np.mean(theta_cycle_gamma['gamma_power_lfp'], axis=0)
+    average_gamma_powerSpectrum_spad = np.mean(theta_cycle_gamma['gamma_power_spad'], axis=0)
     
     # mean_theta_power,std_theta_power, CI_theta_power=calculateStatisticNumpy (theta_power_max_values_np)
     # mean_gamma_lfp_power,std_gamma_lfp_power, CI_gamma_lfp_power=calculateStatisticNumpy (gamma_power_max_lfp_values_np)
@@ -1334,7 +1268,7 @@ def plot_gamma_power_on_theta(Fs,df, LFP_channel, trough_index, half_window,gamm
     ax2.spines['top'].set_visible(False)
     ax2.spines['right'].set_visible(False)
     
-    return -1
+    return theta_cycle_gamma
 
 def find_peak_and_std(data,half_win_len,mode='max'):
     if isinstance(data, pd.Series):
@@ -1376,14 +1310,9 @@ def align_numpy_array_to_same_length (data):
     filtered_data = filtered_data.astype(float)
     return filtered_data
 
-def calculateStatisticNumpy (data):
-    mean = np.mean(data, axis=0)
-    std = np.std(data, axis=0)
-    sem = stats.sem(data)
-    df = len(data) - 1
-    moe = stats.t.ppf(0.975, df) * sem  # 0.975 for 95% confidence level (two-tailed)
-    # Calculate the confidence interval
-    confidence_interval = mean - moe, mean + moe
+def calculateStatisticNumpy (data,CI_method='t',n_boot=1000):
+    'data: (events x samples), CI_method: t for 95% t-distribution CI, bootstrap for percentile bootstrap CI'
+    mean,std,confidence_interval=Epoch.calculate_epoch_statistics(data,confidence=0.95,CI_method=CI_method,n_boot=n_boot)
     return mean,std, confidence_interval
 
 def getNormalised (data):
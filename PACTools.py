@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Phase-amplitude coupling (PAC) comodulogram for LFP and optical signals.
+
+Signals are decimated to a working rate, then every phase band and every amplitude band is filtered once
+(zero-phase SOS filters from a cached filter bank) and Hilbert transformed.
+For each phase band, every amplitude band is binned with np.bincount on the phase bin index,
+giving the Tort modulation index (MI) or the mean vector length (MVL) for the whole comodulogram.
+calculate_comodulograms filters each named signal once and reuses it for every (phase, amplitude) pair.
+Surrogates circularly shift the phase bin index. They run in this process by default; with n_workers>1 they are split
+over a process pool whose workers read the phase bins and envelopes from shared memory, so the band-filtered data
+are not copied to every task. Scripts that use n_workers>1 must call it under if __name__ == '__main__':
+(Windows starts workers by re-importing the script).
+"""
+import numpy as np
+from functools import lru_cache
+from scipy import signal
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import PhaseTools as Phase
+
+def make_bands(centres, width):
+    '''(low, high) bands of the given width (Hz) around each centre frequency.'''
+    return tuple((float(f - width / 2), float(f + width / 2)) for f in centres)
+
+@lru_cache(maxsize=16)
+def get_filter_bank(fs, bands, order=4):
+    '''Band-pass SOS filters for a tuple of (low, high) bands, cached per (fs, bands, order).'''
+    return [signal.butter(order, [low, high], btype='bandpass', fs=fs, output='sos') for low, high in bands]
+
+def filter_bank_hilbert(x, fs, bands, order=4):
+    '''Analytic signal (bands x samples) of x in every band, each band filtered once.'''
+    x = np.asarray(x, dtype=float)
+    analytic = np.empty((len(bands), len(x)), dtype=np.complex64)
+    for i, sos in enumerate(get_filter_bank(fs, bands, order)):
+        analytic[i] = signal.hilbert(signal.sosfiltfilt(sos, x))
+    return analytic
+
+def get_working_rate(Fs, amplitude_bands, oversample=4):
+    '''Decimation factor that keeps the rate above oversample times the highest amplitude frequency.'''
+    high_freq = max(high for _, high in amplitude_bands)
+    return max(1, int(Fs // (oversample * high_freq)))
+
+def comodulogram_from_phase_amplitude(phase_bin_index, amplitude, phase, bins=18, method='tort'):
+    '''Comodulogram (phase bands x amplitude bands).
+    phase_bin_index: (phase bands x samples) bin index, amplitude: (amplitude bands x samples),
+    phase: (phase bands x samples) radians (only used for MVL).'''
+    n_phase = phase_bin_index.shape[0]
+    n_amp = amplitude.shape[0]
+    pac = np.empty((n_phase, n_amp))
+    for i in range(n_phase):
+        if method == 'mvl':
+            'Canolty mean vector length, |mean(a*exp(i*phase))|, all amplitude bands in one product'
+            pac[i] = np.abs(amplitude @ np.exp(1j * phase[i])) / amplitude.shape[1]
+        else:
+            pac[i] = tort_modulation_index(phase_bin_index[i], amplitude, bins)
+    return pac
+
+def tort_modulation_index(bin_index, amplitude, bins=18):
+    '''Tort MI of every amplitude row for one phase bin index.
+    The per-bin amplitude sums are one weighted bincount per row, no (samples x bins) matrix is built.'''
+    amp_sum = np.stack([np.bincount(bin_index, weights=row, minlength=bins) for row in amplitude])
+    count = np.bincount(bin_index, minlength=bins)
+    mean_amp = amp_sum / np.maximum(count, 1)
+    P = mean_amp / mean_amp.sum(axis=1, keepdims=True)
+    entropy_term = np.sum(np.where(P > 0, P * np.log(np.where(P > 0, P, 1)), 0), axis=1)
+    return (np.log(bins) + entropy_term) / np.log(bins)
+
+def surrogate_comodulograms(phase_bin_index, amplitude, phase, shifts, bins=18, method='tort'):
+    '''Comodulograms with the phase circularly shifted by each value in shifts (samples).
+    Top-level function so it can run in a worker process. Returns (surrogates x phase bands x amplitude bands).'''
+    surrogates = np.empty((len(shifts), phase_bin_index.shape[0], amplitude.shape[0]))
+    for i, shift in enumerate(shifts):
+        surrogates[i] = comodulogram_from_phase_amplitude(np.roll(phase_bin_index, shift, axis=1), amplitude,
+                                                          np.roll(phase, shift, axis=1) if method == 'mvl' else phase,
+                                                          bins, method)
+    return surrogates
+
+SURROGATE_DATA = {}
+
+def share_array(x):
+    '''Copy x into a new shared memory block. Returns the block and (name, shape, dtype) to attach to it.'''
+    shm = shared_memory.SharedMemory(create=True, size=max(1, x.nbytes))
+    np.ndarray(x.shape, x.dtype, buffer=shm.buf)[...] = x
+    return shm, (shm.name, x.shape, x.dtype.str)
+
+def init_surrogate_worker(shared_arrays, bins, method):
+    '''Pool initializer: attach once per worker to the shared phase_bin_index, amplitude and phase.'''
+    SURROGATE_DATA.clear()
+    SURROGATE_DATA.update(bins=bins, method=method, blocks=[])
+    for key, (name, shape, dtype) in shared_arrays.items():
+        shm = shared_memory.SharedMemory(name=name)
+        SURROGATE_DATA['blocks'].append(shm)
+        SURROGATE_DATA[key] = np.ndarray(shape, dtype, buffer=shm.buf)
+
+def shared_surrogate_comodulograms(shifts):
+    '''surrogate_comodulograms on the arrays attached by init_surrogate_worker, only the shifts are sent per task.'''
+    return surrogate_comodulograms(SURROGATE_DATA['phase_bin_index'], SURROGATE_DATA['amplitude'],
+                                   SURROGATE_DATA['phase'], shifts, SURROGATE_DATA['bins'], SURROGATE_DATA['method'])
+
+def get_pac_bands(phase_freqs, amp_freqs, phase_width=2, amp_width=None):
+    '''Phase and amplitude bands; amp_width defaults to twice the highest phase frequency,
+    so the amplitude bands contain the sidebands.'''
+    if amp_width is None:
+        amp_width = 2 * np.max(phase_freqs)
+    return make_bands(phase_freqs, phase_width), make_bands(amp_freqs, amp_width)
+
+def get_phase_bin_index(x, fs, phase_bands, bins=18):
+    '''Phase (phase bands x samples, radians) of x and its bin index in bins equal phase bins.'''
+    phase = np.angle(filter_bank_hilbert(x, fs, phase_bands)).astype(np.float32)
+    bin_edges, _ = Phase.get_phase_bin_edges(bins)
+    phase_bin_index = np.clip(np.digitize(phase, bin_edges) - 1, 0, bins - 1).astype(np.uint8)
+    return phase_bin_index, phase
+
+def get_amplitude(x, fs, amp_bands):
+    '''Amplitude envelope (amplitude bands x samples) of x.'''
+    return np.abs(filter_bank_hilbert(x, fs, amp_bands)).astype(np.float32)
+
+def get_surrogate_shifts(n, fs, n_surrogates, min_shift=1.0, seed=None):
+    '''Random circular shifts (samples) of at least min_shift seconds from both ends of an n sample signal.'''
+    min_shift_len = int(min_shift * fs)
+    if n - 2 * min_shift_len < 1:
+        raise ValueError(f'Signal of {n / fs:.2f} s is too short for surrogate shifts of at least {min_shift} s, '
+                         f'use a longer signal or a smaller min_shift (< {n / fs / 2:.2f} s)')
+    rng = np.random.default_rng(seed)
+    return rng.integers(min_shift_len, n - min_shift_len, size=n_surrogates)
+
+def comodulogram_with_surrogates(phase_bin_index, amplitude, phase, fs, bins=18, method='tort',
+                                 n_surrogates=0, n_workers=1, min_shift=1.0, seed=None):
+    '''Comodulogram of precomputed phase bins and amplitude envelopes at rate fs.
+    Returns pac and, if n_surrogates>0, the surrogate z-score and p-value; otherwise None, None.
+    n_workers>1 computes the surrogates in a process pool sharing the arrays (needs the __main__ guard in scripts).'''
+    pac = comodulogram_from_phase_amplitude(phase_bin_index, amplitude, phase, bins, method)
+    if n_surrogates == 0:
+        return pac, None, None
+    shifts = get_surrogate_shifts(phase.shape[1], fs, n_surrogates, min_shift, seed)
+    if n_workers is None or n_workers <= 1:
+        surrogates = [surrogate_comodulograms(phase_bin_index, amplitude, phase, shifts, bins, method)]
+    else:
+        'Phase is only read for MVL, Tort surrogates share the bin index and envelopes only'
+        arrays = {'phase_bin_index': phase_bin_index, 'amplitude': amplitude,
+                  'phase': phase if method == 'mvl' else phase[:, :0]}
+        blocks, shared_arrays = {}, {}
+        try:
+            for key, x in arrays.items():
+                blocks[key], shared_arrays[key] = share_array(np.ascontiguousarray(x))
+            shift_chunks = [chunk for chunk in np.array_split(shifts, n_workers) if len(chunk)]
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=init_surrogate_worker,
+                                     initargs=(shared_arrays, bins, method)) as executor:
+                surrogates = list(executor.map(shared_surrogate_comodulograms, shift_chunks))
+        finally:
+            for shm in blocks.values():
+                shm.close()
+                shm.unlink()
+    surrogates = np.concatenate(surrogates)
+    pac_zscore = (pac - surrogates.mean(axis=0)) / surrogates.std(axis=0)
+    pac_pvalue = (np.sum(surrogates >= pac, axis=0) + 1) / (n_surrogates + 1)
+    return pac, pac_zscore, pac_pvalue
+
+def calculate_comodulograms(signals, pairs, Fs=10000, phase_freqs=np.arange(2, 21, 1),
+                            amp_freqs=np.arange(30, 151, 5), phase_width=2, amp_width=None, bins=18,
+                            method='tort', n_surrogates=0, n_workers=1, min_shift=1.0, seed=None):
+    '''PAC comodulograms for (phase name, amplitude name) pairs of the named signals in the signals dict.
+    Each signal is decimated once, and its phase bands and amplitude bands are filtered once,
+    then reused by every pair it appears in (e.g. LFP->LFP, LFP->zscore and zscore->LFP).
+    Returns {pair: (phase_freqs, amp_freqs, pac, pac_zscore, pac_pvalue)}, see calculate_comodulogram.'''
+    phase_bands, amp_bands = get_pac_bands(phase_freqs, amp_freqs, phase_width, amp_width)
+    q = get_working_rate(Fs, amp_bands)
+    fs = Fs / q
+    decimated = {}
+    for name in dict.fromkeys(name for pair in pairs for name in pair):
+        x = np.asarray(signals[name], dtype=float)
+        decimated[name] = signal.resample_poly(x, 1, q) if q > 1 else x
+    phase_features = {name: get_phase_bin_index(decimated[name], fs, phase_bands, bins)
+                      for name in dict.fromkeys(phase_name for phase_name, _ in pairs)}
+    amplitudes = {name: get_amplitude(decimated[name], fs, amp_bands)
+                  for name in dict.fromkeys(amplitude_name for _, amplitude_name in pairs)}
+    results = {}
+    for phase_name, amplitude_name in pairs:
+        phase_bin_index, phase = phase_features[phase_name]
+        pac, pac_zscore, pac_pvalue = comodulogram_with_surrogates(phase_bin_index, amplitudes[amplitude_name], phase, fs,
+                                                                   bins, method, n_surrogates, n_workers, min_shift, seed)
+        results[(phase_name, amplitude_name)] = (phase_freqs, amp_freqs, pac, pac_zscore, pac_pvalue)
+    return results
+
+def calculate_comodulogram(phase_signal, amplitude_signal, Fs=10000, phase_freqs=np.arange(2, 21, 1),
+                           amp_freqs=np.arange(30, 151, 5), phase_width=2, amp_width=None, bins=18,
+                           method='tort', n_surrogates=0, n_workers=1, min_shift=1.0, seed=None):
+    '''PAC comodulogram of phase_signal phase (e.g. LFP) vs amplitude_signal envelope (e.g. LFP or zscore).
+    amp_width defaults to twice the highest phase frequency, so the amplitude bands contain the sidebands.
+    Returns phase_freqs, amp_freqs, pac (phase x amplitude) and, if n_surrogates>0,
+    the surrogate z-score and p-value (fraction of surrogates >= pac); otherwise None, None.
+    Surrogates shift the phase by a random lag of at least min_shift seconds, see comodulogram_with_surrogates for n_workers.'''
+    pair = ('phase', 'amplitude')
+    return calculate_comodulograms({'phase': phase_signal, 'amplitude': amplitude_signal}, [pair], Fs,
+                                   phase_freqs, amp_freqs, phase_width, amp_width, bins, method,
+                                   n_surrogates, n_workers, min_shift, seed)[pair]
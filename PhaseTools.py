@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Phase-binning of amplitude signals (zscore, gamma envelope...) on the theta phase.
+
+Samples are assigned to phase bins once with np.digitize and all signals are summed per bin
+with one np.bincount, instead of building a boolean mask per bin.
+Bin sums are additive, so a whole-session profile can be built from chunks with
+accumulate_phase_bins, without keeping the filtered copies of the full recording.
+"""
+import warnings
+import numpy as np
+from scipy import signal
+
+def get_phase_bin_edges(bins=30):
+    bin_edges = np.linspace(-np.pi, np.pi, bins + 1)
+    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+    return bin_edges, bin_centers
+
+def phase_bin_sums(phase, amplitudes, bins=30):
+    '''Per-bin count, sum and sum of squares of every amplitude signal, plus the sums for the mean vector.
+    phase: (n,) radians in [-pi, pi). amplitudes: (n,) or (signals x n).
+    Bins are [edge_i, edge_i+1) like the original loops. Returns a dict of sums that can be added across chunks.'''
+    phase = np.asarray(phase, dtype=float)
+    amplitudes = np.atleast_2d(np.asarray(amplitudes, dtype=float))
+    n_signals = amplitudes.shape[0]
+    bin_edges, _ = get_phase_bin_edges(bins)
+    bin_index = np.digitize(phase, bin_edges) - 1
+    valid = (bin_index >= 0) & (bin_index < bins)
+    bin_index = bin_index[valid]
+    amplitudes = amplitudes[:, valid]
+    phase = phase[valid]
+    'One bincount for all signals, the bins of signal i are offset by i*bins'
+    flat_index = (bin_index[np.newaxis, :] + bins * np.arange(n_signals)[:, np.newaxis]).ravel()
+    size = bins * n_signals
+    sums = {
+        'count': np.bincount(bin_index, minlength=bins),
+        'sum': np.bincount(flat_index, weights=amplitudes.ravel(), minlength=size).reshape(n_signals, bins),
+        'sumsq': np.bincount(flat_index, weights=(amplitudes ** 2).ravel(), minlength=size).reshape(n_signals, bins),
+        'vector': amplitudes @ np.exp(1j * phase),
+        'total': amplitudes.sum(axis=1),
+        'phase_vector': np.exp(1j * phase).sum(),
+        'min': amplitudes.min(axis=1) if amplitudes.shape[1] else np.full(n_signals, np.inf),
+        }
+    return sums
+
+def merge_phase_bin_sums(sums_a, sums_b):
+    if sums_a is None:
+        return sums_b
+    return {key: np.minimum(sums_a[key], sums_b[key]) if key == 'min' else sums_a[key] + sums_b[key] for key in sums_a}
+
+def shift_phase_bin_sums(sums, offset):
+    '''Bin sums of (amplitude - offset), offset is one value per signal.'''
+    offset = np.asarray(offset, dtype=float)
+    shifted = dict(sums)
+    shifted['sum'] = sums['sum'] - offset[:, np.newaxis] * sums['count']
+    shifted['sumsq'] = sums['sumsq'] - 2 * offset[:, np.newaxis] * sums['sum'] + offset[:, np.newaxis] ** 2 * sums['count']
+    shifted['vector'] = sums['vector'] - offset * sums['phase_vector']
+    shifted['total'] = sums['total'] - offset * sums['count'].sum()
+    shifted['min'] = sums['min'] - offset
+    return shifted
+
+def accumulate_phase_bins(chunks, bins=30):
+    '''Add up phase_bin_sums over an iterable of (phase, amplitudes) chunks.'''
+    total = None
+    for phase, amplitudes in chunks:
+        total = merge_phase_bin_sums(total, phase_bin_sums(phase, amplitudes, bins))
+    return total
+
+def phase_bin_statistics(sums):
+    '''Mean, std (signals x bins) and count (bins) from accumulated bin sums.'''
+    count = sums['count']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = sums['sum'] / count
+        std = np.sqrt(np.maximum(sums['sumsq'] / count - mean ** 2, 0))
+    return mean, std, count
+
+def phase_modulation_statistics(sums, offset=0):
+    '''Circular statistics per signal:
+    modulation_index: Tort et al. 2010 KL-based MI of the binned mean amplitude,
+    preferred_phase: phase (radians) of the amplitude-weighted mean vector,
+    vector_length: normalised mean vector length, sum(a*exp(i*phase))/sum(a),
+    rayleigh_z, rayleigh_p: Rayleigh test on the amplitude-weighted phases (samples are not independent,
+    so p is only a guide for long recordings).
+    These need a non-negative amplitude: an envelope, or a raw trace such as photon counts.
+    A signed trace (e.g. a zscore) needs an explicit offset (scalar or one per signal), subtracted from
+    the amplitude first (offset=-3 uses zscore+3); a negative amplitude left raises ValueError.
+    Signals with no positive amplitude (e.g. all zero) give NaN with a warning.'''
+    offset = np.broadcast_to(np.asarray(offset, dtype=float), sums['min'].shape)
+    if np.any(offset != 0):
+        sums = shift_phase_bin_sums(sums, offset)
+    if np.any(sums['min'] < 0):
+        raise ValueError('Phase modulation statistics need a non-negative amplitude (an envelope or a raw trace), '
+                         'pass an explicit offset for a signed signal such as a zscore')
+    mean, _, count = phase_bin_statistics(sums)
+    n_bins = mean.shape[-1]
+    valid = sums['total'] > 0
+    if not np.all(valid):
+        warnings.warn('Total amplitude <= 0, phase modulation statistics set to NaN for these signals')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        P = mean / np.nansum(mean, axis=-1, keepdims=True)
+        entropy_term = np.nansum(np.where(P > 0, P * np.log(P), 0), axis=-1)
+        vector_length = np.abs(sums['vector']) / sums['total']
+    modulation_index = (np.log(n_bins) + entropy_term) / np.log(n_bins)
+    preferred_phase = np.angle(sums['vector'])
+    n = count.sum()
+    rayleigh_z = n * vector_length ** 2
+    rayleigh_p = np.minimum(np.exp(np.sqrt(1 + 4 * n + 4 * (n ** 2 - (n * vector_length) ** 2)) - (1 + 2 * n)), 1)
+    statistics = {'modulation_index': modulation_index, 'preferred_phase': preferred_phase,
+                  'vector_length': vector_length, 'rayleigh_z': rayleigh_z, 'rayleigh_p': rayleigh_p}
+    return {key: np.where(valid, value, np.nan) for key, value in statistics.items()}
+
+def iter_phase_amplitude_chunks(phase_data, amplitude_data, fs, phase_band, amplitude_band,
+                                filter_func, chunk_len=60, pad_len=2):
+    '''Yield (theta phase, amplitude envelopes) for chunks of chunk_len seconds.
+    Each chunk is filtered with pad_len seconds of neighbouring data on both sides, which is cut off
+    after the Hilbert transform, so only one chunk of filtered data exists at a time.
+    filter_func(data, low, high, fs) is the band-pass filter, e.g. OE.band_pass_filter.
+    amplitude_band=None uses the amplitude signals as they are (e.g. a smoothed zscore).'''
+    phase_data = np.asarray(phase_data, dtype=float)
+    amplitude_data = np.atleast_2d(np.asarray(amplitude_data, dtype=float))
+    n = len(phase_data)
+    chunk = int(chunk_len * fs)
+    pad = int(pad_len * fs)
+    for start in range(0, n, chunk):
+        stop = min(start + chunk, n)
+        lo = max(0, start - pad)
+        hi = min(n, stop + pad)
+        keep = slice(start - lo, stop - lo)
+        phase_filtered = filter_func(phase_data[lo:hi], phase_band[0], phase_band[1], fs)
+        phase = np.angle(signal.hilbert(phase_filtered))[keep]
+        if amplitude_band is None:
+            amplitudes = amplitude_data[:, start:stop]
+        else:
+            amplitude_filtered = filter_func(amplitude_data[:, lo:hi].T, amplitude_band[0], amplitude_band[1], fs).T
+            amplitudes = np.abs(signal.hilbert(amplitude_filtered, axis=-1))[:, keep]
+        yield phase, amplitudes
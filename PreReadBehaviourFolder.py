@@ -7,6 +7,7 @@ Created on Sat Mar  2 14:25:05 2024
 import numpy as np
 import matplotlib.pyplot as plt
 import OpenEphysTools as OE
+import TrackingTools as Tracking
 import pandas as pd
 import os
 
@@ -25,19 +26,9 @@ def label_multiple_behaviour_files_in_folder(BehaviourData_folder_path,save_pare
         file_path = os.path.join(BehaviourData_folder_path, file)
         print(f"'{file}' labelled as--:'{LabelData['TrialNum'][i]}''{LabelData['sleepState'][i]}'--'{LabelData['movingState'][i]}'--'{LabelData['TrainingState'][i]}'")
         trackingdata = pd.read_csv(file_path, names=['X', 'Y'])
-        trackingdata=trackingdata.fillna(method='ffill')
-        trackingdata=trackingdata/20
-        if LabelData['sleepState'][i]=='sleep':
-            trackingdata['speed']=0
-        elif LabelData['sleepState'][i]=='awake' and LabelData['movingState'][i]=='notmoving':
-            trackingdata['speed']=0
-        else:
-            trackingdata['speed']=((trackingdata['X'].diff()**2 + trackingdata['Y'].diff()**2)**0.5)*tracking_fs # cm per second
-            trackingdata['speed'][trackingdata['speed'] > 20] = np.nan #If the speed is too fast, maybe the tracking position is wrong, delete it.
-            trackingdata['speed'] = trackingdata['speed'].fillna(method='bfill')
-            window_size=5
-            trackingdata['speed'] = trackingdata['speed'].rolling(window=window_size, min_periods=1).median()
-            trackingdata['speed'] = trackingdata['speed'].rolling(window=window_size, min_periods=1).min()
+        still = LabelData['sleepState'][i]=='sleep' or (LabelData['sleepState'][i]=='awake' and LabelData['movingState'][i]=='notmoving')
+        trackingdata = Tracking.process_tracking_data(trackingdata, tracking_fs=tracking_fs, still=still)
+        movement_ranges = Tracking.get_movement_ranges(trackingdata['speed'], tracking_fs=tracking_fs)
         # trackingdata['sleepState']=LabelData['sleepState'][i]
         # trackingdata['movingState']=LabelData['movingState'][i]
         # trackingdata['TrainingState']=LabelData['TrainingState'][i]
@@ -50,6 +41,9 @@ def label_multiple_behaviour_files_in_folder(BehaviourData_folder_path,save_pare
             os.makedirs(save_folder_path)
         filepath=os.path.join(save_folder_path, f'AnimalTracking_{i+1}.pkl')
         trackingdata.to_pickle(filepath)
+        'Movement intervals in seconds (tracking time), so they can be mapped to any sampling rate'
+        movement_intervals = pd.DataFrame(movement_ranges / tracking_fs, columns=['start', 'end'])
+        movement_intervals.to_csv(os.path.join(save_folder_path, f'MovementIntervals_{i+1}.csv'), index=False)
         i=i+1
     return -1
 
@@ -64,11 +58,8 @@ def plot_multiple_behaviour_files_in_folder(BehaviourData_folder_path,tracking_f
         file_path = os.path.join(BehaviourData_folder_path, file)
         print(f"Processing file '{file}' and plot tracking")
         trackingdata = pd.read_csv(file_path, names=['X', 'Y'])
-        trackingdata=trackingdata.fillna(method='ffill')
-        trackingdata=trackingdata/20    
-        trackingdata['speed']=((trackingdata['X'].diff()**2 + trackingdata['Y'].diff()**2)**0.5)*tracking_fs # cm per second
-        trackingdata['speed'][trackingdata['speed'] > 20] = np.nan #If the speed is too fast, maybe the tracking position is wrong, delete it.
-        trackingdata['speed'] = trackingdata['speed'].fillna(method='bfill')
+        X, Y, speed = Tracking.calculate_speed(trackingdata['X'], trackingdata['Y'], tracking_fs=tracking_fs, smooth=False)
+        trackingdata = pd.DataFrame({'X': X, 'Y': Y, 'speed': speed})
         OE.plot_animal_tracking (trackingdata)
         #plt.plot(trackingdata['speed']) 
     return -1
@@ -11,7 +11,6 @@ from PIL import Image
 import matplotlib.pyplot as plt
 from SPADPhotometryAnalysis import SPADAnalysisTools as Analysis
 from SPADPhotometryAnalysis import photometry_functions as fp
-from scipy.ndimage import uniform_filter1d
 import matplotlib.patches as patches
 
 def loadPCFrame (readData):
@@ -274,30 +273,8 @@ def plot_trace(trace,ax, fs=1017, label="trace",unit='Photon Count'):
     return ax
 
 def replace_outliers_with_nearest_avg(data, window_size=25000, z_thresh=3):
-    # Calculate the mean and standard deviation of the moving window
-    mean = uniform_filter1d(data, window_size, mode='reflect')
-    std = uniform_filter1d(data**2, window_size, mode='reflect')
-    std = np.sqrt(std - mean**2)
-
-    # Identify the outliers
-    outliers = (np.abs(data - mean) > z_thresh * std)
-
-    # Replace outliers with the average of their nearest non-outlier neighbors
-    for i in np.where(outliers)[0]:
-        j = i - 1
-        while j >= 0 and outliers[j]:
-            j -= 1
-        k = i + 1
-        while k < len(data) and outliers[k]:
-            k += 1
-        if j >= 0 and k < len(data):
-            data[i] = (data[j] + data[k]) / 2
-        elif j >= 0:
-            data[i] = data[j]
-        elif k < len(data):
-            data[i] = data[k]
-
-    return data
+    'Rolling-window outlier cleaner, see SPADAnalysisTools.replace_outliers_with_nearest_avg'
+    return Analysis.replace_outliers_with_nearest_avg(data, window_size=window_size, z_thresh=z_thresh)
 def get_snr_image(data):
     mean_image = data[:, :,:].mean(axis=2)
     std_image = data[:, :,:].std(axis=2)
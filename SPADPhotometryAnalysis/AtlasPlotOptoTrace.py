@@ -30,60 +30,14 @@ def plot_trace(trace,ax, fs=9938.4, label="trace",color='tab:blue'):
     ax.set_ylabel('df/f')
     return ax
 
-from scipy.ndimage import uniform_filter1d
 
 def replace_outliers_with_nearest_avg(data, window_size=25000, z_thresh=3):
-    # Calculate the mean and standard deviation of the moving window
-    mean = uniform_filter1d(data, window_size, mode='reflect')
-    std = uniform_filter1d(data**2, window_size, mode='reflect')
-    std = np.sqrt(std - mean**2)
-
-    # Identify the outliers
-    outliers = (np.abs(data - mean) > z_thresh * std)
-
-    # Replace outliers with the average of their nearest non-outlier neighbors
-    for i in np.where(outliers)[0]:
-        j = i - 1
-        while j >= 0 and outliers[j]:
-            j -= 1
-        k = i + 1
-        while k < len(data) and outliers[k]:
-            k += 1
-        if j >= 0 and k < len(data):
-            data[i] = (data[j] + data[k]) / 2
-        elif j >= 0:
-            data[i] = data[j]
-        elif k < len(data):
-            data[i] = data[k]
-
-    return data
+    'Rolling-window outlier cleaner, see SPADAnalysisTools.replace_outliers_with_nearest_avg'
+    return Analysis.replace_outliers_with_nearest_avg(data, window_size=window_size, z_thresh=z_thresh)
 
 def replace_outliers_with_avg(data, threshold):
-    # Identify the outliers
-    outliers = np.abs(data) > threshold
-
-    # Get the indices of the outliers
-    outlier_indices = np.where(outliers)[0]
-
-    # Iterate over the outlier indices
-    for index in outlier_indices:
-        # Find the nearest non-outlier value
-        left = index
-        while left > 0 and outliers[left - 1]:
-            left -= 1
-
-        right = index
-        while right < len(data) - 1 and outliers[right + 1]:
-            right += 1
-
-        # If the outlier is not at the boundaries of the array, replace it with the average of its neighbors
-        if left != 0 and right != len(data) - 1:
-            data[index] = (data[left - 1] + data[right + 1]) / 2
-        # If the outlier is at the boundaries of the array, replace it with the nearest non-outlier value
-        else:
-            data[index] = data[left - 1] if left != 0 else data[right + 1]
-
-    return data
+    'Samples with |data|>threshold are replaced by the average of their nearest non-outlier neighbours, all at once'
+    return Analysis.replace_outliers_with_neighbours(data, np.abs(data) > threshold)
 
 def notchfilter (data,f0=100,bw=10,fs=840):
     # Bandwidth of the notch filter (in Hz)   
@@ -92,96 +46,21 @@ def notchfilter (data,f0=100,bw=10,fs=840):
     for _ in range(4):
         data = signal.filtfilt(b, a, data)
     return data
-# Function to find the average of nearby valid values
-def get_nearby_average(arr, idx, threshold):
-    # Initialize left and right pointers
-    left = idx - 1
-    right = idx + 1
-    valid_neighbors = []
-    # Move the left pointer until we find a valid neighbor or reach the start
-    while left >= 0:
-        if arr[left] <= threshold:
-            valid_neighbors.append(arr[left])
-            break
-        left -= 1
-    # Move the right pointer until we find a valid neighbor or reach the end
-    while right < len(arr):
-        if arr[right] <= threshold:
-            valid_neighbors.append(arr[right])
-            break
-        right += 1
-    # Calculate the average of the valid neighbors
-    if valid_neighbors:
-        return np.mean(valid_neighbors)
-    else:
-        return arr[idx]  # If no valid neighbors, return the original value
-
 def get_nearby_value(data, idx, threshold):
-    # Find nearby values that are above the threshold
-    left = idx - 1
-    right = idx + 1
-    while left >= 0 or right < len(data):
-        # Check left neighbor
-        if left >= 0 and data[left] > threshold:
-            return data[left]
-        # Check right neighbor
-        if right < len(data) and data[right] > threshold:
-            return data[right]
-        left -= 1
-        right += 1
-    # If no valid neighbor found, return the original value (or some other fallback value)
-    return data[idx]
+    'Nearest value above threshold (left first), for one index or an array of indices'
+    return Analysis.get_nearest_valid_values(data, np.asarray(data) > threshold)[idx]
 
 def get_clean_data(data, outlier_thres,opto_thre):
-    above_opto_threshold_mask = data > opto_thre
-    opto_indices = np.where(above_opto_threshold_mask)[0]
-    filtered_indices = []
-    for i in range(len(opto_indices)):
-        if i == 0 or opto_indices[i] > opto_indices[i-1] + 1:
-            filtered_indices.append(opto_indices[i])
-    
-    data_cleaned = data.copy()
-    above_threshold_mask = data > outlier_thres
-    outlier_indices = np.where(above_threshold_mask)[0]
-    # Replace outliers with the average of nearby valid values
-    for idx in outlier_indices:
-        data_cleaned[idx] = get_nearby_average(data, idx, outlier_thres)
+    'Onsets of all runs above opto_thre, samples above outlier_thres replaced by the average of their valid neighbours'
+    filtered_indices,_ = Analysis.get_opto_pulses(data, opto_thre)
+    data_cleaned = Analysis.replace_outliers_with_neighbours(data, np.asarray(data) > outlier_thres)
     return filtered_indices, data_cleaned
 
 def get_clean_data_below(data, outlier_length, opto_thre):
-
-    # Find indices where data > threshold
-    indices_above_threshold = np.where(data > opto_thre)[0]
-    
-    # Group consecutive indices
-    pulse_indices = []
-    current_group = []
-    for i in indices_above_threshold:
-        if current_group and i != current_group[-1] + 1:
-            if len(current_group) >= outlier_length:
-                pulse_indices.append(current_group)
-            current_group = []
-        current_group.append(i)
-    if len(current_group) >= outlier_length:
-        pulse_indices.append(current_group)
-    
-    # Flatten the list of indices
-    flattened_pulse_indices = [i for group in pulse_indices for i in group]
-    filtered_indices = []
-    for i in range(len(flattened_pulse_indices)):
-        if i == 0 or flattened_pulse_indices[i] > flattened_pulse_indices[i - 1] + 1:  # Ensure indices are not consecutive
-            filtered_indices.append(flattened_pulse_indices[i])
-    # Create a copy of the data and replace pulse values
-    cleaned_data = data.copy()
-    cleaned_data[flattened_pulse_indices] = np.nan  # Replace with NaN
-    
-    # Optionally interpolate the NaN values
-    cleaned_data = np.interp(
-        np.arange(len(cleaned_data)),
-        np.arange(len(cleaned_data))[~np.isnan(cleaned_data)],
-        cleaned_data[~np.isnan(cleaned_data)],
-    )
-    return filtered_indices,cleaned_data
+    'Onsets of runs above opto_thre lasting at least outlier_length samples, the runs are interpolated over'
+    starts,stops = Analysis.get_opto_pulses(data, opto_thre, min_length=outlier_length)
+    cleaned_data = Analysis.blank_opto_artefacts(data, starts, stops)
+    return starts,cleaned_data
 
 # def get_clean_data_below(data, outlier_thres, opto_thre):
 #     # Identify values below the opto threshold
@@ -203,28 +82,20 @@ def get_clean_data_below(data, outlier_length, opto_thre):
 #         data_cleaned[idx] = get_nearby_value(data, idx, outlier_thres)
 #     return filtered_indices, data_cleaned
 
-def get_average_opto_response_by_sync (data,outlier_thres,opto_thre,half_window,sampling_rate):
-    opto_indices,data_cleaned=get_clean_data_below (data,outlier_thres,opto_thre)
-    #opto_indices,data_cleaned=get_clean_data (data,outlier_thres,opto_thre)
-    half_win_size = int(half_window * sampling_rate)  # convert to samples
-
-    windows = []
-    for index in opto_indices:
-        start_index = index-84
-        end_index = int(index+sampling_rate*half_window)
-        if end_index <= len(data_cleaned) and start_index>=0:
-            window_data = data_cleaned[start_index:end_index]
-            windows.append(window_data)
-    if windows:
-        windows_array = np.array(windows)
-        average_signals = np.mean(windows_array, axis=0)
-        std_signals = np.std(windows_array, axis=0)
+def get_average_opto_response_by_sync (data,outlier_thres,opto_thre,half_window,sampling_rate,pre_window=0.1):
+    'Plot the response from Analysis.get_opto_response, windows start pre_window seconds before each stimulus'
+    response=Analysis.get_opto_response(data,opto_thre,sampling_rate,min_length=outlier_thres,
+                                        pre_window=pre_window,post_window=half_window)
+    windows=response['windows']
+    if len(windows)>0:
+        average_signals = response['mean']
+        std_signals = response['std']
         # Plot the average signals and standard deviation as shaded area
-        time_axis = np.arange(84+half_win_size) / sampling_rate  # Convert to time in seconds
+        time_axis = response['time']+pre_window  # Convert to time in seconds
         plt.figure(figsize=(10, 6))
         plt.plot(time_axis, average_signals, label='Average Signal')
         plt.fill_between(time_axis, average_signals - std_signals, average_signals + std_signals, color='b', alpha=0.2, label='Standard Deviation')
-        plt.axvline(x=0.1, color='red', linestyle='--', label='Event Time')
+        plt.axvline(x=pre_window, color='red', linestyle='--', label='Event Time')
         plt.xlabel('Time (s)')
         plt.ylabel('Signal')
         plt.title('Average Signal with Standard Deviation')
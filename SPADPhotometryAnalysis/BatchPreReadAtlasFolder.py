@@ -6,6 +6,7 @@ Created on Tue Apr 23 21:53:34 2024
 """
 
 from SPADPhotometryAnalysis import AtlasDecode
+from SPADPhotometryAnalysis import SPADAnalysisTools as Analysis
 import os
 import numpy as np
 import matplotlib.pyplot as plt
@@ -13,31 +14,8 @@ import re
 from datetime import datetime
 
 def replace_outliers_with_avg(data, threshold):
-    # Identify the outliers
-    outliers = np.abs(data) > threshold
-
-    # Get the indices of the outliers
-    outlier_indices = np.where(outliers)[0]
-
-    # Iterate over the outlier indices
-    for index in outlier_indices:
-        # Find the nearest non-outlier value
-        left = index
-        while left > 0 and outliers[left - 1]:
-            left -= 1
-
-        right = index
-        while right < len(data) - 1 and outliers[right + 1]:
-            right += 1
-
-        # If the outlier is not at the boundaries of the array, replace it with the average of its neighbors
-        if left != 0 and right != len(data) - 1:
-            data[index] = (data[left - 1] + data[right + 1]) / 2
-        # If the outlier is at the boundaries of the array, replace it with the nearest non-outlier value
-        else:
-            data[index] = data[left - 1] if left != 0 else data[right + 1]
-
-    return data
+    'Samples with |data|>threshold are replaced by the average of their nearest non-outlier neighbours, all at once'
+    return Analysis.replace_outliers_with_neighbours(data, np.abs(data) > threshold)
 
 def plot_trace(trace,ax, fs=9938.4, label="trace",color='tab:blue'):
     t=(len(trace)) / fs
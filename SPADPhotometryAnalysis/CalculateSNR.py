@@ -67,6 +67,15 @@ def calculate_SNR (data):
     print ('SNR is', snr)
     return snr
 
+def calculate_band_SNR (traces,fs=9938.4,signal_band=(2,15),noise_band=(150,250),method="welch"):
+    '''Spectral SNR: signal band power / noise band power of every trace, with the band power table.
+    Uses the cached spectra of Analysis.compute_psd, so the PSD plots of the same traces are not recomputed
+    (Analysis.clear_psd_cache() frees them once a batch is done).'''
+    band_power=Analysis.get_band_power(traces,fs,bands={'signal':signal_band,'noise':noise_band},method=method)
+    band_power['SNR']=band_power['signal']/band_power['noise']
+    print (band_power)
+    return band_power
+
 def calculate_SNR_for_folder_csv (parent_folder):
     # Iterate over all folders in the parent folder
     SNR_savename='SNR_results.csv'        
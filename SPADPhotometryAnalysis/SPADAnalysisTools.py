@@ -5,14 +5,19 @@ Created on Fri Dec 17 11:12:47 2021
 @author: Yifang
 """
 import os
+import hashlib
+import itertools
+from collections import OrderedDict
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 from sklearn.decomposition import FastICA
 from scipy import signal
+from scipy import stats
 from SPADPhotometryAnalysis import SPADdemod
 from SPADPhotometryAnalysis import photometry_functions as fp
-from scipy.fft import fft
+from scipy.fft import fft, rfft, rfftfreq
+from scipy.integrate import trapezoid
 
 '''Set basic parameter'''
 def Set_filename (dpath, csv_filename="traceValue.csv"):
@@ -57,38 +62,37 @@ def getTimeDivisionTrace (dpath, trace, sig_highlim,sig_lowlim, ref_highlim,ref_
     This method is suitable when the time-division two signals are with very different amplitude,
     I use two different thresholds to detect peak values for two channels
     '''
-    lmin,lmax=SPADdemod.Find_targetPeaks(trace, dmin=1, dmax=1,high_limit=sig_highlim, low_limit=sig_lowlim)
+    'One local-maximum scan, split into the two channels by amplitude'
+    peak_index=SPADdemod.get_local_maxima(trace)
+    green_peaks,red_peaks=SPADdemod.split_peaks_by_amplitude(trace,peak_index,[(sig_lowlim,sig_highlim),(ref_lowlim,ref_highlim)])
     fig, ax = plt.subplots(figsize=(12, 3))
-    ax.plot(lmax,trace[lmax], color='g')
-    x_green, Green=SPADdemod.Interpolate_timeDiv (lmax,trace)
+    ax.plot(green_peaks,trace[green_peaks], color='g')
+    fig, ax = plt.subplots(figsize=(12, 3))
+    ax.plot(red_peaks,trace[red_peaks], color='r')
+    x, (Green,Red)=SPADdemod.DemodTimeDivision(trace,[green_peaks,red_peaks])
     fname = os.path.join(dpath, "Green_traceAll.csv")
     np.savetxt(fname, Green, delimiter=",")
-    
-    lmin,lmax=SPADdemod.Find_targetPeaks(trace, dmin=1, dmax=1,high_limit=ref_highlim, low_limit=ref_lowlim)
-    fig, ax = plt.subplots(figsize=(12, 3))
-    ax.plot(lmax,trace[lmax], color='r')
-    x_red, Red=SPADdemod.Interpolate_timeDiv (lmax,trace)
     fname = os.path.join(dpath, "Red_traceAll.csv")
     np.savetxt(fname, Red, delimiter=",")
     return Green,Red
 
-def getTimeDivisionTrace_fromMask (dpath, Trace_raw, high_thd,low_thd):
+def getTimeDivisionTrace_fromMask (dpath, Trace_raw, high_thd,low_thd,signal_min_width=5,reference_max_width=4):
     '''
    This method can be used when the two channels are with similar amplitudes.
    Usually, I use 500Hz square wave for time division
    Signal channel is modulated by a 30% duty cycle(5-6 samples)sqaure wave, 
    while reference channel is modulated by a 20% duty cycle wave(2-4 samples).
    high_thd and low_thd are for detecting all square wave peaks.
-   Then I can use the width of the square wave to sparate the two channels
+   Then I can use the width of the square wave to sparate the two channels,
+   pulses of at least signal_min_width samples are signal, at most reference_max_width samples are reference.
     '''
     mask=SPADdemod.findMask(Trace_raw,high_thd=high_thd,low_thd=low_thd)
-    mask_green=SPADdemod.preserve_more_than_five_ones(mask)
-    mask_red=SPADdemod.preserve_fewer_than_four_ones(mask)
-    Green_peakIdx,Green_raw= SPADdemod.findTraceFromMask(Trace_raw,mask_green)
-    Red_peakIdx,Red_raw= SPADdemod.findTraceFromMask(Trace_raw,mask_red)
-    
-    x_green, Green=SPADdemod.Interpolate_timeDiv (Green_peakIdx,Green_raw)
-    x_red, Red=SPADdemod.Interpolate_timeDiv (Red_peakIdx,Red_raw)
+    'Peak of every pulse in one pass, then split into the two channels by pulse width'
+    peak_index,widths=SPADdemod.get_pulse_peak_index(Trace_raw,mask)
+    Green_peakIdx=peak_index[widths>=signal_min_width]
+    Red_peakIdx=peak_index[widths<=reference_max_width]
+    x, (Green,Red)=SPADdemod.DemodTimeDivision(Trace_raw,[Green_peakIdx,Red_peakIdx])
+    x_green=x_red=x
     
     fname = os.path.join(dpath, "Green_traceAll.csv")
     np.savetxt(fname, Green, delimiter=",")
@@ -117,19 +121,14 @@ def ReadTwoROItrace (dpath,plot_xrange=500):
     return Green_raw,Red_raw
 
 def DemodTwoTraces (dpath,Green_raw, Red_raw,high_g,low_g,high_r,low_r):
-    lmin,lmax=SPADdemod.Find_targetPeaks(Green_raw, dmin=1, dmax=1,high_limit=high_g, low_limit=low_g)
+    'Pulse peaks of each ROI trace, then both channels on the same sample grid'
+    green_peaks,=SPADdemod.split_peaks_by_amplitude(Green_raw,SPADdemod.get_local_maxima(Green_raw),[(low_g,high_g)])
     fig, ax = plt.subplots(figsize=(12, 3))
-    ax.plot(lmax,Green_raw[lmax], color='g')
-    #ax.plot(lmin,Green_raw[lmin], color='k')
-    x_green, Green=SPADdemod.Interpolate_timeDiv (lmax,Green_raw)
-    #x_dark, Dark=SPADdemod.Interpolate_timeDiv (lmin,Green_raw)
-    
-    lmin,lmax=SPADdemod.Find_targetPeaks(Red_raw, dmin=1, dmax=1,high_limit=high_r, low_limit=low_r)
+    ax.plot(green_peaks,Green_raw[green_peaks], color='g')
+    red_peaks,=SPADdemod.split_peaks_by_amplitude(Red_raw,SPADdemod.get_local_maxima(Red_raw),[(low_r,high_r)])
     fig, ax = plt.subplots(figsize=(12, 3))
-    ax.plot(lmax,Red_raw[lmax], color='r')
-    #ax.plot(lmin,Red_raw[lmin], color='k')
-    x_red, Red=SPADdemod.Interpolate_timeDiv (lmax,Red_raw)
-    #x_dark, Dark=SPADdemod.Interpolate_timeDiv (lmin,Red_raw)  
+    ax.plot(red_peaks,Red_raw[red_peaks], color='r')
+    x, (Green,Red)=SPADdemod.DemodTimeDivision([Green_raw,Red_raw],[green_peaks,red_peaks])
     fname = os.path.join(dpath, "Green_traceAll.csv")
     np.savetxt(fname, Green, delimiter=",")
     
@@ -156,6 +155,130 @@ def get_detrend (trace):
     ax=plot_trace(trace_detrend,ax, title="Trace_detrend")
     return trace_detrend
 
+'''Outlier removal: rolling statistics from cumulative sums, all flagged samples filled at once'''
+def get_rolling_mean_std(data, window_size):
+    '''Moving mean and std in a centred window of window_size samples with reflected edges,
+    same as scipy.ndimage.uniform_filter1d(mode='reflect') of data and data**2, computed from cumulative sums.'''
+    data = np.asarray(data, dtype=float)
+    offset = np.mean(data)  # cumulative sums of the centred data keep their precision on long traces
+    left = window_size // 2
+    right = window_size - 1 - left
+    padded = np.pad(data - offset, (left, right), mode='symmetric')
+    csum = np.concatenate(([0], np.cumsum(padded)))
+    csum2 = np.concatenate(([0], np.cumsum(padded ** 2)))
+    mean = (csum[window_size:] - csum[:-window_size]) / window_size
+    mean_sq = (csum2[window_size:] - csum2[:-window_size]) / window_size
+    std = np.sqrt(mean_sq - mean ** 2)
+    return mean + offset, std
+
+def replace_outliers_with_neighbours(data, outliers):
+    '''Replace every flagged sample by the average of the nearest non-outlier sample on its left and on its right,
+    or by the one that exists at the edges. The neighbours of all samples come from one running max/min of the
+    non-outlier index, so there is no search per outlier. Returns a new array.'''
+    data = np.array(data, dtype=float)
+    outliers = np.asarray(outliers, dtype=bool)
+    n = len(data)
+    index = np.arange(n)
+    left = np.maximum.accumulate(np.where(outliers, -1, index))
+    right = np.minimum.accumulate(np.where(outliers, n, index)[::-1])[::-1]
+    has_left = left >= 0
+    has_right = right < n
+    left_value = data[np.maximum(left, 0)]
+    right_value = data[np.minimum(right, n - 1)]
+    fill = np.where(has_left & has_right, (left_value + right_value) / 2, np.where(has_left, left_value, right_value))
+    replace = outliers & (has_left | has_right)
+    data[replace] = fill[replace]
+    return data
+
+def replace_outliers_with_nearest_avg(data, window_size=25000, z_thresh=3):
+    '''Samples more than z_thresh rolling std away from the rolling mean (window_size samples) are replaced
+    by the average of their nearest non-outlier neighbours.'''
+    mean, std = get_rolling_mean_std(data, window_size)
+    with np.errstate(invalid='ignore'):
+        outliers = np.abs(data - mean) > z_thresh * std
+    return replace_outliers_with_neighbours(data, outliers)
+
+def get_nearest_valid_values(data, valid):
+    '''Value of the nearest valid sample for every sample (the left one when both are at the same distance),
+    data itself where there is no valid sample.'''
+    data = np.asarray(data, dtype=float)
+    valid = np.asarray(valid, dtype=bool)
+    n = len(data)
+    index = np.arange(n)
+    left = np.maximum.accumulate(np.where(valid, index, -1))
+    right = np.minimum.accumulate(np.where(valid, index, n)[::-1])[::-1]
+    'Exclude the sample itself, like the neighbour search it replaces'
+    left = np.concatenate(([-1], left[:-1]))
+    right = np.concatenate((right[1:], [n]))
+    use_left = (left >= 0) & ((right >= n) | (index - left <= right - index))
+    use_right = ~use_left & (right < n)
+    nearest = data.copy()
+    nearest[use_left] = data[left[use_left]]
+    nearest[use_right] = data[right[use_right]]
+    return nearest
+
+'''Opto-stimulation: stimulus onsets from threshold crossings, artefact blanking and stimulus-locked windows'''
+def get_opto_pulses(data, opto_thre, min_length=1):
+    '''Start and stop (exclusive) of every run of samples above opto_thre lasting at least min_length samples.'''
+    starts, widths = SPADdemod.get_pulse_runs(np.asarray(data) > opto_thre)
+    keep = widths >= min_length
+    return starts[keep], starts[keep] + widths[keep]
+
+def blank_opto_artefacts(data, starts, stops):
+    '''Replace the samples of every pulse [start, stop) by linear interpolation from the samples around it.'''
+    data = np.asarray(data, dtype=float)
+    step = np.zeros(len(data) + 1, dtype=np.int64)
+    np.add.at(step, starts, 1)
+    np.add.at(step, stops, -1)
+    artefact = np.cumsum(step[:-1]) > 0
+    keep = ~artefact & ~np.isnan(data)
+    index = np.arange(len(data))
+    return np.interp(index, index[keep], data[keep])
+
+def get_opto_locked_windows(data, onsets, fs, pre_window=0.1, post_window=0.9):
+    '''(stimuli x samples) windows from pre_window seconds before to post_window seconds after every onset,
+    gathered with one fancy index. Onsets without a full window are dropped.
+    Returns the windows, the onsets used and the time axis (seconds, 0 at the onset).'''
+    pre_len = int(pre_window * fs)
+    post_len = int(post_window * fs)
+    onsets = np.asarray(onsets, dtype=np.int64)
+    onsets = onsets[(onsets - pre_len >= 0) & (onsets + post_len <= len(data))]
+    offsets = np.arange(-pre_len, post_len)
+    windows = np.asarray(data)[onsets[:, np.newaxis] + offsets]
+    return windows, onsets, offsets / fs
+
+def opto_response_statistics(windows, confidence=0.95):
+    '''Mean, std and t-distribution confidence interval across stimuli (axis 0).'''
+    mean = np.mean(windows, axis=0)
+    std = np.std(windows, axis=0)
+    n = len(windows)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        'CI is nan for a single stimulus'
+        sem = np.std(windows, axis=0, ddof=1) / np.sqrt(n)
+        moe = stats.t.ppf(0.5 + confidence / 2, n - 1) * sem
+    return mean, std, (mean - moe, mean + moe)
+
+def get_opto_response(traces, opto_thre, fs, min_length=1, pre_window=0.1, post_window=0.9, confidence=0.95):
+    '''Stimulus-locked response without plotting. traces: one trace or a list of traces (e.g. the sessions of a day),
+    the windows of all traces are pooled. For every trace, onsets are the starts of runs above opto_thre of at least
+    min_length samples, and those runs are blanked by interpolation before the windows are taken.
+    Returns a dict with windows, time, mean, std, CI, and per trace the onsets and the cleaned trace.'''
+    if not isinstance(traces, (list, tuple)):
+        traces = [traces]
+    windows, onsets, cleaned = [], [], []
+    for data in traces:
+        starts, stops = get_opto_pulses(data, opto_thre, min_length)
+        data_cleaned = blank_opto_artefacts(data, starts, stops)
+        trace_windows, _, time = get_opto_locked_windows(data_cleaned, starts, fs, pre_window, post_window)
+        windows.append(trace_windows)
+        onsets.append(starts)
+        cleaned.append(data_cleaned)
+    windows = np.concatenate(windows)
+    response = {'windows': windows, 'time': time, 'onsets': onsets, 'data_cleaned': cleaned}
+    if len(windows) > 0:
+        response['mean'], response['std'], response['CI'] = opto_response_statistics(windows, confidence)
+    return response
+
 def butter_filter(data, btype='low', cutoff=10, fs=9938.4, order=5):
 #def butter_filter(data, btype='high', cutoff=3, fs=130, order=5): # for photometry data  
     # cutoff and fs in Hz
@@ -167,18 +290,94 @@ def butter_filter(data, btype='low', cutoff=10, fs=9938.4, order=5):
     # ax=plot_trace(y,ax, label="trace_10Hz_low_pass")
     return y
 
+'''Batched PSD with a cache, shared by the PSD plots, band-power tables and SNR reports'''
+PSD_CACHE = OrderedDict()
+PSD_CACHE_SIZE = 16
+PSD_BANDS = {'slow_wave': (0, 1), 'theta': (2, 15), 'gamma': (30, 80), 'ripple': (150, 250)}
+
+def multitaper_psd(x, fs, nperseg=4096, NW=4, chunk_size=256):
+    '''Multitaper PSD of every row of x (traces x samples): DPSS tapers on non-overlapping segments of nperseg samples,
+    averaged over tapers and segments. Same one-sided density scaling as signal.welch.'''
+    x = np.atleast_2d(np.asarray(x, dtype=float))
+    nperseg = min(nperseg, x.shape[-1])
+    tapers = signal.windows.dpss(nperseg, NW, Kmax=max(1, int(2 * NW) - 1))
+    n_seg = x.shape[-1] // nperseg
+    segments = x[:, :n_seg * nperseg].reshape(len(x), n_seg, nperseg)
+    f = rfftfreq(nperseg, 1 / fs)
+    Pxx = np.zeros((len(x), len(f)))
+    for start in range(0, n_seg, chunk_size):
+        chunk = segments[:, start:start + chunk_size]
+        chunk = chunk - chunk.mean(axis=-1, keepdims=True)
+        for taper in tapers:
+            Pxx += (np.abs(rfft(chunk * taper, axis=-1)) ** 2).sum(axis=1)
+    Pxx /= fs * n_seg * len(tapers)
+    'One-sided: double everything except DC and (for even nperseg) Nyquist'
+    Pxx[:, 1:len(f) - (nperseg % 2 == 0)] *= 2
+    return f, Pxx
+
+def clear_psd_cache():
+    '''Empty the PSD cache, e.g. between recordings of a batch.'''
+    PSD_CACHE.clear()
+
+def compute_psd(traces, fs=9938.4, method="welch", nperseg=4096, NW=4, cache=True):
+    '''PSD of one trace or many traces in one call. traces: 1-D, (traces x samples), or a list of 1-D traces.
+    method: welch (nperseg samples, as PSD_plot), multitaper (see multitaper_psd) or periodogram (whole trace).
+    Returns f and Pxx (traces x frequencies), or a 1-D Pxx for a 1-D input.
+    Welch and multitaper results are cached per (data, fs, method, parameters), so replotting or band power reuses the spectrum.
+    The cache keeps the PSD_CACHE_SIZE most recently used spectra; whole-trace periodograms are never cached.'''
+    if isinstance(traces, (list, tuple)) and len(set(len(trace) for trace in traces)) > 1:
+        'Different lengths (e.g. theta and non-theta parts): one spectrum per trace, with a common nperseg'
+        if method == "periodogram":
+            raise ValueError('periodograms of traces of different length have different frequency axes, use welch or multitaper')
+        nperseg = min(nperseg, min(len(trace) for trace in traces))
+        results = [compute_psd(trace, fs, method, nperseg, NW, cache) for trace in traces]
+        return results[0][0], np.vstack([Pxx for _, Pxx in results])
+    data = np.ascontiguousarray(traces, dtype=float)
+    key = (hashlib.sha1(data.tobytes()).hexdigest(), data.shape, fs, method, nperseg, NW)
+    cache = cache and method != "periodogram"
+    if cache and key in PSD_CACHE:
+        PSD_CACHE.move_to_end(key)
+        return PSD_CACHE[key]
+    if method == "welch":
+        f, Pxx = signal.welch(data, fs=fs, nperseg=min(nperseg, data.shape[-1]), axis=-1)
+    elif method == "multitaper":
+        f, Pxx = multitaper_psd(data, fs, nperseg, NW)
+        Pxx = Pxx.reshape(data.shape[:-1] + Pxx.shape[-1:])
+    elif method == "periodogram":
+        f, Pxx = signal.periodogram(data, fs=fs, axis=-1)
+    else:
+        raise ValueError('method should be welch, multitaper or periodogram')
+    if cache:
+        PSD_CACHE[key] = (f, Pxx)
+        if len(PSD_CACHE) > PSD_CACHE_SIZE:
+            PSD_CACHE.popitem(last=False)
+    return f, Pxx
+
+def band_power_table(f, Pxx, bands=PSD_BANDS, labels=None, relative=False):
+    '''Band power (integral of the PSD over each band) of every trace, as a DataFrame (traces x bands).
+    relative=True divides by the total power.'''
+    Pxx = np.atleast_2d(Pxx)
+    table = pd.DataFrame(index=labels if labels is not None else range(len(Pxx)))
+    for name, (low, high) in bands.items():
+        idx = (f >= low) & (f <= high)
+        table[name] = trapezoid(Pxx[:, idx], f[idx], axis=-1)
+    if relative:
+        table = table.div(trapezoid(Pxx, f, axis=-1), axis=0)
+    return table
+
+def get_band_power(traces, fs=9938.4, bands=PSD_BANDS, labels=None, method="welch", nperseg=4096, relative=False):
+    f, Pxx = compute_psd(traces, fs, method, nperseg)
+    return band_power_table(f, Pxx, bands, labels, relative)
+
 '''Use python Scipy to plot PSD'''
 def PSD_plot(data, fs=9938.4, method="welch", color='tab:blue', xlim=[1,100], linewidth=1, linestyle='-',label='PSD',ax=None):
-    '''Three methods to plot PSD: welch, periodogram, plotlib based on a given ax'''
+    '''Plot PSD with welch, multitaper or periodogram (see compute_psd) based on a given ax'''
     if ax is None:
         fig, ax = plt.subplots()  # Create a new figure and axis if none provided
     else:
         fig = ax.figure  # Reference the figure from the provided ax
     
-    if method == "welch":
-        f, Pxx_den = signal.welch(data, fs=fs, nperseg=4096)
-    elif method == "periodogram":
-        f, Pxx_den = signal.periodogram(data, fs=fs)
+    f, Pxx_den = compute_psd(data, fs, method)
     # Convert to dB/Hz
     Pxx_den_dB = 10 * np.log10(Pxx_den)
     
@@ -202,6 +401,32 @@ def PSD_plot(data, fs=9938.4, method="welch", color='tab:blue', xlim=[1,100], li
         
     return fig, ax,f_filtered,Pxx_den_dB_filtered
 
+def PSD_plot_traces(traces, fs=9938.4, labels=None, colors=None, linestyles=None, method="welch", xlim=[1,100],
+                    linewidth=1, bands=PSD_BANDS, ax=None):
+    '''Plot the PSD of several traces (e.g. LFP rest/move/sleep) on one ax, from one compute_psd call.
+    Returns fig, ax and the band power table (traces x bands).'''
+    if ax is None:
+        fig, ax = plt.subplots()
+    else:
+        fig = ax.figure
+    labels = labels if labels is not None else ['PSD%d' % i for i in range(len(traces))]
+    colors = colors if colors is not None else [None] * len(traces)
+    linestyles = linestyles if linestyles is not None else ['-'] * len(traces)
+    f, Pxx = compute_psd(list(traces), fs, method)
+    Pxx = np.atleast_2d(Pxx)
+    Pxx_dB = 10 * np.log10(Pxx)
+    idx = (f >= xlim[0]) & (f <= xlim[1])
+    for i in range(len(Pxx)):
+        ax.plot(f, Pxx_dB[i], color=colors[i], linewidth=linewidth, linestyle=linestyles[i], label=labels[i])
+    ax.set_xlim(xlim)
+    ax.set_ylim([np.min(Pxx_dB[:, idx]) - 1, np.max(Pxx_dB[:, idx]) + 1])
+    ax.set_xlabel('Frequency [Hz]')
+    ax.set_ylabel('PSD [dB/Hz]')
+    legend = ax.legend(fontsize=12, markerscale=1.5)
+    legend.get_frame().set_facecolor('none')
+    legend.get_frame().set_edgecolor('none')
+    return fig, ax, band_power_table(f, Pxx, bands, labels)
+
 
 def combineTraces (dpath,fileNum):
     for i in range(fileNum):
@@ -232,30 +457,66 @@ def getSignal_subtract(Red,Green,fs=9938.4):
     Signal=GreenNorm-RedNorm
     return Signal[0]
 
-def getICA (Red,Green):
+'''ICA: the unmixing matrix is fitted on a subset of samples, cached, and applied to the whole recording in chunks'''
+ICA_UNMIXING_CACHE = {}
+
+def normalise_ica_unmixing(unmixing, mixing):
+    '''Reorder the components so that component i contributes most to observed channel i,
+    and flip their signs so that this contribution is positive, so repeated runs give the same output.'''
+    n = len(unmixing)
+    weight = np.abs(mixing) / np.abs(mixing).sum(axis=0, keepdims=True)
+    permutations = list(itertools.permutations(range(n)))
+    order = np.array(max(permutations, key=lambda perm: weight[np.arange(n), list(perm)].sum()))
+    sign = np.sign(mixing[np.arange(n), order])
+    return unmixing[order] * sign[:, np.newaxis]
+
+def fit_ica_unmixing(X, fit_samples=200000, random_state=0):
+    '''FastICA unmixing matrix and mean of X (samples x channels), fitted on fit_samples evenly spaced samples.
+    ICA does not use the time order, so a strided subset of a long recording gives the same unmixing.
+    Results are cached per (subset, random_state).'''
+    step = max(1, len(X) // fit_samples)
+    subset = np.ascontiguousarray(X[::step], dtype=float)
+    key = (hashlib.sha1(subset.tobytes()).hexdigest(), subset.shape, random_state)
+    if key not in ICA_UNMIXING_CACHE:
+        ica = FastICA(n_components=X.shape[1], random_state=random_state)
+        ica.fit(subset)
+        ICA_UNMIXING_CACHE[key] = (normalise_ica_unmixing(ica.components_, ica.mixing_), ica.mean_)
+    return ICA_UNMIXING_CACHE[key]
+
+def apply_ica_unmixing(X, unmixing, mean, chunk_size=2**20):
+    '''Sources (samples x components) = (X-mean) @ unmixing.T, chunk_size samples at a time.'''
+    S = np.empty((len(X), len(unmixing)))
+    for start in range(0, len(X), chunk_size):
+        S[start:start + chunk_size] = (np.asarray(X[start:start + chunk_size], dtype=float) - mean) @ unmixing.T
+    return S
+
+def getICA (Red,Green,fit_samples=200000,random_state=0,plot=True):
+    '''Two ICA components of the Green/Red traces, component 1 is mostly Green and component 2 mostly Red.
+    Seeded and fitted on a subset of fit_samples, see fit_ica_unmixing.'''
     channel1=Green
     channel2=Red
     X = np.c_[channel1,channel2]
     # Compute ICA
-    ica = FastICA(n_components=2)
-    S = ica.fit_transform(X)  # Reconstruct signals
-    A = ica.mixing_  # Get estimated mixing matrix
-    '''Plot ICA'''
-    plt.figure()
-    models = [X, S]
-    names = [
-        "Observations (mixed signal)",
-        "ICA recovered signals",
-    ]
-    colors = ["green", "red"]
-    
-    for ii, (model, name) in enumerate(zip(models, names), 1):
-        plt.subplot(2, 1, ii)
-        plt.title(name)
-        for sig, color in zip(model.T, colors):
-            plt.plot(sig, color=color,alpha=0.5)
-    plt.tight_layout()
-    plt.show()
+    unmixing, mean = fit_ica_unmixing(X, fit_samples=fit_samples, random_state=random_state)
+    S = apply_ica_unmixing(X, unmixing, mean)  # Reconstruct signals
+    if plot:
+        '''Plot ICA, at most fit_samples points per trace'''
+        step = max(1, len(X) // fit_samples)
+        plt.figure()
+        models = [X[::step], S[::step]]
+        names = [
+            "Observations (mixed signal)",
+            "ICA recovered signals",
+        ]
+        colors = ["green", "red"]
+        
+        for ii, (model, name) in enumerate(zip(models, names), 1):
+            plt.subplot(2, 1, ii)
+            plt.title(name)
+            for sig, color in zip(model.T, colors):
+                plt.plot(sig, color=color,alpha=0.5)
+        plt.tight_layout()
+        plt.show()
     '''get two separated signals'''
     signal1=S[:,0]
     signal2=S[:,1]
@@ -264,46 +525,32 @@ def getICA (Red,Green):
 
 '''PSD analysis after subtracting mean'''
 def plot_PSD_bands (trace,fs=9938.4):
-    from numpy.fft import fft
-    t = np.arange(len(trace)) / fs
-    
-    x = trace                               # Relabel the data variable
-    dt = t[1] - t[0]                      # Define the sampling interval
-    N = x.shape[0]                        # Define the total number of data points
-    T = N * dt                            # Define the total duration of the data
-    
-    xf = fft(x - x.mean())                # Compute Fourier transform of x
-    Sxx = 2 * dt ** 2 / T * (xf * xf.conj())  # Compute spectrum
-    Sxx = Sxx[:int(len(x) / 2)]           # Ignore negative frequencies
-    
-    df = 1 / T.max()                      # Determine frequency resolution
-    fNQ = 1 / dt / 2                      # Determine Nyquist frequency
-    faxis = np.arange(0,fNQ,df)              # Construct frequency axis
+    faxis, Sxx = compute_psd(trace, fs, method="periodogram")  # Spectrum of the whole trace
 
     fig, ax = plt.subplots(2,2,sharey=False)
     
-    ax[0,0].plot(faxis, Sxx.real)                 # Plot spectrum vs frequency
+    ax[0,0].plot(faxis, Sxx)                 # Plot spectrum vs frequency
     ax[0,0].set_xlim([0, 1])
     #ax[0,0].set_ylim([0, 2000])                    # Select frequency range
     ax[0,0].set_title("Slow Wave band",fontsize=8)
     ax[0,0].xaxis.set_tick_params(labelsize=8)
     ax[0,0].yaxis.set_tick_params(labelsize=8)
     
-    ax[0,1].plot(faxis, Sxx.real)                 # Plot spectrum vs frequency
+    ax[0,1].plot(faxis, Sxx)                 # Plot spectrum vs frequency
     ax[0,1].set_xlim([2, 15])
     #ax[0,1].set_ylim([0, 0.005])                    # Select frequency range
     ax[0,1].set_title("Theta band",fontsize=8)
     ax[0,1].xaxis.set_tick_params(labelsize=8)
     ax[0,1].yaxis.set_tick_params(labelsize=8)
     
-    ax[1,0].plot(faxis, Sxx.real)                 # Plot spectrum vs frequency
+    ax[1,0].plot(faxis, Sxx)                 # Plot spectrum vs frequency
     ax[1,0].set_xlim([30, 80])
     #ax[1,0].set_ylim([0, 0.005])                    # Select frequency range
     ax[1,0].set_title("Gamma band",fontsize=8)
     ax[1,0].xaxis.set_tick_params(labelsize=8)
     ax[1,0].yaxis.set_tick_params(labelsize=8)
     
-    ax[1,1].plot(faxis, Sxx.real)                 # Plot spectrum vs frequency
+    ax[1,1].plot(faxis, Sxx)                 # Plot spectrum vs frequency
     ax[1,1].set_xlim([150, 250])
     #ax[1,1].set_ylim([0, 0.005])                    # Select frequency range
     ax[1,1].set_title("Ripple band",fontsize=8)
@@ -321,25 +568,11 @@ def plot_PSD_bands (trace,fs=9938.4):
     return fig
 
 def plot_PSD_bands_full (trace,fs=9938.4):
-    from numpy.fft import fft
-    t = np.arange(len(trace)) / fs
-    
-    x = trace                               # Relabel the data variable
-    dt = t[1] - t[0]                      # Define the sampling interval
-    N = x.shape[0]                        # Define the total number of data points
-    T = N * dt                            # Define the total duration of the data
-    
-    xf = fft(x - x.mean())                # Compute Fourier transform of x
-    Sxx = 2 * dt ** 2 / T * (xf * xf.conj())  # Compute spectrum
-    Sxx = Sxx[:int(len(x) / 2)]           # Ignore negative frequencies
-    
-    df = 1 / T.max()                      # Determine frequency resolution
-    fNQ = 1 / dt / 2                      # Determine Nyquist frequency
-    faxis = np.arange(0,fNQ,df)              # Construct frequency axis
+    faxis, Sxx = compute_psd(trace, fs, method="periodogram")  # Spectrum of the whole trace
 
     fig, ax = plt.subplots(1,1)
     
-    ax.plot(faxis, Sxx.real)                 # Plot spectrum vs frequency
+    ax.plot(faxis, Sxx)                 # Plot spectrum vs frequency
     ax.set_xlim([0,5000])
     #ax.set_ylim([0, 1e-7])                    # Select frequency range
     ax.set_title("Full band",fontsize=8)
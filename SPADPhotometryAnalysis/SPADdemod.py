@@ -7,10 +7,8 @@ Created on Fri Feb 25 17:36:16 2022
 import os
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.fft import irfft, rfft, rfftfreq
+from scipy.fft import irfft, rfft, rfftfreq, ifft, next_fast_len
 import scipy
-from scipy import interpolate
-from scipy.signal import find_peaks
 
 def findMask(trace,high_thd,low_thd=0):
     mask=trace.copy()
@@ -19,53 +17,48 @@ def findMask(trace,high_thd,low_thd=0):
     mask[mask!=0]=1
     return mask
 
-def preserve_more_than_five_ones(mask_array):
-    preserved_array = mask_array.copy()
-    consecutive_ones = 0
-
-    for i in range(len(mask_array)):
-        if mask_array[i] == 1:
-            consecutive_ones += 1
-        else:
-            if consecutive_ones < 5:
-                preserved_array[i - consecutive_ones:i] = 0
-            consecutive_ones = 0
-
-    # Handle the last sequence if it ends with 1s
-    if consecutive_ones > 3:
-        preserved_array[len(mask_array) - consecutive_ones:] = 1
-
-    return preserved_array
-
-def preserve_fewer_than_four_ones(mask_array):
-    preserved_array = mask_array.copy()
-    consecutive_ones = 0
-
-    for i in range(len(mask_array)):
-        if mask_array[i] == 1:
-            consecutive_ones += 1
-        else:
-            if consecutive_ones > 0 and consecutive_ones <= 4:
-                preserved_array[i - consecutive_ones:i] = 1
-            else:
-                preserved_array[i - consecutive_ones:i] = 0
-            consecutive_ones = 0
-
-    # Handle the last sequence if it ends with 1s
-    if consecutive_ones > 0 and consecutive_ones < 3:
-        preserved_array[len(mask_array) - consecutive_ones:] = 1
-    else:
-        preserved_array[len(mask_array) - consecutive_ones:] = 0
-
-    return preserved_array
+def get_pulse_runs(mask_array):
+    '''Start index and width (samples) of every run of ones in a 0/1 mask.'''
+    edges = np.diff(np.concatenate(([0], np.asarray(mask_array) == 1, [0])).astype(np.int8))
+    starts = np.flatnonzero(edges == 1)
+    stops = np.flatnonzero(edges == -1)
+    return starts, stops - starts
+
+def get_pulse_width_per_sample(mask_array):
+    '''Width of the pulse (run of ones) each sample belongs to, 0 outside pulses.'''
+    is_one = np.asarray(mask_array) == 1
+    starts, widths = get_pulse_runs(mask_array)
+    'Run number of every sample from a cumulative count of run starts'
+    run_start = np.zeros(len(is_one), dtype=np.int64)
+    run_start[starts] = 1
+    run_number = np.cumsum(run_start) * is_one
+    return np.concatenate(([0], widths))[run_number]
+
+def separate_pulse_trains(mask_array, signal_min_width=5, reference_max_width=4):
+    '''Split a findMask output into the signal mask (pulses of at least signal_min_width samples)
+    and the reference mask (pulses of at most reference_max_width samples), in one pass over the pulse widths.
+    A pulse cut by the end of the trace is classified by its width like the others.'''
+    width = get_pulse_width_per_sample(mask_array)
+    dtype = np.asarray(mask_array).dtype
+    mask_signal = (width >= signal_min_width).astype(dtype)
+    mask_reference = ((width > 0) & (width <= reference_max_width)).astype(dtype)
+    return mask_signal, mask_reference
+
+def preserve_more_than_five_ones(mask_array, min_width=5):
+    '''Keep pulses of at least min_width samples, see separate_pulse_trains.'''
+    mask_signal, _ = separate_pulse_trains(mask_array, signal_min_width=min_width)
+    return mask_signal
+
+def preserve_fewer_than_four_ones(mask_array, max_width=4):
+    '''Keep pulses of at most max_width samples, see separate_pulse_trains.'''
+    _, mask_reference = separate_pulse_trains(mask_array, reference_max_width=max_width)
+    return mask_reference
 
 
 def findTraceFromMask(trace,mask):
-    non_signal_index=np.where(mask==0)[0]
-    trace_temp=trace.copy()
-    trace_temp[non_signal_index]=0
-    peaks, _ = find_peaks(trace_temp)
-    envelope = np.zeros_like(trace_temp)
+    '''Peak of every pulse in mask and an envelope that is zero except at the peaks, see get_pulse_peak_index.'''
+    peaks,_=get_pulse_peak_index(trace,mask)
+    envelope = np.zeros_like(trace)
     envelope[peaks] = trace[peaks]
     return peaks,envelope
 
@@ -128,19 +121,56 @@ def Find_targetPeaks(s, dmin=1, dmax=1, high_limit=4000, low_limit=2700):
     return lmin, lmax
 
 def Interpolate_timeDiv (Index,trace):
-    x=Index
-    y=trace[Index]
-    if Index[0]!=0:
-        x = np.concatenate( ([0], x ))
-        y = np.concatenate( ([y[0]], y ) )
-    if Index[-1]!=len(trace)-1:
-        x = np.concatenate( (x,[len(trace)-1]) )
-        y = np.concatenate( (y ,[y[-1]]) )
-    f = interpolate.interp1d(x, y)
+    '''Linear interpolation of trace[Index] on every sample, held at the first/last value before/after the first/last index.'''
     xnew = np.arange(0, len(trace), 1)
-    ynew = f(xnew)   # use interpolation function returned by `interp1d`
+    ynew = np.interp(xnew, Index, trace[Index])
     return xnew, ynew
 
+'''Time division: one pulse index shared by the channels, all channels interpolated on the same sample grid'''
+def get_local_maxima(s):
+    '''Index of every local maximum, the scan used by Find_targetPeaks and hl_envelopes_idx.'''
+    return (np.diff(np.sign(np.diff(s))) < 0).nonzero()[0] + 1
+
+def split_peaks_by_amplitude(s, peak_index, limits):
+    '''Split one peak index into channels by amplitude, limits is a list of (low_limit, high_limit), one per channel.'''
+    peak_value = s[peak_index]
+    return [peak_index[(peak_value > low_limit) & (peak_value < high_limit)] for low_limit, high_limit in limits]
+
+def get_pulse_peak_index(trace, mask_array):
+    '''Index of the highest sample of every pulse (run of ones) in mask_array, and the pulse widths.
+    One value per pulse, taken for all pulses at once with a reduceat over the pulse samples.'''
+    trace = np.asarray(trace)
+    starts, widths = get_pulse_runs(mask_array)
+    if len(starts) == 0:
+        return starts, widths
+    pulse_samples = np.flatnonzero(np.asarray(mask_array) == 1)
+    offsets = np.concatenate(([0], np.cumsum(widths)[:-1]))
+    pulse_values = trace[pulse_samples]
+    pulse_max = np.maximum.reduceat(pulse_values, offsets)
+    'First sample of each pulse that reaches the pulse maximum'
+    pulse_number = np.repeat(np.arange(len(starts)), widths)
+    is_max = pulse_values == pulse_max[pulse_number]
+    _, first = np.unique(pulse_number[is_max], return_index=True)
+    return pulse_samples[np.flatnonzero(is_max)[first]], widths
+
+def DemodTimeDivision(traces, pulse_indices):
+    '''Every channel of a time-division recording on the common grid 0..n-1 (linear between pulses, like Interpolate_timeDiv).
+    traces: one trace shared by all channels, or a list with one trace per channel.
+    pulse_indices: list with the pulse (peak) sample index of each channel.
+    Returns the sample grid and a (channels x samples) array, so the channels stay sample-aligned.'''
+    if isinstance(traces, (list, tuple)):
+        traces = [np.asarray(trace, dtype=float) for trace in traces]
+    else:
+        traces = [np.asarray(traces, dtype=float)] * len(pulse_indices)
+    n = min(len(trace) for trace in traces)
+    grid = np.arange(n)
+    channels = np.empty((len(pulse_indices), n))
+    for i, (trace, pulse_index) in enumerate(zip(traces, pulse_indices)):
+        pulse_index = np.asarray(pulse_index)
+        pulse_index = pulse_index[pulse_index < n]
+        channels[i] = np.interp(grid, pulse_index, trace[pulse_index])
+    return grid, channels
+
 def plotDemodFreq (mixedTrace,envelope,xf,yfMixed,yfEnvelope,color):
     '''
     Plot 
@@ -176,18 +206,20 @@ def plotTwoChannel (mixed_red,envelope_red,mixed_green,envelope_green,zoomWindw=
     '''
     Plot Two Color
     '''
-    sample_points=np.arange(len(mixed_red)) #timeline in sample points    
+    sample_points=np.arange(len(envelope_red)) #timeline in sample points    
     
     fig, (ax0,ax1,ax2,ax3) = plt.subplots(nrows=4)
     ax0.plot(sample_points, envelope_red, color='r',label='Envelope',linewidth=1)
     #ax0.legend(loc='best')
     
+    ax1.plot(np.arange(len(mixed_red)), mixed_red,color='grey',label='Mixed',linewidth=0.5,alpha=0.6)
     ax1.plot(sample_points, envelope_red,color='r',label='Zoomed Envelope',linewidth=1)
     ax1.set_xlim(zoomWindw)
     ax1.legend(loc='upper right')
     
     ax2.plot(sample_points, envelope_green,color='g',label='Envelope',linewidth=1)    
     
+    ax3.plot(np.arange(len(mixed_green)), mixed_green,color='grey',label='Mixed',linewidth=0.5,alpha=0.6)
     ax3.plot(sample_points, envelope_green,color='g',label='Zoomed Envelope',linewidth=1)
     ax3.legend(loc='upper right')
     ax3.set_xlim(zoomWindw)   
@@ -205,74 +237,93 @@ def butter_filter(data, btype='low', cutoff=10, fs=9938.4, order=10):
     y = scipy.signal.filtfilt(b, a, data, axis=0)
     return y
 
-def DemodFreqShift (count_value,fc_g,fc_r,fs=9938.4):
-    sample_number=len(count_value)
-    #sample_points=np.arange(sample_number) #timeline in sample points
-    print ('sample_number is', sample_number)
+def carrier_band_gains(freqs, carriers, side_band=250, transition=50):
+    '''(carriers x freqs) gain for the band fc+/-side_band around every carrier.
+    Band edges are raised-cosine ramps of width transition (Hz), so the band-pass impulse response is short
+    and chunks of a long trace can be demodulated independently.'''
+    distance = np.abs(freqs[np.newaxis, :] - np.asarray(carriers, dtype=float)[:, np.newaxis])
+    ramp = np.clip((side_band + transition / 2 - distance) / transition, 0, 1)
+    return 0.5 - 0.5 * np.cos(np.pi * ramp)
+
+def analytic_carriers(count_value, carriers, fs=9938.4, side_band=250, transition=50):
+    '''Analytic signal (carriers x samples) of every carrier band from one rfft of the trace.
+    Only the positive frequencies of each band are kept (single sideband), so abs() is the envelope
+    and .real is the band-passed trace.'''
+    x = np.asarray(count_value, dtype=float)
+    n = len(x)
+    n_fft = next_fast_len(n)
+    spectrum = rfft(x, n=n_fft)
+    gains = carrier_band_gains(rfftfreq(n_fft, 1 / fs), carriers, side_band, transition)
+    analytic_spectrum = np.zeros((len(gains), n_fft), dtype=complex)
+    analytic_spectrum[:, :len(spectrum)] = 2 * gains * spectrum
+    return ifft(analytic_spectrum, axis=-1, overwrite_x=True)[:, :n]
+
+def iter_demodulated_chunks(count_value, carriers, fs=9938.4, side_band=250, transition=50, chunk_len=0.5, pad_len=0.1):
+    '''Yield the (carriers x samples) envelopes of consecutive chunk_len second chunks.
+    Each chunk is demodulated with pad_len seconds of neighbouring samples that are cut off afterwards,
+    so a stream can be demodulated with a latency of chunk_len+pad_len.'''
+    x = np.asarray(count_value, dtype=float)
+    n = len(x)
+    chunk = int(chunk_len * fs)
+    pad = int(pad_len * fs)
+    for start in range(0, n, chunk):
+        stop = min(start + chunk, n)
+        lo = max(0, start - pad)
+        hi = min(n, stop + pad)
+        envelope = np.abs(analytic_carriers(x[lo:hi], carriers, fs, side_band, transition))
+        yield envelope[:, start - lo:stop - lo]
+
+def DemodCarriers(count_value, carriers, fs=9938.4, side_band=250, transition=50, chunk_len=None):
+    '''Envelope (carriers x samples) of every carrier of a frequency-multiplexed trace.
+    chunk_len=None demodulates the whole trace in one pass, otherwise chunk_len seconds at a time.'''
+    if chunk_len is None:
+        return np.abs(analytic_carriers(count_value, carriers, fs, side_band, transition))
+    return np.concatenate(list(iter_demodulated_chunks(count_value, carriers, fs, side_band, transition, chunk_len)), axis=1)
+
+def estimate_carrier_lag(band_signal, fc, fs=9938.4):
+    '''Lag within +/- half a carrier period that maximises np.correlate(np.roll(band_signal,lag),band_signal).
+    The circular correlation at all lags comes from one FFT.'''
+    x = np.asarray(band_signal, dtype=float)
+    spectrum = rfft(x)
+    circular_corr = irfft(spectrum * np.conj(spectrum), n=len(x))
+    lags = np.arange(int(-0.5*fs/fc),int(0.5*fs/fc))
+    return lags[np.argmax(circular_corr[lags % len(x)])]
+
+def DemodFreqShift (count_value,fc_g,fc_r,fs=9938.4,chunk_len=None):
+    '''Both carriers are demodulated in one pass (Hilbert envelope of each 250 Hz side band), see DemodCarriers.'''
+    print ('sample_number is', len(count_value))
     print ('sampling rage is', fs)
-    
-    yf = rfft(count_value)
-    xf = rfftfreq(sample_number, 1 / fs)
-    
-    '''Remove unwanted low/high frequencies and demodulation'''
-    points_per_freq = len(xf) / (fs/2)
-    #yf[0:int(10*points_per_freq)] = 0 
-    #yf[int(3060*points_per_freq):]=0
-    #mix = irfft(yf)
-    
-    yf_g = np.copy(yf)
-    yf_r=np.copy(yf)
-    
-    '''The maximum frequency is half the sample rate'''
-    fc_g_idx = int(points_per_freq * fc_g)
-    sideBand=int(points_per_freq *250) 
-    fc_r_idx = int(points_per_freq * fc_r) 
     print ('fc_green is',fc_g)
     print ('fc_red is',fc_r)
-    print ('fc_g_idx is',fc_g_idx)
-    print ('sideBand_idx is',sideBand)
-    print ('fc_r_idx is',fc_r_idx)
-    
-    '''For red---preserve wanted band'''
-    yf_r[0: fc_r_idx - sideBand] = 0 
-    yf_r[fc_r_idx + sideBand : ] = 0 
-    signal_r = irfft(yf_r)    
-    print ('For red channal, keep band:',fc_r_idx - sideBand,'to',fc_r_idx + sideBand)   
-    
-    '''Envelope--red'''
-    lmin,lmax=hl_envelopes_max(signal_r, dmin=1, dmax=1, split=False)
-    xnew, red_recovered=Interpolate_timeDiv (lmax,signal_r)
-        
-    '''For green'''
-    yf_g[0: fc_g_idx - sideBand] = 0 
-    yf_g[fc_g_idx + sideBand : ] = 0 
-    signal_g = irfft(yf_g)
-    print ('For green channal, keep band:',fc_g_idx - sideBand,'to',fc_g_idx + sideBand)   
-    '''Hilbert transform--green'''
-    lmin,lmax=hl_envelopes_max(signal_g, dmin=1, dmax=1, split=False)
-    xnew, green_recovered=Interpolate_timeDiv (lmax,signal_g)          
+    zoomWindw=[0,10000]
+    if chunk_len is None:
+        'One pass: abs() is the envelope, .real the band-limited carrier for the plot'
+        analytic=analytic_carriers(count_value,[fc_r,fc_g],fs=fs,side_band=250)
+        red_recovered,green_recovered=np.abs(analytic)
+        mixed_red,mixed_green=analytic.real
+    else:
+        red_recovered,green_recovered=DemodCarriers(count_value,[fc_r,fc_g],fs=fs,side_band=250,chunk_len=chunk_len)
+        'Band-limited carriers only for the plotted window (plus one chunk, so the cut is outside it)'
+        plot_len=min(len(count_value),zoomWindw[1]+int(chunk_len*fs))
+        mixed_red,mixed_green=analytic_carriers(count_value[:plot_len],[fc_r,fc_g],fs=fs,side_band=250).real
     
     '''PLOT TO COMPARE'''    
-    fig=plotTwoChannel (mixed_red=signal_r,envelope_red=red_recovered,
-                        mixed_green=signal_g,envelope_green=green_recovered,
-                        zoomWindw=[0,10000])
+    fig=plotTwoChannel (mixed_red=mixed_red,envelope_red=red_recovered,
+                        mixed_green=mixed_green,envelope_green=green_recovered,
+                        zoomWindw=zoomWindw)
     
     return red_recovered,green_recovered
 
 def DemodFreqShift_bandpass (count_value,fc_g,fc_r,fs=9938.4):
     mix_g=butter_filter(count_value, btype='low', cutoff=fc_g+250, fs=fs, order=5)
     mix_g=butter_filter(mix_g, btype='high', cutoff=fc_g-250, fs=fs, order=5)
-    xcorr = lambda i: np.correlate(np.roll(mix_g,i), mix_g)
-    lags = np.arange(int(-0.5*fs/fc_g),int(0.5*fs/fc_g))
-    lag = lags[np.argmax([xcorr(s) for s in lags])]
+    lag = estimate_carrier_lag(mix_g, fc_g, fs)
     # Demodulate signal by multiplication with lagged modulation then lowpass filtering.
     mixed_green = np.roll(mix_g,lag)*mix_g
 
     mix_r=butter_filter(count_value, btype='low', cutoff=fc_r+250, fs=fs, order=5)
     mix_r=butter_filter(mix_r, btype='high', cutoff=fc_r-250, fs=fs, order=5)
-    xcorr = lambda i: np.correlate(np.roll(mix_r,i), mix_r)
-    lags = np.arange(int(-0.5*fs/fc_r),int(0.5*fs/fc_r))
-    lag = lags[np.argmax([xcorr(s) for s in lags])]
+    lag = estimate_carrier_lag(mix_r, fc_r, fs)
     # Demodulate signal by multiplication with lagged modulation then lowpass filtering.
     mixed_red = np.roll(mix_r,lag)*mix_r
 
@@ -10,6 +10,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from scipy.sparse import csc_matrix, eye, diags
 from scipy.sparse.linalg import spsolve
+from scipy import ndimage
 from sklearn.linear_model import Lasso
 import pandas as pd
 import os
@@ -77,48 +78,38 @@ def get_zdFF(reference,signal,smooth_win=10,remove=0,lambd=5e4,porder=1,itermax=
   return zdFF
 
 
-def smooth_signal(x,window_len=10,window='flat'):
+SMOOTH_WINDOWS = {'hanning': np.hanning, 'hamming': np.hamming, 'bartlett': np.bartlett, 'blackman': np.blackman}
+
+def smooth_signal(x,window_len=10,window='flat',axis=-1):
 
     """smooth the data using a window with requested size.
     
-    This method is based on the convolution of a scaled window with the signal.
-    The signal is prepared by introducing reflected copies of the signal 
-    (with the window size) in both ends so that transient parts are minimized
-    in the begining and end part of the output signal.
-    The code taken from: https://scipy-cookbook.readthedocs.io/items/SignalSmooth.html
+    The signal is extended by reflecting it (without repeating the edge sample) at both ends,
+    so that transient parts are minimized in the begining and end part of the output signal.
+    Based on: https://scipy-cookbook.readthedocs.io/items/SignalSmooth.html
+    The reflection is done inside the scipy.ndimage filter, so no padded copy of the signal is made,
+    and 'flat' is a running sum whose cost does not depend on window_len.
     
     input:
-        x: the input signal 
-        window_len: the dimension of the smoothing window; should be an odd integer
+        x: the input signal, 1D or 2D (channels x samples, smoothed along axis)
+        window_len: the dimension of the smoothing window
         window: the type of window from 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'
                 'flat' window will produce a moving average smoothing.
     output:
-        the smoothed signal        
+        the smoothed signal, same shape as x
     """
-    import numpy as np
-
-    if x.ndim != 1:
-        raise(ValueError, "smooth only accepts 1 dimension arrays.")
-
-    if x.size < window_len:
-        raise(ValueError, "Input vector needs to be bigger than window size.")
-
     if window_len<3:
         return x
-
     if not window in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
-        raise(ValueError, "Window is one of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'")
-
-    s=np.r_[x.loc[window_len-1:0:-1],x,x.loc[-2:-window_len-1:-1]]
+        raise ValueError("Window is one of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'")
 
+    x=np.asarray(x,dtype=float)
+    if x.shape[axis] < window_len:
+        raise ValueError("Input vector needs to be bigger than window size.")
     if window == 'flat': # Moving average
-        w=np.ones(window_len,'d')
-    else:
-        w=eval('np.'+window+'(window_len)')
-
-    y=np.convolve(w/w.sum(),s,mode='valid')
-
-    return y[(int(window_len/2)-1):-int(window_len/2)]
+        return ndimage.uniform_filter1d(x,window_len,axis=axis,mode='mirror')
+    w=SMOOTH_WINDOWS[window](window_len)
+    return ndimage.correlate1d(x,w/w.sum(),axis=axis,mode='mirror')
 
 
 '''
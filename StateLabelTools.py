@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Functions to label brain/behavioural states on the 10 kHz aligned timebase.
+
+States are handled as sample index ranges, i.e. an (n,2) int array of [start, end) pairs,
+and as a compact uint8 state array with one code per sample.
+This avoids looping over epochs on the full timestamp vector and avoids copying
+the aligned DataFrame for every state.
+Sorted, non-overlapping ranges are interval sets: union, intersection, complement and
+restriction only touch the range boundaries, never a per-sample array.
+REM sleep is labelled from a theta/delta band power ratio per time bin with hysteresis thresholds
+and run-length duration rules, so different thresholds can be tried on the same ratio.
+"""
+import numpy as np
+import pandas as pd
+from scipy import signal
+
+def epochs_to_index_ranges(timestamps, starts, ends):
+    '''Map epoch start/end times (seconds) to [start_idx, end_idx) sample ranges.
+    timestamps must be sorted, e.g. the 'timestamps' column of the aligned DataFrame.
+    Empty ranges are dropped.'''
+    timestamps = np.asarray(timestamps)
+    start_idx = np.searchsorted(timestamps, np.asarray(starts, dtype=float), side='left')
+    end_idx = np.searchsorted(timestamps, np.asarray(ends, dtype=float), side='left')
+    index_ranges = np.column_stack((start_idx, end_idx)).astype(np.int64)
+    return index_ranges[index_ranges[:, 1] > index_ranges[:, 0]]
+
+def label_from_index_ranges(n_samples, index_ranges, value=1, dtype=np.uint8):
+    '''Fill a state array of length n_samples with value inside the index ranges and 0 elsewhere.
+    Overlapping ranges are allowed, the array is built with one cumulative sum.'''
+    index_ranges = np.asarray(index_ranges, dtype=np.int64).reshape(-1, 2)
+    delta = np.zeros(n_samples + 1, dtype=np.int64)
+    np.add.at(delta, np.clip(index_ranges[:, 0], 0, n_samples), 1)
+    np.add.at(delta, np.clip(index_ranges[:, 1], 0, n_samples), -1)
+    state = np.zeros(n_samples, dtype=dtype)
+    state[np.cumsum(delta[:-1]) > 0] = value
+    return state
+
+def index_ranges_from_label(state, value=1):
+    '''Run-length encode the samples where state==value back to [start, end) ranges.'''
+    mask = np.asarray(state) == value
+    edges = np.diff(mask.astype(np.int8), prepend=0, append=0)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return np.column_stack((starts, ends)).astype(np.int64)
+
+def normalise_index_ranges(index_ranges):
+    '''Sort ranges and merge overlapping or touching ones, giving a canonical interval set.'''
+    index_ranges = np.asarray(index_ranges, dtype=np.int64).reshape(-1, 2)
+    index_ranges = index_ranges[index_ranges[:, 1] > index_ranges[:, 0]]
+    if len(index_ranges) == 0:
+        return index_ranges
+    index_ranges = index_ranges[np.argsort(index_ranges[:, 0], kind='stable')]
+    max_end = np.maximum.accumulate(index_ranges[:, 1])
+    new_range = np.concatenate(([True], index_ranges[1:, 0] > max_end[:-1]))
+    group_end = np.append(np.flatnonzero(new_range)[1:] - 1, len(index_ranges) - 1)
+    return np.column_stack((index_ranges[new_range, 0], max_end[group_end]))
+
+def union_index_ranges(*index_ranges):
+    return normalise_index_ranges(np.concatenate([np.asarray(r, dtype=np.int64).reshape(-1, 2) for r in index_ranges]))
+
+def complement_index_ranges(index_ranges, n_samples):
+    '''Return the ranges of [0, n_samples) that are not covered by index_ranges.'''
+    index_ranges = np.clip(normalise_index_ranges(index_ranges), 0, n_samples)
+    edges = np.concatenate(([0], index_ranges.ravel(), [n_samples]))
+    gaps = edges.reshape(-1, 2)
+    return gaps[gaps[:, 1] > gaps[:, 0]]
+
+def intersect_index_ranges(index_ranges_a, index_ranges_b):
+    '''Ranges covered by both interval sets, e.g. non-theta and non-REM.
+    Every pair of ranges that can overlap is found with searchsorted on the sorted boundaries.'''
+    a = normalise_index_ranges(index_ranges_a)
+    b = normalise_index_ranges(index_ranges_b)
+    'For every range of a, the ranges of b from first (first end > start) to last (last start < end) overlap it'
+    first = np.searchsorted(b[:, 1], a[:, 0], side='right')
+    last = np.searchsorted(b[:, 0], a[:, 1], side='left')
+    counts = np.maximum(last - first, 0)
+    a_index = np.repeat(np.arange(len(a)), counts)
+    b_index = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(first, counts)
+    starts = np.maximum(a[a_index, 0], b[b_index, 0])
+    ends = np.minimum(a[a_index, 1], b[b_index, 1])
+    return np.column_stack((starts, ends)).astype(np.int64).reshape(-1, 2)
+
+def restrict_index_ranges(index_ranges, start, end):
+    '''Part of the interval set inside [start, end), e.g. a state within a time window of the session.'''
+    return intersect_index_ranges(index_ranges, [[start, end]])
+
+def overlaps_index_ranges(index_ranges, starts, ends):
+    '''Boolean array, True where the query range [starts[i], ends[i]) overlaps the interval set.
+    Used to test many events (e.g. ripple peaks +/- 10 ms) against a state in one call.'''
+    index_ranges = normalise_index_ranges(index_ranges)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    first = np.searchsorted(index_ranges[:, 1], starts, side='right')
+    valid = first < len(index_ranges)
+    overlaps = np.zeros(len(starts), dtype=bool)
+    overlaps[valid] = index_ranges[first[valid], 0] < ends[valid]
+    return overlaps & (ends > starts)
+
+def index_ranges_length(index_ranges):
+    '''Number of samples in the interval set.'''
+    index_ranges = normalise_index_ranges(index_ranges)
+    return int(np.sum(index_ranges[:, 1] - index_ranges[:, 0]))
+
+def merge_index_ranges(index_ranges, max_gap=0, min_len=0):
+    '''Merge [start, end) ranges separated by at most max_gap samples, then drop ranges shorter than min_len.'''
+    index_ranges = np.asarray(index_ranges, dtype=np.int64).reshape(-1, 2)
+    if len(index_ranges) == 0:
+        return index_ranges
+    new_range = np.concatenate(([True], index_ranges[1:, 0] - index_ranges[:-1, 1] > max_gap))
+    starts = index_ranges[new_range, 0]
+    ends = index_ranges[np.append(np.flatnonzero(new_range)[1:] - 1, len(index_ranges) - 1), 1]
+    merged = np.column_stack((starts, ends))
+    return merged[merged[:, 1] - merged[:, 0] >= min_len]
+
+def index_ranges_to_indices(index_ranges):
+    '''Expand [start, end) ranges to a flat sample index array.'''
+    index_ranges = np.asarray(index_ranges, dtype=np.int64).reshape(-1, 2)
+    lengths = index_ranges[:, 1] - index_ranges[:, 0]
+    if lengths.sum() == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(index_ranges[:, 0] - np.cumsum(lengths) + lengths, lengths)
+    return np.arange(lengths.sum(), dtype=np.int64) + offsets
+
+def state_to_categorical(state, categories):
+    '''Wrap a uint8 state array as a pandas Categorical, e.g. categories=['nontheta','theta'].'''
+    return pd.Categorical.from_codes(np.asarray(state, dtype=np.int8), categories=categories)
+
+def take_index_ranges(data, index_ranges):
+    '''Concatenate the samples in index_ranges from a DataFrame/Series (or numpy array).
+    NOTE: this cuts and concatenates the signals, only use it for visualisation or PSD.'''
+    indices = index_ranges_to_indices(index_ranges)
+    if isinstance(data, (pd.DataFrame, pd.Series)):
+        return data.iloc[indices].reset_index(drop=True)
+    return np.asarray(data)[indices]
+
+def get_band_power_matrix(data, fs, bands, window_len=2, step=1, target_fs=250):
+    '''Mean PSD in every band (bands x time bins) from one spectrogram of data decimated to about target_fs.
+    Bins are window_len seconds long every step seconds; returns bin centre times (seconds from the first sample)
+    and the band power matrix, so state thresholds can be changed without filtering the data again.'''
+    q = max(1, int(fs // target_fs))
+    data = np.asarray(data, dtype=float)
+    if q > 1:
+        data = signal.resample_poly(data, 1, q)
+    fs = fs / q
+    nperseg = int(window_len * fs)
+    f, t, Sxx = signal.spectrogram(data, fs=fs, nperseg=nperseg, noverlap=nperseg - int(step * fs), detrend='constant')
+    band_power = np.vstack([Sxx[(f >= low) & (f <= high)].mean(axis=0) for low, high in bands])
+    return t, band_power
+
+def hysteresis_state(x, low_thres, high_thres):
+    '''Two-threshold state: switches on when x > high_thres and stays on until x < low_thres.
+    The last threshold crossing before each sample is found with a running maximum, no loop over samples.'''
+    x = np.asarray(x, dtype=float)
+    trigger = np.where(x > high_thres, 1, np.where(x < low_thres, 0, -1))
+    last_trigger = np.maximum.accumulate(np.where(trigger >= 0, np.arange(len(x)), -1))
+    return np.where(last_trigger >= 0, trigger[np.maximum(last_trigger, 0)], 0).astype(np.uint8)
+
+def REM_ranges_from_ratio(ratio, bin_times, n_samples, fs, low_thres=1.0, high_thres=1.5,
+                          min_duration=5, max_gap=2, step=1):
+    '''REM [start, end) sample ranges from a theta/delta ratio per time bin:
+    hysteresis thresholds, bouts separated by <= max_gap seconds merged, bouts shorter than min_duration seconds dropped.
+    Cheap enough to sweep the thresholds on the same ratio.'''
+    state = hysteresis_state(ratio, low_thres, high_thres)
+    bin_ranges = merge_index_ranges(index_ranges_from_label(state), int(round(max_gap / step)), int(round(min_duration / step)))
+    if len(bin_ranges) == 0:
+        return bin_ranges
+    bin_times = np.asarray(bin_times, dtype=float)
+    starts = np.round((bin_times[bin_ranges[:, 0]] - step / 2) * fs)
+    ends = np.round((bin_times[bin_ranges[:, 1] - 1] + step / 2) * fs)
+    return normalise_index_ranges(np.clip(np.column_stack((starts, ends)), 0, n_samples))
+
+def get_theta_delta_ratio(lfp, fs, theta_band=(5, 9), delta_band=(1, 4), window_len=2, step=1):
+    '''Theta/delta band power ratio per time bin, see get_band_power_matrix. Returns bin times and the ratio.'''
+    t, band_power = get_band_power_matrix(lfp, fs, [theta_band, delta_band], window_len, step)
+    return t, band_power[0] / band_power[1]
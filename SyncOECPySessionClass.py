@@ -18,11 +18,17 @@ import pynapple as nap
 import MakePlots
 import pynacollada as pyna
 from SPADPhotometryAnalysis import SPADAnalysisTools as OpticalAnlaysis
+import StateLabelTools as StateLabel
+import TrackingTools as Tracking
+import EpochTools as Epoch
+import WaveletCoherence as Coh
+import CorrelationTools as Corr
+import PACTools as PAC
 from scipy.signal import correlate2d
 import pickle
 
 class SyncOEpyPhotometrySession:
-    def __init__(self, SessionPath,recordingName,IsTracking=False,read_aligned_data_from_file=False, recordingMode='py',indicator='GECI'):
+    def __init__(self, SessionPath,recordingName,IsTracking=False,read_aligned_data_from_file=False, recordingMode='py',indicator='GECI',REM_params=None):
         '''
         Parameters
         ----------
@@ -33,6 +39,9 @@ class SyncOEpyPhotometrySession:
             False if it is the first time you analyse this trial of data, 
             once you have removed noises, run the single-trial analysis, saved the .pkl file, 
             set it to true to read aligned data directly.
+        REM_params:
+            keyword arguments of Label_REM_sleep (LFP_channel defaults to 'LFP_2'),
+            e.g. {'method':'envelope'} to reproduce the REM labels (and ripple exclusion) of analyses before the band-power ratio.
         '''
         self.recordingMode=recordingMode
         self.indicator=indicator
@@ -68,7 +77,12 @@ class SyncOEpyPhotometrySession:
             # if self.indicator == 'GEVI':
             #     self.Ephys_tracking_spad_aligned['zscore_raw']=-self.Ephys_tracking_spad_aligned['zscore_raw']  
             self.save_data(self.Ephys_tracking_spad_aligned, 'Ephys_tracking_photometry_aligned.pkl')
-        self.Label_REM_sleep ('LFP_2')
+        'Brain/behavioural states as interval sets ([start, end) sample ranges), e.g. theta, nontheta, REM, nonREM, moving, rest'
+        self.state_index_ranges={}
+        self.Label_REM_sleep (**{'LFP_channel':'LFP_2',**(REM_params or {})})
+        if read_aligned_data_from_file and os.path.exists(os.path.join(self.dpath, 'State_index_ranges.pkl')):
+            'Reuse saved labels (e.g. theta from pynacollada_label_theta(save=True)) with the saved aligned data'
+            self.load_state_index_ranges()
         self.savepath = os.path.join(SessionPath, "Results")
         if not os.path.exists(self.savepath):
             os.makedirs(self.savepath) 
@@ -403,9 +417,10 @@ class SyncOEpyPhotometrySession:
             print ('If not changing, the pipeline will align the length automatically')
         else:
             print ('Yay~~Camera time mask matched! Synchronising LFP and Optical signal finished.') 
-        time_interval_common = 1.0 / self.fs
-        self.trackingdata_resampled = self.trackingdata.resample(f'{time_interval_common:.9f}S').mean()
-        self.trackingdata_resampled = self.trackingdata_resampled.fillna(method='ffill')
+        'Each tracking sample is held until the next one, same as resample().mean() and ffill, without the 10 kHz groupby'
+        hold_index=Tracking.get_hold_index(len(self.trackingdata),self.tracking_fs,self.fs)
+        self.trackingdata_resampled = self.trackingdata.iloc[hold_index]
+        self.trackingdata_resampled.index = pd.to_timedelta(np.arange(len(hold_index))/self.fs, unit='s')
         return self.trackingdata_resampled    
     
     def save_data (self, data,filename):
@@ -463,7 +478,10 @@ class SyncOEpyPhotometrySession:
         return -1
     
     
-    def plot_freq_power_coherence (self,LFP_channel,start_time,end_time,SPAD_cutoff,lfp_cutoff):
+    def plot_freq_power_coherence (self,LFP_channel,start_time,end_time,SPAD_cutoff,lfp_cutoff,n_surrogates=0):
+        '''Wavelet power of both signals and their smoothed wavelet coherence, from one CWT per signal.
+        n_surrogates>0 adds a red-noise Monte-Carlo significance contour, computed in this process
+        (see Coh.wavelet_coherence for a process pool, which needs the if __name__ == '__main__': guard in scripts).'''
         silced_recording=self.slicing_pd_data (self.Ephys_tracking_spad_aligned,start_time=start_time, end_time=end_time)
         #SPAD_smooth= OE.butter_filter(data['zscore_raw'], btype='high', cutoff=0.5, fs=self.fs, order=5)
         SPAD_smooth= OE.smooth_signal(silced_recording['zscore_raw'],Fs=self.fs,cutoff=SPAD_cutoff)
@@ -473,91 +491,41 @@ class SyncOEpyPhotometrySession:
         spad_low = pd.Series(SPAD_smooth, index=silced_recording['zscore_raw'].index)
         lfp_low = pd.Series(lfp_lowpass, index=silced_recording[LFP_channel].index)
         
+        frequency,time,coherence,phase,power_spad,power_lfp,coherence_signif=Coh.wavelet_coherence(
+            spad_low,lfp_low,Fs=self.fs,freq_range=(1.9,50),n_surrogates=n_surrogates)
+        
         fig, ax = plt.subplots(6, 1, figsize=(16, 8))
         OE.plot_trace_in_seconds_ax (ax[0],spad_low,self.fs,label='GEVI',color=sns.color_palette("husl", 8)[3],
                                ylabel='z-score',xlabel=False)
-        #spad_filtered=OE.band_pass_filter(spad_data,120,300,self.fs)
-        sst_spad,frequency,power_spad,global_ws=OE.Calculate_wavelet(spad_low,lowpassCutoff=100,Fs=self.fs,scale=40)
-        OE.plot_wavelet(ax[1],sst_spad,frequency,power_spad,Fs=self.fs,colorBar=False,logbase=False)
-        lfp_low=lfp_low
+        OE.plot_wavelet(ax[1],spad_low,frequency,power_spad,Fs=self.fs,colorBar=False,logbase=False)
         OE.plot_trace_in_seconds_ax (ax[2],lfp_low,self.fs,label='LFP',color=sns.color_palette("dark", 8)[7],ylabel='mV',xlabel=False)
-        #lfp_data_filtered=OE.band_pass_filter(lfp_data,120,300,self.fs)
-        sst_lfp,frequency,power_lfp,global_ws=OE.Calculate_wavelet(lfp_low,lowpassCutoff=500,Fs=self.fs,scale=40)
-        OE.plot_wavelet(ax[3],sst_lfp,frequency,power_lfp,Fs=self.fs,colorBar=False,logbase=False)
-        
-        cross_power = np.abs(power_spad * np.conj(power_lfp))**2
-        coherence = cross_power / (np.abs(power_spad) * np.abs(power_lfp))
+        OE.plot_wavelet(ax[3],lfp_low,frequency,power_lfp,Fs=self.fs,colorBar=False,logbase=False)
         
         ax[1].set_ylim(0,20)
         ax[3].set_ylim(0,20)
         ax[3].set_xlabel('Time (seconds)')
         ax[0].legend().set_visible(False)
         ax[2].legend().set_visible(False)
-        ax[1].spines['top'].set_visible(False)
-        ax[1].spines['right'].set_visible(False)
-        ax[1].spines['bottom'].set_visible(False)
-        ax[1].spines['left'].set_visible(False)
-        ax[3].spines['top'].set_visible(False)
-        ax[3].spines['right'].set_visible(False)
-        ax[3].spines['bottom'].set_visible(False)
-        ax[3].spines['left'].set_visible(False)
+        for i in [1,3]:
+            ax[i].spines['top'].set_visible(False)
+            ax[i].spines['right'].set_visible(False)
+            ax[i].spines['bottom'].set_visible(False)
+            ax[i].spines['left'].set_visible(False)
         ax[2].spines['bottom'].set_visible(False)
-        ax[1].set_xticks([])  # Hide x-axis tick marks
-        ax[1].set_xlabel([])
-        ax[1].set_xlabel('')  # Hide x-axis label
-        ax[2].set_xticks([])  # Hide x-axis tick marks
-        ax[2].set_xlabel([])
-        ax[2].set_xlabel('')  # Hide x-axis label
-        ax[3].set_xticks([])  # Hide x-axis tick marks
-        ax[3].set_xlabel([])
-        ax[3].set_xlabel('')  # Hide x-axis label
+        for i in [1,2,3]:
+            ax[i].set_xticks([])  # Hide x-axis tick marks
+            ax[i].set_xlabel('')  # Hide x-axis label
         
-        time = np.arange(len(sst_spad)) / self.fs  # Construct time array
         level = 8  # Number of contour levels you want
-        # Custom color limits
-        vmin = coherence.min()*1  # Replace with your desired minimum value
-        vmax = coherence.max()*0.9  # Replace with your desired maximum value
-        CS = ax[4].contourf(time, frequency, coherence, level, vmin=vmin, vmax=vmax)
-        #OE.plot_wavelet(ax[4],sst_spad,frequency,coherence,Fs=self.fs,colorBar=True,logbase=True)
-
-        #ax[4].set_yscale('log', base=2, subs=None)
-        ax[4].set_ylim([np.min(frequency), np.max(frequency)])
-        #yax = plt.gca().yaxis
-        #yax.set_major_formatter(ticker.ScalarFormatter())
-
-        ax[4].set_ylim(0,20)
-        ax[4].set_ylabel('Frequency [Hz]')
-        ax[4].set_xlabel('Time [s]')
-        ax[4].set_title('Coherence between SPAD and LFP')
-        
-        SPAD_smooth= OE.smooth_signal(silced_recording['zscore_raw'],Fs=self.fs,cutoff=SPAD_cutoff)
-        SPAD_smooth= OE.butter_filter(SPAD_smooth, btype='high', cutoff=15, fs=self.fs, order=5)
-        lfp_lowpass = OE.butter_filter(silced_recording[LFP_channel], btype='high', cutoff=15, fs=self.fs, order=5)
-        lfp_lowpass = OE.butter_filter(lfp_lowpass, btype='low', cutoff=lfp_cutoff, fs=self.fs, order=5)
-        spad_low = pd.Series(SPAD_smooth, index=silced_recording['zscore_raw'].index)
-        lfp_low = pd.Series(lfp_lowpass, index=silced_recording[LFP_channel].index)
-        
-        sst_spad,frequency,power_spad,global_ws=OE.Calculate_wavelet(spad_low,lowpassCutoff=100,Fs=self.fs,scale=40)
-        
-        sst_lfp,frequency,power_lfp,global_ws=OE.Calculate_wavelet(lfp_low,lowpassCutoff=500,Fs=self.fs,scale=40)
-        
-        cross_power = np.abs(power_spad * np.conj(power_lfp))**2
-        coherence = cross_power / (np.abs(power_spad) * np.abs(power_lfp))
-        
-        vmin = coherence.min()*1  # Replace with your desired minimum value
-        vmax = coherence.max()*0.9  # Replace with your desired maximum value
-        CS = ax[5].contourf(time, frequency, coherence, level, vmin=vmin, vmax=vmax)
-        #OE.plot_wavelet(ax[4],sst_spad,frequency,coherence,Fs=self.fs,colorBar=True,logbase=True)
-
-        #ax[5].set_yscale('log', base=2, subs=None)
-        ax[5].set_ylim([np.min(frequency), np.max(frequency)])
-        #yax = plt.gca().yaxis
-        #yax.set_major_formatter(ticker.ScalarFormatter())
-
-        ax[5].set_ylim(0,50)
-        ax[5].set_ylabel('Frequency [Hz]')
-        ax[5].set_xlabel('Time [s]')
-        ax[5].set_title('Coherence above 15Hz')
+        'The same coherence map is shown for 0-20Hz and 15-50Hz'
+        for i,ylim,title in [(4,(0,20),'Coherence between SPAD and LFP'),(5,(15,50),'Coherence above 15Hz')]:
+            CS = ax[i].contourf(time, frequency, coherence, level, vmin=0, vmax=1)
+            if coherence_signif is not None:
+                ax[i].contour(time, frequency, coherence/coherence_signif[:,np.newaxis], [1], colors='k', linewidths=0.5)
+            ax[i].set_ylim(ylim)
+            ax[i].set_ylabel('Frequency [Hz]')
+            ax[i].set_xlabel('Time [s]')
+            ax[i].set_title(title)
         #plt.tight_layout()
         output_path=os.path.join(self.savepath,'makefigure','example_coherence.png')
         fig.savefig(output_path, bbox_inches='tight', pad_inches=0, transparent=True)
@@ -565,6 +533,16 @@ class SyncOEpyPhotometrySession:
         
         return -1
     
+    def calculate_optical_LFP_coherence (self,LFP_channel,freq_range=(2,50),n_surrogates=0,n_workers=1):
+        '''Wavelet coherence and phase lag between zscore_raw and the LFP over the whole session.
+        Returns frequency, time, coherence, phase and the significance level per frequency (None if n_surrogates=0).
+        n_workers>1 runs the surrogates in a process pool, call it under if __name__ == '__main__': in scripts.'''
+        spad_data=self.Ephys_tracking_spad_aligned['zscore_raw'].to_numpy()
+        lfp_data=self.Ephys_tracking_spad_aligned[LFP_channel].to_numpy()
+        frequency,time,coherence,phase,_,_,coherence_signif=Coh.wavelet_coherence(
+            spad_data,lfp_data,Fs=self.fs,freq_range=freq_range,n_surrogates=n_surrogates,n_workers=n_workers)
+        return frequency,time,coherence,phase,coherence_signif
+    
     def plot_segment_band_feature (self,LFP_channel,start_time,end_time,SPAD_cutoff,lfp_cutoff):
         silced_recording=self.slicing_pd_data (self.Ephys_tracking_spad_aligned,start_time=start_time, end_time=end_time)
         #SPAD_smooth= OE.butter_filter(data['zscore_raw'], btype='high', cutoff=0.5, fs=self.fs, order=5)
@@ -696,12 +674,13 @@ class SyncOEpyPhotometrySession:
         OE.plot_trace_in_seconds_ax (ax[0],spad_data,self.fs,label=spad_label,color=sns.color_palette("husl", 8)[3],
                                ylabel='z-score',xlabel=False)
         #spad_filtered=OE.band_pass_filter(spad_data,120,300,self.fs)
-        sst,frequency,power,global_ws=OE.Calculate_wavelet(spad_data,lowpassCutoff=100,Fs=self.fs,scale=40)
+        'Only 0-20Hz is shown, so only compute the scales in this band on a decimated signal'
+        sst,frequency,power,global_ws=OE.Calculate_wavelet(spad_data,lowpassCutoff=100,Fs=self.fs,freq_range=(1.9,20))
         OE.plot_wavelet(ax[1],sst,frequency,power,Fs=self.fs,colorBar=False,logbase=False)
         lfp_data=lfp_data/1000
         OE.plot_trace_in_seconds_ax (ax[2],lfp_data,self.fs,label=lfp_label,color=sns.color_palette("husl", 8)[5],ylabel='mV',xlabel=False)
         #lfp_data_filtered=OE.band_pass_filter(lfp_data,120,300,self.fs)
-        sst,frequency,power,global_ws=OE.Calculate_wavelet(lfp_data,lowpassCutoff=500,Fs=self.fs,scale=40)
+        sst,frequency,power,global_ws=OE.Calculate_wavelet(lfp_data,lowpassCutoff=500,Fs=self.fs,freq_range=(1.9,20))
         OE.plot_wavelet(ax[3],sst,frequency,power,Fs=self.fs,colorBar=AddColorbar,logbase=False)
         ax[1].set_ylim(0,20)
         ax[3].set_ylim(0,20)
@@ -729,20 +708,65 @@ class SyncOEpyPhotometrySession:
         plt.show()
         return -1
     
-    def Label_REM_sleep (self,LFP_channel):
+    def Label_REM_sleep (self,LFP_channel,low_thres=1.0,high_thres=1.5,min_duration=5,max_gap=2,method='power_ratio',envelope_thres=1.2):
+        '''REM periods as interval sets, self.state_index_ranges['REM'] and ['nonREM'].
+        method='power_ratio': the theta(5-9 Hz)/delta(1-4 Hz) power ratio is computed once per 1 s bin from a spectrogram of the LFP,
+        then REM starts when the ratio > high_thres, ends when it drops below low_thres,
+        bouts closer than max_gap seconds are merged and bouts shorter than min_duration seconds are dropped.
+        The ratio is kept (self.theta_delta_ratio), so relabel_REM_sleep can try other thresholds without recomputing it.
+        method='envelope': the previous labelling, every sample where the ratio of the z-scored theta and delta envelopes
+        (OE.getThetaDeltaRatio) > envelope_thres, without hysteresis or duration rules.
+        The thresholds of the two methods apply to different quantities, see compare_REM_labelling before pooling sessions.'''
+        if method=='envelope':
+            self.REM_index_ranges=self.get_envelope_REM_ranges(LFP_channel,envelope_thres)
+            self.set_state_index_ranges('REM',self.REM_index_ranges,'nonREM')
+            return self.REM_index_ranges
+        lfp_data=self.Ephys_tracking_spad_aligned[LFP_channel].to_numpy()/1000
+        self.theta_delta_ratio=StateLabel.get_theta_delta_ratio(lfp_data,self.fs)
+        return self.relabel_REM_sleep(low_thres,high_thres,min_duration,max_gap)
+    
+    def get_envelope_REM_ranges (self,LFP_channel,envelope_thres=1.2):
+        '''REM ranges of the previous labelling: z-scored theta/delta envelope ratio (OE.getThetaDeltaRatio) > envelope_thres.'''
         lfp_data=self.Ephys_tracking_spad_aligned[LFP_channel]/1000
-        timestamps=self.Ephys_tracking_spad_aligned['timestamps'].copy()
-        timestamps=timestamps.to_numpy()
+        timestamps=self.Ephys_tracking_spad_aligned['timestamps'].to_numpy()
         LFP=nap.Tsd(t = timestamps, d = lfp_data.to_numpy(), time_units = 's')
         ThetaDeltaRatio=OE.getThetaDeltaRatio (LFP,self.fs,windowlen=1000)
-        self.Ephys_tracking_spad_aligned['REMstate'] = 'nonREM'  # Initialize with 'nonREM'
-        self.Ephys_tracking_spad_aligned.loc[ThetaDeltaRatio > 1.2, 'REMstate'] = 'REM'
-        return ThetaDeltaRatio
+        return StateLabel.index_ranges_from_label(np.asarray(ThetaDeltaRatio)>envelope_thres,value=True)
+    
+    def compare_REM_labelling (self,LFP_channel='LFP_2',envelope_thres=1.2,**kwargs):
+        '''REM fraction of the envelope labelling and of the power-ratio labelling (kwargs: thresholds of relabel_REM_sleep),
+        and the fraction of either REM set shared by both, to calibrate the thresholds on a session.
+        The session labels are not changed.'''
+        n_samples=len(self.Ephys_tracking_spad_aligned)
+        envelope_ranges=self.get_envelope_REM_ranges(LFP_channel,envelope_thres)
+        lfp_data=self.Ephys_tracking_spad_aligned[LFP_channel].to_numpy()/1000
+        bin_times,ratio=StateLabel.get_theta_delta_ratio(lfp_data,self.fs)
+        ratio_ranges=StateLabel.REM_ranges_from_ratio(ratio,bin_times,n_samples,self.fs,**kwargs)
+        envelope_length=StateLabel.index_ranges_length(envelope_ranges)
+        ratio_length=StateLabel.index_ranges_length(ratio_ranges)
+        shared_length=StateLabel.index_ranges_length(StateLabel.intersect_index_ranges(envelope_ranges,ratio_ranges))
+        comparison=pd.Series({'envelope_REM_fraction':envelope_length/n_samples,
+                              'power_ratio_REM_fraction':ratio_length/n_samples,
+                              'shared_of_envelope':shared_length/max(envelope_length,1),
+                              'shared_of_power_ratio':shared_length/max(ratio_length,1)})
+        print (comparison)
+        return comparison
+    
+    def relabel_REM_sleep (self,low_thres=1.0,high_thres=1.5,min_duration=5,max_gap=2):
+        '''REM interval set from the stored theta/delta ratio, e.g. for a threshold sweep.'''
+        bin_times,ratio=self.theta_delta_ratio
+        self.REM_index_ranges=StateLabel.REM_ranges_from_ratio(ratio,bin_times,len(self.Ephys_tracking_spad_aligned),self.fs,
+                                                              low_thres,high_thres,min_duration,max_gap)
+        self.set_state_index_ranges('REM',self.REM_index_ranges,'nonREM')
+        return self.REM_index_ranges
     
     def pynacollada_label_theta (self,LFP_channel,Low_thres=0.2,High_thres=10,save=False,plot_theta=False):
         '''NOTE: 
         I applied the pynacollada ripple-detection method, but with the theta band to extract high-theta period.
         Other period are defined as non-theta.
+        Theta epochs are stored as sample index ranges (self.theta_index_ranges, self.non_theta_index_ranges),
+        also in self.state_index_ranges['theta'] and ['nontheta']. No per-sample column is added to the aligned data.
+        Use get_theta_part()/get_non_theta_part() if a concatenated copy is needed for visualisation.
         '''
         lfp_data=self.Ephys_tracking_spad_aligned[LFP_channel]/1000
         timestamps=self.Ephys_tracking_spad_aligned['timestamps'].copy()
@@ -751,71 +775,126 @@ class SyncOEpyPhotometrySession:
         'To detect theta'
         theta_band_filtered,nSS,nSS3,theta_ep,theta_tsd = OE.getThetaEvents (LFP,self.fs,windowlen=500,Low_thres=Low_thres,High_thres=High_thres)  
         print ('Label theta part, found theta high epoch number---',len(theta_ep))
-        '''METHOD: label theta_ep in the Dataframe'''
-        timestamps_round=np.round(timestamps, 2)
-
-        self.Ephys_tracking_spad_aligned['BrainState']='nontheta'
-        indices_theta_epoch = []
-        for i in range (len(theta_ep)):
-            # print ('ep start---', theta_ep.iloc[[i]]['start'][0])
-            # print ('ep end---', theta_ep.iloc[[i]]['end'][0])
-            indices_theta_epoch_i = np.where((timestamps_round>=theta_ep.iloc[[i]]['start'][0]) & (timestamps_round<theta_ep.iloc[[i]]['end'][0]))[0]
-            indices_theta_epoch.extend(indices_theta_epoch_i.astype(int))
-            
-        self.Ephys_tracking_spad_aligned.iloc[indices_theta_epoch, self.Ephys_tracking_spad_aligned.columns.get_loc('BrainState')]='theta' 
-        self.save_data(self.Ephys_tracking_spad_aligned, 'Ephys_tracking_photometry_aligned.pkl')
-
-        print ('---Theta labelling saved, plotting theta and nontheta features---') 
+        '''METHOD: map theta_ep to sample ranges and label them in one pass'''
+        theta_ep_values=np.asarray(theta_ep.values,dtype=float).reshape(-1,2)
+        self.theta_index_ranges=StateLabel.epochs_to_index_ranges(timestamps,theta_ep_values[:,0],theta_ep_values[:,1])
+        self.non_theta_index_ranges=self.set_state_index_ranges('theta',self.theta_index_ranges,'nontheta')
+        if save:
+            self.save_state_index_ranges()
+            print ('---Theta labelling saved---') 
         '''This will separate theta and non-theta period, but only for visualisation.
         We should not use the separated and concatenated theta/nontheta periods for other analysis,
         because it will cut and concatenate the LFP and optical signals arbitrarily'''
-        self.theta_part=self.Ephys_tracking_spad_aligned.iloc[indices_theta_epoch]
-        self.non_theta_part=self.Ephys_tracking_spad_aligned[self.Ephys_tracking_spad_aligned['BrainState'] == 'nontheta']
-        self.theta_part=self.theta_part.reset_index(drop=True)
-        self.non_theta_part=self.non_theta_part.reset_index(drop=True)
-        'Save the theta part with real indices'
-        if save:
-            theta_path=os.path.join(self.dpath, "theta_part_with_index.pkl")
-            self.theta_part.to_pickle(theta_path) 
-            non_theta_path=os.path.join(self.dpath, "non_theta_part_with_index.pkl")
-            self.non_theta_part.to_pickle(non_theta_path)
-        #From here,I reset the index, concatenate the theta part and non-theta part just for plotting and show the features
         if plot_theta:
-            time_interval = 1.0 / self.fs
-            total_duration = len(self.non_theta_part) * time_interval
-            timestamps = np.arange(0, total_duration, time_interval)
-            if len(self.non_theta_part)>len(timestamps):
-                self.non_theta_part=self.non_theta_part[:len(timestamps)]
-            elif len(self.non_theta_part)<len(timestamps):
-                timestamps=timestamps[:len(self.non_theta_part)]   
-            # Convert the 'time_column' to timedelta if it's not already
-            self.non_theta_part['time_column'] = pd.to_timedelta(timestamps,unit='s') 
-            # Set the index to the 'time_column'
-            self.non_theta_part.set_index('time_column', inplace=True)
-            
-            total_duration = len(self.theta_part) * time_interval
-            timestamps = np.arange(0, total_duration, time_interval)
-            if len(self.theta_part)>len(timestamps):
-                self.theta_part=self.theta_part[:len(timestamps)]
-            elif len(self.theta_part)<len(timestamps):
-                timestamps=timestamps[:len(self.theta_part)]   
-            self.theta_part['time_column'] = pd.to_timedelta(timestamps, unit='s') 
-            self.theta_part.set_index('time_column', inplace=True)      
-            
+            print ('---Plotting theta and nontheta features---') 
+            theta_part=self.get_theta_part()
+            non_theta_part=self.get_non_theta_part()
             #plot theta
-            sst,frequency,power,global_ws=OE.Calculate_wavelet(self.theta_part[LFP_channel]/1000,lowpassCutoff=500,Fs=self.fs)
+            sst,frequency,power,global_ws=OE.Calculate_wavelet(theta_part[LFP_channel]/1000,lowpassCutoff=500,Fs=self.fs)
             time = np.arange(len(sst)) *(1/self.fs)
-            OE.plot_wavelet_feature(sst,frequency,power,global_ws,time,self.theta_part[LFP_channel])
-            #self.plot_lowpass_two_trace (self.theta_part, LFP_channel,SPAD_cutoff=20,lfp_cutoff=20)
+            OE.plot_wavelet_feature(sst,frequency,power,global_ws,time,theta_part[LFP_channel])
             #plot non-theta
-            sst,frequency,power,global_ws=OE.Calculate_wavelet(self.non_theta_part[LFP_channel]/1000,lowpassCutoff=500,Fs=self.fs)
+            sst,frequency,power,global_ws=OE.Calculate_wavelet(non_theta_part[LFP_channel]/1000,lowpassCutoff=500,Fs=self.fs)
             time = np.arange(len(sst)) *(1/self.fs)
-            OE.plot_wavelet_feature(sst,frequency,power,global_ws,time,self.non_theta_part[LFP_channel])
-            #self.plot_lowpass_two_trace (self.non_theta_part, LFP_channel,SPAD_cutoff=20,lfp_cutoff=20)
-        return self.theta_part,self.non_theta_part
+            OE.plot_wavelet_feature(sst,frequency,power,global_ws,time,non_theta_part[LFP_channel])
+        return self.theta_index_ranges,self.non_theta_index_ranges
+    
+    def get_theta_part (self):
+        'Concatenated copy of the theta periods, index reset. For visualisation only.'
+        return StateLabel.take_index_ranges(self.Ephys_tracking_spad_aligned,self.theta_index_ranges)
+    
+    def get_non_theta_part (self):
+        'Concatenated copy of the non-theta periods, index reset. For visualisation only.'
+        return StateLabel.take_index_ranges(self.Ephys_tracking_spad_aligned,self.non_theta_index_ranges)
+    
+    def label_movement (self,speed_threshold=2,min_duration=1,max_gap=0.5):
+        '''Label moving periods (speed > speed_threshold cm/s) as [start, end) sample ranges on the aligned timebase,
+        self.movement_index_ranges and self.rest_index_ranges.
+        The held speed column is read at the tracking rate (one sample per tracking frame),
+        so gap merging and the min_duration check run on the 10 Hz trace, see TrackingTools.get_movement_ranges.'''
+        n_samples=len(self.Ephys_tracking_spad_aligned)
+        step=int(round(self.fs/self.tracking_fs))
+        speed=self.Ephys_tracking_spad_aligned['speed'].to_numpy()[::step]
+        movement_ranges=Tracking.get_movement_ranges(speed,self.tracking_fs,speed_threshold,min_duration,max_gap)
+        self.movement_index_ranges=Tracking.tracking_ranges_to_index_ranges(movement_ranges,self.tracking_fs,self.fs,n_samples=n_samples)
+        self.rest_index_ranges=self.set_state_index_ranges('moving',self.movement_index_ranges,'rest')
+        return self.movement_index_ranges,self.rest_index_ranges
+    
+    def set_state_index_ranges (self,state,index_ranges,complement_state=None):
+        '''Store a state as an interval set, and its complement on the aligned timebase if complement_state is given.
+        Returns the complement (or the stored ranges).'''
+        n_samples=len(self.Ephys_tracking_spad_aligned)
+        self.state_index_ranges[state]=StateLabel.normalise_index_ranges(index_ranges)
+        if complement_state is None:
+            return self.state_index_ranges[state]
+        self.state_index_ranges[complement_state]=StateLabel.complement_index_ranges(self.state_index_ranges[state],n_samples)
+        return self.state_index_ranges[complement_state]
+    
+    def get_state_index_ranges (self,*states,start_time=None,end_time=None):
+        '''Intersection of the named states, e.g. ('nontheta','nonREM','rest'), optionally restricted to [start_time, end_time) seconds.'''
+        index_ranges=np.array([[0,len(self.Ephys_tracking_spad_aligned)]],dtype=np.int64)
+        for state in states:
+            index_ranges=StateLabel.intersect_index_ranges(index_ranges,self.state_index_ranges[state])
+        if start_time is not None or end_time is not None:
+            timestamps=self.Ephys_tracking_spad_aligned['timestamps'].to_numpy()
+            start=0 if start_time is None else np.searchsorted(timestamps,start_time,side='left')
+            end=len(timestamps) if end_time is None else np.searchsorted(timestamps,end_time,side='left')
+            index_ranges=StateLabel.restrict_index_ranges(index_ranges,start,end)
+        return index_ranges
+    
+    def get_state_part (self,*states):
+        'Concatenated copy of the samples in all the named states, index reset. For visualisation only.'
+        return StateLabel.take_index_ranges(self.Ephys_tracking_spad_aligned,self.get_state_index_ranges(*states))
+    
+    def get_events_near_state (self,event_times,state,max_distance=0.01):
+        '''True for every event time (seconds) with a sample of state within max_distance seconds.'''
+        timestamps=self.Ephys_tracking_spad_aligned['timestamps'].to_numpy()
+        event_times=np.asarray(event_times,dtype=float)
+        starts=np.searchsorted(timestamps,event_times-max_distance,side='left')
+        ends=np.searchsorted(timestamps,event_times+max_distance,side='right')
+        return StateLabel.overlaps_index_ranges(self.state_index_ranges[state],starts,ends)
+    
+    def drop_events_near_state (self,rip_ep,rip_tsd,state,max_distance=0.01):
+        '''Remove detected events (IntervalSet rip_ep and peak Tsd rip_tsd) whose peak is within max_distance seconds of state.'''
+        peak_times=np.asarray(rip_tsd.index)
+        near_state=self.get_events_near_state(peak_times,state,max_distance)
+        for peak_time in peak_times[near_state]:
+            print (f'Remove rip_ep near {state}, peak time is --', peak_time)
+        rip_ep = rip_ep.drop(list(np.flatnonzero(near_state)))
+        rip_tsd = rip_tsd.drop(list(peak_times[near_state]))
+        return rip_ep,rip_tsd
+    
+    def save_state_index_ranges (self,filename='State_index_ranges.pkl'):
+        '''Save the interval sets (a few KB) instead of per-sample state columns in the aligned pickle.
+        They are loaded back (load_state_index_ranges) when the session is created with read_aligned_data_from_file=True.'''
+        filepath=os.path.join(self.dpath, filename)
+        with open(filepath, 'wb') as file:
+            pickle.dump(self.state_index_ranges, file)
+        return -1
+    
+    def load_state_index_ranges (self,filename='State_index_ranges.pkl'):
+        '''Load interval sets saved by save_state_index_ranges, replacing the states of the same name.
+        The theta/nontheta, REM and moving/rest attributes are restored too, so get_theta_part etc. work without relabelling.'''
+        filepath=os.path.join(self.dpath, filename)
+        with open(filepath, 'rb') as file:
+            state_index_ranges=pickle.load(file)
+        n_samples=len(self.Ephys_tracking_spad_aligned)
+        for state,index_ranges in state_index_ranges.items():
+            index_ranges=StateLabel.normalise_index_ranges(index_ranges)
+            if len(index_ranges) and index_ranges[-1,1]>n_samples:
+                raise ValueError(f'{filename}: state {state} ends at sample {index_ranges[-1,1]}, '
+                                 f'after the {n_samples} aligned samples, it was saved for other aligned data')
+            self.state_index_ranges[state]=index_ranges
+        attributes={'theta':'theta_index_ranges','nontheta':'non_theta_index_ranges','REM':'REM_index_ranges',
+                    'moving':'movement_index_ranges','rest':'rest_index_ranges'}
+        for state,attribute in attributes.items():
+            if state in state_index_ranges:
+                setattr(self,attribute,self.state_index_ranges[state])
+        print ('---State labels loaded---',list(state_index_ranges))
+        return self.state_index_ranges
     
     def plot_theta_correlation(self,LFP_channel):
-        silced_recording=self.theta_part
+        silced_recording=self.get_theta_part()
         #silced_recording=self.Ephys_tracking_spad_aligned
         silced_recording=silced_recording.reset_index(drop=True)
         #print (silced_recording.index)
@@ -858,40 +937,16 @@ class SyncOEpyPhotometrySession:
         
         if excludeTheta:
             'To remove detected ripples if they are during theta----meaning they are fast gamma'
-            drop_index_ep=[]
-            drop_index_std=[]
-            for i in range (len(rip_ep)):
-                ripple_std_time=rip_tsd.index[i]
-                #close_timestamps_mask = np.abs(data_segment['timestamps'] -data_segment['timestamps'][0]- ripple_std_time) <= 0.01     
-                close_timestamps_mask = np.abs(data_segment['timestamps'] - ripple_std_time) <= 0.01      
-                close_timestamps_df = data_segment[close_timestamps_mask]
-                if 'theta' in close_timestamps_df['BrainState'].values:
-                    drop_index_ep.append(i)
-                    drop_index_std.append(ripple_std_time)
-                    print ('Romeve rip_ep near theta, peak time is --', ripple_std_time)    
-            rip_ep = rip_ep.drop(drop_index_ep)
-            rip_tsd = rip_tsd.drop(drop_index_std)
+            rip_ep,rip_tsd=self.drop_events_near_state(rip_ep,rip_tsd,'theta')
             
         if excludeREM:
             'To remove detected ripples if they are during theta----meaning they are fast gamma'
-            drop_index_ep=[]
-            drop_index_std=[]
-            for i in range (len(rip_ep)):
-                ripple_std_time=rip_tsd.index[i]
-                #close_timestamps_mask = np.abs(data_segment['timestamps'] -data_segment['timestamps'][0]- ripple_std_time) <= 0.01     
-                close_timestamps_mask = np.abs(data_segment['timestamps'] - ripple_std_time) <= 0.01      
-                close_timestamps_df = data_segment[close_timestamps_mask]
-                if 'REM' in close_timestamps_df['REMstate'].values:
-                    drop_index_ep.append(i)
-                    drop_index_std.append(ripple_std_time)
-                    print ('Romeve rip_ep near REM state, peak time is --', ripple_std_time)    
-            rip_ep = rip_ep.drop(drop_index_ep)
-            rip_tsd = rip_tsd.drop(drop_index_std)
+            rip_ep,rip_tsd=self.drop_events_near_state(rip_ep,rip_tsd,'REM')
         
         # Assign a value to the dynamically generated key
         self.ripple_numbers = len(rip_ep)
         'Calculate ripple frequency during non-theta periods'
-        nontheta_length=len(data_segment[data_segment['BrainState'] == 'nontheta'])
+        nontheta_length=StateLabel.index_ranges_length(self.state_index_ranges['nontheta'])
         self.ripple_freq=np.round(self.ripple_numbers/(nontheta_length/self.fs),4)
         
         print('LFP length in seconds:',len(LFP)/self.fs)
@@ -1030,40 +1085,16 @@ class SyncOEpyPhotometrySession:
         
         if excludeTheta:
             'To remove detected ripples if they are during theta----meaning they are fast gamma'
-            drop_index_ep=[]
-            drop_index_std=[]
-            for i in range (len(rip_ep)):
-                ripple_std_time=rip_tsd.index[i]
-                #close_timestamps_mask = np.abs(data_segment['timestamps'] -data_segment['timestamps'][0]- ripple_std_time) <= 0.01     
-                close_timestamps_mask = np.abs(data_segment['timestamps'] - ripple_std_time) <= 0.01      
-                close_timestamps_df = data_segment[close_timestamps_mask]
-                if 'theta' in close_timestamps_df['BrainState'].values:
-                    drop_index_ep.append(i)
-                    drop_index_std.append(ripple_std_time)
-                    print ('Romeve rip_ep near theta, peak time is --', ripple_std_time)    
-            rip_ep = rip_ep.drop(drop_index_ep)
-            rip_tsd = rip_tsd.drop(drop_index_std)
+            rip_ep,rip_tsd=self.drop_events_near_state(rip_ep,rip_tsd,'theta')
             
         if excludeREM:
             'To remove detected ripples if they are during theta----meaning they are fast gamma'
-            drop_index_ep=[]
-            drop_index_std=[]
-            for i in range (len(rip_ep)):
-                ripple_std_time=rip_tsd.index[i]
-                #close_timestamps_mask = np.abs(data_segment['timestamps'] -data_segment['timestamps'][0]- ripple_std_time) <= 0.01     
-                close_timestamps_mask = np.abs(data_segment['timestamps'] - ripple_std_time) <= 0.01      
-                close_timestamps_df = data_segment[close_timestamps_mask]
-                if 'REM' in close_timestamps_df['REMstate'].values:
-                    drop_index_ep.append(i)
-                    drop_index_std.append(ripple_std_time)
-                    print ('Romeve rip_ep near REM state, peak time is --', ripple_std_time)    
-            rip_ep = rip_ep.drop(drop_index_ep)
-            rip_tsd = rip_tsd.drop(drop_index_std)
+            rip_ep,rip_tsd=self.drop_events_near_state(rip_ep,rip_tsd,'REM')
         
         # Assign a value to the dynamically generated key
         self.ripple_numbers = len(rip_ep)
         'Calculate ripple frequency during non-theta periods'
-        nontheta_length=len(data_segment[data_segment['BrainState'] == 'nontheta'])
+        nontheta_length=StateLabel.index_ranges_length(self.state_index_ranges['nontheta'])
         self.ripple_freq=np.round(self.ripple_numbers/(nontheta_length/self.fs),4)
         
         print('LFP length in seconds:',len(LFP)/self.fs)
@@ -1214,56 +1245,20 @@ class SyncOEpyPhotometrySession:
         
         if excludeTheta:
             'To remove detected ripples if they are during theta----meaning they are fast gamma'
-            drop_index_ep=[]
-            drop_index_std=[]
-            for i in range (len(rip_ep)):
-                ripple_std_time=rip_tsd.index[i]
-                #close_timestamps_mask = np.abs(data_segment['timestamps'] -data_segment['timestamps'][0]- ripple_std_time) <= 0.01     
-                close_timestamps_mask = np.abs(data_segment['timestamps'] - ripple_std_time) <= 0.01      
-                close_timestamps_df = data_segment[close_timestamps_mask]
-                if 'theta' in close_timestamps_df['BrainState'].values:
-                    drop_index_ep.append(i)
-                    drop_index_std.append(ripple_std_time)
-                    print ('Romeve rip_ep near theta, peak time is --', ripple_std_time)    
-            rip_ep = rip_ep.drop(drop_index_ep)
-            rip_tsd = rip_tsd.drop(drop_index_std)
+            rip_ep,rip_tsd=self.drop_events_near_state(rip_ep,rip_tsd,'theta')
             
         if excludeNonTheta:
             'To remove detected ripples if they are during theta----meaning they are fast gamma'
-            drop_index_ep=[]
-            drop_index_std=[]
-            for i in range (len(rip_ep)):
-                ripple_std_time=rip_tsd.index[i]
-                #close_timestamps_mask = np.abs(data_segment['timestamps'] -data_segment['timestamps'][0]- ripple_std_time) <= 0.01     
-                close_timestamps_mask = np.abs(data_segment['timestamps'] - ripple_std_time) <= 0.01      
-                close_timestamps_df = data_segment[close_timestamps_mask]
-                if 'nontheta' in close_timestamps_df['BrainState'].values:
-                    drop_index_ep.append(i)
-                    drop_index_std.append(ripple_std_time)
-                    print ('Romeve rip_ep near non-theta, peak time is --', ripple_std_time)    
-            rip_ep = rip_ep.drop(drop_index_ep)
-            rip_tsd = rip_tsd.drop(drop_index_std)
+            rip_ep,rip_tsd=self.drop_events_near_state(rip_ep,rip_tsd,'nontheta')
             
         if excludeREM:
             'To remove detected ripples if they are during theta----meaning they are fast gamma'
-            drop_index_ep=[]
-            drop_index_std=[]
-            for i in range (len(rip_ep)):
-                ripple_std_time=rip_tsd.index[i]
-                #close_timestamps_mask = np.abs(data_segment['timestamps'] -data_segment['timestamps'][0]- ripple_std_time) <= 0.01     
-                close_timestamps_mask = np.abs(data_segment['timestamps'] - ripple_std_time) <= 0.01      
-                close_timestamps_df = data_segment[close_timestamps_mask]
-                if 'REM' in close_timestamps_df['REMstate'].values:
-                    drop_index_ep.append(i)
-                    drop_index_std.append(ripple_std_time)
-                    print ('Romeve rip_ep near REM state, peak time is --', ripple_std_time)    
-            rip_ep = rip_ep.drop(drop_index_ep)
-            rip_tsd = rip_tsd.drop(drop_index_std)
+            rip_ep,rip_tsd=self.drop_events_near_state(rip_ep,rip_tsd,'REM')
         
         # Assign a value to the dynamically generated key
         self.ripple_numbers = len(rip_ep)
         'Calculate ripple frequency during non-theta periods'
-        nontheta_length=len(data_segment[data_segment['BrainState'] == 'nontheta'])
+        nontheta_length=StateLabel.index_ranges_length(self.state_index_ranges['nontheta'])
         self.ripple_freq=np.round(self.ripple_numbers/(nontheta_length/self.fs),4)
         
         print('LFP length in seconds:',len(LFP)/self.fs)
@@ -1521,7 +1516,7 @@ class SyncOEpyPhotometrySession:
         return rip_ep,rip_tsd
     
     def plot_gamma_power_on_theta_cycle(self,LFP_channel):
-        silced_recording=self.theta_part
+        silced_recording=self.get_theta_part()
         silced_recording=silced_recording.reset_index(drop=True)
 
         silced_recording['theta_angle']=OE.calculate_theta_phase_angle(silced_recording[LFP_channel], theta_low=5, theta_high=9)
@@ -1530,7 +1525,8 @@ class SyncOEpyPhotometrySession:
         #print (trough_index)
         
         gamma_band=(55, 80)
-        OE.plot_gamma_power_on_theta(self.fs,silced_recording,LFP_channel,trough_index,half_window=0.2,gamma_band=gamma_band)
+        'Cycle-resolved traces and gamma power, (cycles x frequencies x samples)'
+        self.theta_cycle_gamma=OE.plot_gamma_power_on_theta(self.fs,silced_recording,LFP_channel,trough_index,half_window=0.2,gamma_band=gamma_band)
         
         '''plot correlation using hilbert '''
         zscore=OE.smooth_signal(silced_recording['zscore_raw'], self.fs,100,window='flat')
@@ -1540,41 +1536,67 @@ class SyncOEpyPhotometrySession:
         
         return -1
 
-    def get_mean_corr_two_traces (self, spad_data,lfp_data,corr_window):
-        # corr_window as second
+    def calculate_PAC_comodulogram (self,phase_channel='LFP_1',amplitude_channel='zscore_raw',method='tort',n_surrogates=0,**kwargs):
+        '''PAC comodulogram of phase_channel phase vs amplitude_channel envelope over the whole session, see PACTools.
+        Results are kept in self.PAC_comodulograms[(phase_channel,amplitude_channel)].'''
+        phase_data=self.Ephys_tracking_spad_aligned[phase_channel].to_numpy()
+        amplitude_data=self.Ephys_tracking_spad_aligned[amplitude_channel].to_numpy()
+        result=PAC.calculate_comodulogram(phase_data,amplitude_data,Fs=self.fs,method=method,n_surrogates=n_surrogates,**kwargs)
+        if not hasattr(self,'PAC_comodulograms'):
+            self.PAC_comodulograms={}
+        self.PAC_comodulograms[(phase_channel,amplitude_channel)]=result
+        return result
+    
+    def plot_PAC_comodulograms (self,LFP_channel='LFP_1',method='tort',n_surrogates=0,**kwargs):
+        '''Comodulograms for LFP->LFP, LFP phase->optical amplitude and optical phase->LFP amplitude.'''
+        pairs=[(LFP_channel,LFP_channel,'LFP phase - LFP amplitude'),
+               (LFP_channel,'zscore_raw','LFP phase - optical amplitude'),
+               ('zscore_raw',LFP_channel,'Optical phase - LFP amplitude')]
+        'Each channel is filtered once and shared by the three pairs'
+        signals={channel:self.Ephys_tracking_spad_aligned[channel].to_numpy() for channel in (LFP_channel,'zscore_raw')}
+        results=PAC.calculate_comodulograms(signals,[pair[:2] for pair in pairs],Fs=self.fs,method=method,n_surrogates=n_surrogates,**kwargs)
+        if not hasattr(self,'PAC_comodulograms'):
+            self.PAC_comodulograms={}
+        self.PAC_comodulograms.update(results)
+        label='Mean vector length' if method=='mvl' else 'Modulation index'
+        fig, ax = plt.subplots(1, 3, figsize=(18, 5))
+        for i,(phase_channel,amplitude_channel,title) in enumerate(pairs):
+            phase_freqs,amp_freqs,pac,pac_zscore,pac_pvalue=results[(phase_channel,amplitude_channel)]
+            MakePlots.plot_comodulogram(ax[i],phase_freqs,amp_freqs,pac,pac_pvalue,title=title,label=label)
+        plt.tight_layout()
+        figName=self.recordingName+'_PAC_comodulogram_'+LFP_channel+'.png'
+        fig.savefig(os.path.join(self.savepath,figName))
+        plt.show()
+        return -1
+
+    def get_event_epochs (self,event_peak_times,half_window,columns):
+        '''Gather an (events x window x channels) array around event times (seconds), without changing the DataFrame.
+        Events are mapped to the closest sample with searchsorted, events within half_window of the recording ends are dropped.'''
+        timestamps=self.Ephys_tracking_spad_aligned['timestamps'].to_numpy()
+        centre_index=Epoch.get_event_index(timestamps,event_peak_times,half_window,fs=self.fs)
+        channel_data=[self.Ephys_tracking_spad_aligned[column].to_numpy() for column in columns]
+        return Epoch.extract_event_epochs(channel_data,centre_index,int(half_window*self.fs))
+    
+    def get_mean_corr_two_traces (self, spad_data,lfp_data,corr_window,max_lag=None,overlap=1,plotShade='std'):
+        '''Mean cross-correlation of windows of corr_window seconds every overlap seconds.
+        All windows are correlated in one batched FFT, max_lag (seconds) limits the lags that are computed.'''
         total_seconds=len(spad_data)/self.fs
         print('total_second:',total_seconds)
-        overlap=1
-        total_num=int((total_seconds-corr_window)/overlap)+1
-        print('total_num:',total_num)
-        if type(spad_data) is pd.Series:
-            spad_data_np=spad_data.to_numpy()
-        elif type(spad_data) is np.ndarray:
-                spad_data_np=spad_data
-        if type(lfp_data) is pd.Series:
-            lfp_data_np=lfp_data.to_numpy()
-        elif type(lfp_data) is np.ndarray:
-                lfp_data_np=lfp_data
-        
-        cross_corr_values = []
-        for i in range(total_num):
-            start_time = i * overlap
-            end_time = start_time + corr_window  
-            spad_1=self.slicing_np_data (spad_data_np,start_time=start_time, end_time=end_time)
-            lfp_1=self.slicing_np_data (lfp_data_np,start_time=start_time, end_time=end_time)
-            lags,cross_corr =OE.calculate_correlation_with_detrend (spad_1,lfp_1)
-            #cross_corr = signal.correlate(spad_1, lfp_1, mode='full')
-            cross_corr_values.append(cross_corr)
-            
-        cross_corr_values = np.array(cross_corr_values)
-        mean_cross_corr = np.mean(cross_corr_values, axis=0)
-        std_cross_corr = np.std(cross_corr_values, axis=0)
+        spad_data_np=np.asarray(spad_data)
+        lfp_data_np=np.asarray(lfp_data)
+        max_lag_len=None if max_lag is None else int(max_lag*self.fs)
+        lags,mean_cross_corr,std_cross_corr,CI_cross_corr,cross_corr_values=Corr.sliding_window_correlation_stats(
+            spad_data_np,lfp_data_np,int(corr_window*self.fs),int(overlap*self.fs),max_lag=max_lag_len)
+        print('total_num:',len(cross_corr_values))
         
         x = lags/self.fs
         
         plt.figure(figsize=(10, 5))
         plt.plot(x, mean_cross_corr, color='b', label='Mean Cross-Correlation')
-        plt.fill_between(x, mean_cross_corr - std_cross_corr, mean_cross_corr + std_cross_corr, color='gray', alpha=0.3, label='Standard Deviation')
+        if plotShade=='CI':
+            plt.fill_between(x, CI_cross_corr[0], CI_cross_corr[1], color='gray', alpha=0.3, label='0.95 CI')
+        else:
+            plt.fill_between(x, mean_cross_corr - std_cross_corr, mean_cross_corr + std_cross_corr, color='gray', alpha=0.3, label='Standard Deviation')
         plt.xlabel('Lags(seconds)')
         plt.ylabel('Cross-Correlation')
         plt.title('Mean Cross-Correlation with Standard Deviation')
@@ -1590,77 +1612,34 @@ class SyncOEpyPhotometrySession:
             savename='_RipplePeak_'
             cutoff=200
             
-        timestamps=self.Ephys_tracking_spad_aligned['timestamps']
-        z_score_values = []
-        LFP_values_1=[]
-        LFP_values_2=[]
-        LFP_values_3=[]
-        LFP_values_4=[]
-        peak_values =[]
-        peak_indexs = []
-        peak_stds = []
         zscore_peak_window=half_window
         half_window_len=int(zscore_peak_window*self.fs)
-
+        'Gather (events x window x channels) epochs, channel order: zscore_raw, LFP_1..LFP_4'
+        event_epochs=self.get_event_epochs (event_peak_times,half_window,['zscore_raw','LFP_1','LFP_2','LFP_3','LFP_4'])
+        z_score=Epoch.smooth_epochs(event_epochs[:,:,0],int(self.fs/cutoff))
+        z_score_values=Epoch.normalise_epochs(z_score)
+        LFP_values=Epoch.normalise_epochs(event_epochs[:,:,1:],axis=1)
+        LFP_values_1=LFP_values[:,:,0]
+        LFP_values_2=LFP_values[:,:,1]
+        LFP_values_3=LFP_values[:,:,2]
+        LFP_values_4=LFP_values[:,:,3]
+        #Calculate optical peak triggerred by ripple peak
+        if self.indicator=='GECI':
+            peak_values, peak_indexs, peak_stds=Epoch.find_epoch_peaks(z_score_values,half_window_len,mode='max')
+        else:
+            peak_values, peak_indexs, peak_stds=Epoch.find_epoch_peaks(z_score_values,half_window_len,mode='min')
         if plot_single_trace:
             fig, ax = plt.subplots(1, 1, figsize=(8, 4))
-        for i in range(len(event_peak_times)):
-            if event_peak_times[i]>=half_window and event_peak_times[i]<=timestamps.iloc[-1]-half_window:
-                self.Ephys_tracking_spad_aligned['abs_diff'] = abs(self.Ephys_tracking_spad_aligned['timestamps'] - event_peak_times[i])
-                closest_index = self.Ephys_tracking_spad_aligned['abs_diff'].idxmin()
-                start_idx=closest_index-int(half_window*self.fs)
-                end_idx=closest_index+int(half_window*self.fs)
-                segment_data = self.Ephys_tracking_spad_aligned[start_idx:end_idx]
-                segment_zscore=segment_data['zscore_raw']
-                z_score=OE.smooth_signal(segment_zscore,Fs=self.fs,cutoff=cutoff)
-                #z_score=segment_zscore.to_numpy()
-                # normalise to zscore
-                normalized_z_score = OE.getNormalised (z_score)
-                #normalized_z_score = z_score
-                z_score_values.append(normalized_z_score) 
-                
-                segment_LFP_1=segment_data['LFP_1']
-                segment_LFP_2=segment_data['LFP_2']
-                segment_LFP_3=segment_data['LFP_3']
-                segment_LFP_4=segment_data['LFP_4']
-                
-                LFP_normalised_1=OE.getNormalised (segment_LFP_1)
-                LFP_normalised_2=OE.getNormalised (segment_LFP_2)
-                LFP_normalised_3=OE.getNormalised (segment_LFP_3)
-                LFP_normalised_4=OE.getNormalised (segment_LFP_4)
-              
-                LFP_values_1.append(LFP_normalised_1)
-                LFP_values_2.append(LFP_normalised_2)
-                LFP_values_3.append(LFP_normalised_3)
-                LFP_values_4.append(LFP_normalised_4)
-                #Calculate optical peak triggerred by ripple peak
-                mididx=int(len(normalized_z_score)/2)
-                if self.indicator=='GECI':
-                    peak_value, peak_index, peak_std=OE.find_peak_and_std(normalized_z_score[mididx-half_window_len:mididx+half_window_len],half_window_len,mode='max')
-                else:
-                    peak_value, peak_index, peak_std=OE.find_peak_and_std(normalized_z_score[mididx-half_window_len:mididx+half_window_len],half_window_len,mode='min')
-                    
-                peak_values.append(peak_value)
-                peak_indexs.append(peak_index)
-                peak_stds.append(peak_std)
-                if plot_single_trace:
-                    x = np.linspace(-half_window, half_window, len(z_score))
-                    ax.plot(x,normalized_z_score)
-        if plot_single_trace:
+            x = np.linspace(-half_window, half_window, z_score_values.shape[1])
+            ax.plot(x,z_score_values.T)
             [plt.axvline(x=0, color='green')]
             plt.xlabel('Time(seconds)')
             plt.ylabel('z-score')
             plt.title(f'{mode} triggered optical traces')
             plt.show()
         
-        z_score_values = np.array(z_score_values)
         mean_z_score,std_z_score, CI_z_score=OE.calculateStatisticNumpy (z_score_values)
         
-        LFP_values_1 = np.array(LFP_values_1)
-        LFP_values_2 = np.array(LFP_values_2)
-        LFP_values_3 = np.array(LFP_values_3)
-        LFP_values_4 = np.array(LFP_values_4)
-        
         mean_LFP_1,std_LFP_1, CI_LFP_1=OE.calculateStatisticNumpy (LFP_values_1)
         mean_LFP_2,std_LFP_2, CI_LFP_2=OE.calculateStatisticNumpy (LFP_values_2)
         mean_LFP_3,std_LFP_3, CI_LFP_3=OE.calculateStatisticNumpy (LFP_values_3)
@@ -1693,10 +1672,7 @@ class SyncOEpyPhotometrySession:
         plt.tight_layout()
         plt.show()
         
-        peak_values=np.array(peak_values)
-        peak_indexs=np.array(peak_indexs)
-        peak_times=peak_indexs/self.fs-zscore_peak_window
-        peak_stds=np.array(peak_stds)
+        peak_times=Epoch.get_peak_latency(peak_indexs,self.fs,zscore_peak_window)
         if mode=='ripple':
             self.ripple_triggered_zscore_values=z_score_values
             self.ripple_triggered_LFP_values_1=LFP_values_1
@@ -1738,70 +1714,29 @@ class SyncOEpyPhotometrySession:
             savename='_ThetaPeak_'
             cutoff=20
                  
-        timestamps=self.Ephys_tracking_spad_aligned['timestamps']
-        z_score_values = []
-        LFP_values_1=[]
-        LFP_values_2=[]
-        LFP_values_3=[]
-        LFP_values_4=[]
-        peak_values =[]
-        peak_indexs = []
-        peak_stds = []
         zscore_peak_window=half_window
         half_window_len=int(zscore_peak_window*self.fs)
-
+        'Gather (events x window x channels) epochs, channel order: zscore_raw, LFP_1..LFP_4'
+        event_epochs=self.get_event_epochs (event_peak_times,half_window,['zscore_raw','LFP_1','LFP_2','LFP_3','LFP_4'])
+        z_score=Epoch.smooth_epochs(event_epochs[:,:,0],int(self.fs/cutoff))
+        #z_score=OE.butter_filter(segment_zscore, btype='low', cutoff=cutoff, fs=self.fs, order=5)
+        # normalise to zscore
+        z_score_values=Epoch.normalise_epochs(z_score)
+        LFP_smooth=Epoch.smooth_epochs(event_epochs[:,:,1:],int(self.fs/500),axis=1)
+        LFP_values=Epoch.normalise_epochs(LFP_smooth,axis=1)
+        LFP_values_1=LFP_values[:,:,0]
+        LFP_values_2=LFP_values[:,:,1]
+        LFP_values_3=LFP_values[:,:,2]
+        LFP_values_4=LFP_values[:,:,3]
+        #Calculate optical peak triggerred by ripple peak
+        if self.indicator=='GECI':
+            peak_values, peak_indexs, peak_stds=Epoch.find_epoch_peaks(z_score_values,half_window_len,mode='max')
+        else:
+            peak_values, peak_indexs, peak_stds=Epoch.find_epoch_peaks(z_score_values,half_window_len,mode='min')
         if plot_single_trace:
             fig, ax = plt.subplots(1, 1, figsize=(8, 4))
-        for i in range(len(event_peak_times)):
-            if event_peak_times[i]-timestamps[0]>=half_window and event_peak_times[i]<=timestamps.iloc[-1]-half_window:
-                #print ('Trial:',i,'-event_peak_times is:',event_peak_times[i])
-                #print ('timestamps[0]:',timestamps[0])
-                self.Ephys_tracking_spad_aligned['abs_diff'] = abs(self.Ephys_tracking_spad_aligned['timestamps'] - event_peak_times[i])
-                closest_index = self.Ephys_tracking_spad_aligned['abs_diff'].idxmin()
-                start_idx=closest_index-int(half_window*self.fs)
-                end_idx=closest_index+int(half_window*self.fs)
-                segment_data = self.Ephys_tracking_spad_aligned[start_idx:end_idx]
-                segment_zscore=segment_data['zscore_raw']
-                z_score=OE.smooth_signal(segment_zscore,Fs=self.fs,cutoff=cutoff)
-                #z_score=OE.butter_filter(segment_zscore, btype='low', cutoff=cutoff, fs=self.fs, order=5)
-                #z_score=segment_zscore.to_numpy()
-                # normalise to zscore
-                normalized_z_score = OE.getNormalised (z_score)
-                #normalized_z_score = z_score
-                z_score_values.append(normalized_z_score) 
-                
-                segment_LFP_1=segment_data['LFP_1']
-                segment_LFP_2=segment_data['LFP_2']
-                segment_LFP_3=segment_data['LFP_3']
-                segment_LFP_4=segment_data['LFP_4']
-                
-                LFP_smooth_1=OE.smooth_signal(segment_LFP_1,Fs=self.fs,cutoff=500)
-                LFP_smooth_2=OE.smooth_signal(segment_LFP_2,Fs=self.fs,cutoff=500)
-                LFP_smooth_3=OE.smooth_signal(segment_LFP_3,Fs=self.fs,cutoff=500)
-                LFP_smooth_4=OE.smooth_signal(segment_LFP_4,Fs=self.fs,cutoff=500)
-                LFP_normalised_1=OE.getNormalised (LFP_smooth_1)
-                LFP_normalised_2=OE.getNormalised (LFP_smooth_2)
-                LFP_normalised_3=OE.getNormalised (LFP_smooth_3)
-                LFP_normalised_4=OE.getNormalised (LFP_smooth_4)
-              
-                LFP_values_1.append(LFP_normalised_1)
-                LFP_values_2.append(LFP_normalised_2)
-                LFP_values_3.append(LFP_normalised_3)
-                LFP_values_4.append(LFP_normalised_4)
-                #Calculate optical peak triggerred by ripple peak
-                mididx=int(len(normalized_z_score)/2)
-                if self.indicator=='GECI':
-                    peak_value, peak_index, peak_std=OE.find_peak_and_std(normalized_z_score[mididx-half_window_len:mididx+half_window_len],half_window_len,mode='max')
-                else:
-                    peak_value, peak_index, peak_std=OE.find_peak_and_std(normalized_z_score[mididx-half_window_len:mididx+half_window_len],half_window_len,mode='min')
-                    
-                peak_values.append(peak_value)
-                peak_indexs.append(peak_index)
-                peak_stds.append(peak_std)
-                if plot_single_trace:
-                    x = np.linspace(-half_window, half_window, len(z_score))
-                    ax.plot(x,normalized_z_score)
-        if plot_single_trace:
+            x = np.linspace(-half_window, half_window, z_score_values.shape[1])
+            ax.plot(x,z_score_values.T)
             [plt.axvline(x=0, color='green')]
             plt.xlabel('Time(seconds)')
             plt.ylabel('z-score')
@@ -1810,14 +1745,8 @@ class SyncOEpyPhotometrySession:
             plt.savefig(os.path.join(self.savepath,figName))
             plt.show()
         
-        z_score_values = np.array(z_score_values)
         mean_z_score,std_z_score, CI_z_score=OE.calculateStatisticNumpy (z_score_values)
         
-        LFP_values_1 = np.array(LFP_values_1)
-        LFP_values_2 = np.array(LFP_values_2)
-        LFP_values_3 = np.array(LFP_values_3)
-        LFP_values_4 = np.array(LFP_values_4)
-        
         mean_LFP_1,std_LFP_1, CI_LFP_1=OE.calculateStatisticNumpy (LFP_values_1)
         mean_LFP_2,std_LFP_2, CI_LFP_2=OE.calculateStatisticNumpy (LFP_values_2)
         mean_LFP_3,std_LFP_3, CI_LFP_3=OE.calculateStatisticNumpy (LFP_values_3)
@@ -1852,10 +1781,7 @@ class SyncOEpyPhotometrySession:
         fig.savefig(os.path.join(self.savepath, figName))
         plt.show()
         
-        peak_values=np.array(peak_values)
-        peak_indexs=np.array(peak_indexs)
-        peak_times=peak_indexs/self.fs-zscore_peak_window
-        peak_stds=np.array(peak_stds)
+        peak_times=Epoch.get_peak_latency(peak_indexs,self.fs,zscore_peak_window)
         if mode=='ripple':
             self.ripple_triggered_zscore_values=z_score_values
             self.ripple_triggered_LFP_values_1=LFP_values_1
@@ -1897,7 +1823,10 @@ class SyncOEpyPhotometrySession:
         plt.show()
         return -1
     
-    def Oscillation_optical_correlation (self, mode='ripple',lfp_channel='LFP_2', half_window=0.2):
+    def Oscillation_optical_correlation (self, mode='ripple',lfp_channel='LFP_2', half_window=0.2,max_lag=None):
+        '''Cross-correlation between the smoothed zscore and the LFP in every event window.
+        Only lags within +/- max_lag seconds (default half_window) are computed, in one batched FFT,
+        and the (events x lags) array is stored as float32 in ripple/theta_event_corr_array.'''
         if mode=='ripple':
             savename='_Ripple_'
             event_peak_times=self.rip_tsd.index.to_numpy()
@@ -1906,30 +1835,20 @@ class SyncOEpyPhotometrySession:
             savename='_Theta_'
             event_peak_times=self.theta_tsd.index.to_numpy()
             cutoff=20
-        cross_corr_values = []
-        timestamps=self.Ephys_tracking_spad_aligned['timestamps']
-        for i in range(len(event_peak_times)):
-            if event_peak_times[i]-timestamps[0]>=half_window and event_peak_times[i]<=timestamps.iloc[-1]-half_window:
-                self.Ephys_tracking_spad_aligned['abs_diff'] = abs(self.Ephys_tracking_spad_aligned['timestamps'] - event_peak_times[i])
-                closest_index = self.Ephys_tracking_spad_aligned['abs_diff'].idxmin()
-                start_idx=closest_index-int(half_window*self.fs)
-                end_idx=closest_index+int(half_window*self.fs)
-                segment_data = self.Ephys_tracking_spad_aligned[start_idx:end_idx]
-                segment_zscore=segment_data['zscore_raw']
-                segment_LFP=segment_data[lfp_channel]
-                z_score=OE.smooth_signal(segment_zscore,Fs=self.fs,cutoff=cutoff)
-                lags,cross_corr =OE.calculate_correlation_with_detrend (z_score,segment_LFP)
-                cross_corr_values.append(cross_corr)
-        cross_corr_values = np.array(cross_corr_values,dtype=float)
-        # Truncate all columns to the common length   
-        #event_corr_array=OE.align_numpy_array_to_same_length (cross_corr_values)
-        event_corr_array=cross_corr_values
+        if max_lag is None:
+            max_lag=half_window
+        event_epochs=self.get_event_epochs (event_peak_times,half_window,['zscore_raw',lfp_channel])
+        z_score_epochs=Epoch.smooth_epochs(event_epochs[:,:,0],int(self.fs/cutoff))
+        lags,event_corr_array=Corr.batched_cross_correlation(z_score_epochs,event_epochs[:,:,1],
+                                                             max_lag=int(max_lag*self.fs),dtype=np.float32)
         mean_cross_corr,std_cross_corr, CI_cross_corr=OE.calculateStatisticNumpy (event_corr_array)
         if mode=='ripple':
             self.ripple_event_corr_array=event_corr_array
+            self.ripple_event_corr_lags=lags/self.fs
 
         if mode=='theta':
             self.theta_event_corr_array=event_corr_array
+            self.theta_event_corr_lags=lags/self.fs
             # Assuming mean_cross_corr and CI_cross_corr have already been calculated
             max_index = np.argmax(np.abs(mean_cross_corr))
             max_mean = mean_cross_corr[max_index]
@@ -1944,7 +1863,7 @@ class SyncOEpyPhotometrySession:
             # with open(os.path.join(self.dpath,'CI_cross_corr.pkl'), 'wb') as f:
             #     pickle.dump(CI_cross_corr, f)
             
-        x = np.linspace((-len(mean_cross_corr)/2)/self.fs, (len(mean_cross_corr)/2)/self.fs, len(mean_cross_corr))  
+        x = lags/self.fs
         fig, ax = plt.subplots(figsize=(5, 3))
         # Plot the mean cross-correlation
         ax.plot(x, mean_cross_corr, color='#404040', label='Mean Cross Correlation')
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Animal tracking (camera X/Y) to speed and movement state.
+
+The speed pipeline (forward fill of lost positions, speed, jump rejection, back fill,
+rolling median then rolling minimum) runs on NumPy arrays at the tracking rate,
+same result as the pandas chain used before in PreReadBehaviourFolder.
+Movement is returned as [start, end) index ranges at the tracking rate (see StateLabelTools),
+which can be mapped to the 10 kHz aligned timebase without upsampling the speed trace.
+"""
+import warnings
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+import StateLabelTools as StateLabel
+
+def ffill_nan(x):
+    '''Forward fill NaNs along the first axis (leading NaNs stay NaN), like DataFrame.ffill.'''
+    x = np.asarray(x, dtype=float)
+    valid = ~np.isnan(x)
+    index = np.where(valid, np.arange(len(x)).reshape((-1,) + (1,) * (x.ndim - 1)), 0)
+    index = np.maximum.accumulate(index, axis=0)
+    filled = np.take_along_axis(x, index, axis=0)
+    return np.where(np.maximum.accumulate(valid, axis=0), filled, np.nan)
+
+def bfill_nan(x):
+    '''Backward fill NaNs along the first axis (trailing NaNs stay NaN), like Series.bfill.'''
+    return ffill_nan(np.asarray(x)[::-1])[::-1]
+
+def rolling_nan_reduce(x, window_size, func=np.nanmedian):
+    '''Trailing rolling window of window_size samples with min_periods=1, NaNs ignored,
+    like Series.rolling(window_size, min_periods=1).median() for func=np.nanmedian.'''
+    x = np.asarray(x, dtype=float)
+    padded = np.concatenate((np.full(window_size - 1, np.nan), x))
+    with warnings.catch_warnings():
+        'All-NaN windows give NaN, same as pandas'
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return func(sliding_window_view(padded, window_size), axis=-1)
+
+def calculate_speed(X, Y, tracking_fs=10, scale=20, max_speed=20, window_size=5, smooth=True):
+    '''Speed (cm/s) from X/Y pixel positions.
+    Lost positions are forward filled, positions are divided by scale (pixels per cm),
+    speeds above max_speed are tracking jumps and are back filled from the next sample,
+    then (smooth=True) a rolling median and a rolling minimum of window_size samples remove the remaining spikes.
+    Returns X, Y (cm) and speed.'''
+    position = ffill_nan(np.column_stack((X, Y))) / scale
+    speed = np.empty(len(position))
+    speed[0] = np.nan
+    speed[1:] = np.hypot(*np.diff(position, axis=0).T) * tracking_fs
+    speed[speed > max_speed] = np.nan
+    speed = bfill_nan(speed)
+    if smooth:
+        speed = rolling_nan_reduce(speed, window_size, np.nanmedian)
+        speed = rolling_nan_reduce(speed, window_size, np.nanmin)
+    return position[:, 0], position[:, 1], speed
+
+def process_tracking_data(trackingdata, tracking_fs=10, scale=20, max_speed=20, window_size=5, still=False):
+    '''Tracking DataFrame with X, Y (cm) and speed columns from a raw X/Y DataFrame.
+    still=True (sleep, or awake and not moving trials) sets the speed to 0.'''
+    X, Y, speed = calculate_speed(trackingdata['X'].to_numpy(), trackingdata['Y'].to_numpy(),
+                                  tracking_fs, scale, max_speed, window_size)
+    if still:
+        speed = np.zeros(len(speed), dtype=np.int64)
+    return pd.DataFrame({'X': X, 'Y': Y, 'speed': speed}, index=trackingdata.index)
+
+def get_movement_ranges(speed, tracking_fs=10, speed_threshold=2, min_duration=1, max_gap=0.5):
+    '''[start, end) tracking-sample ranges where speed > speed_threshold (cm/s),
+    with gaps up to max_gap seconds merged and movements shorter than min_duration seconds dropped.'''
+    state = (np.nan_to_num(np.asarray(speed, dtype=float)) > speed_threshold).astype(np.uint8)
+    index_ranges = StateLabel.index_ranges_from_label(state, value=1)
+    return StateLabel.merge_index_ranges(index_ranges, int(round(max_gap * tracking_fs)), int(round(min_duration * tracking_fs)))
+
+def tracking_ranges_to_index_ranges(index_ranges, tracking_fs=10, fs=10000, n_samples=None, offset=0):
+    '''Map [start, end) tracking-sample ranges to sample ranges at fs, e.g. on the 10 kHz aligned timebase.
+    offset (samples at fs) is added first, e.g. the dummy samples added before the tracking in slice_to_align_with_min_len.'''
+    index_ranges = np.round(np.asarray(index_ranges, dtype=float).reshape(-1, 2) * fs / tracking_fs).astype(np.int64) + offset
+    if n_samples is not None:
+        index_ranges = np.clip(index_ranges, 0, n_samples)
+    return index_ranges[index_ranges[:, 1] > index_ranges[:, 0]]
+
+def get_hold_index(n_tracking, tracking_fs=10, fs=10000):
+    '''Index of the tracking sample held at every fs sample, from the first to the last tracking sample.
+    Same samples as resampling the tracking to fs with a mean per bin and a forward fill.'''
+    n_samples = int(round((n_tracking - 1) * fs / tracking_fs)) + 1
+    return np.floor(np.arange(n_samples) * tracking_fs / fs + 1e-9).astype(np.int64)
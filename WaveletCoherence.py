@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Wavelet coherence between the optical signal and the LFP.
+
+Both signals are transformed once with the Morlet CWT from waveletFunctions.
+The auto- and cross-spectra are smoothed in time (Gaussian, by FFT) and in scale (boxcar),
+as in Torrence & Webster 1999 and Grinsted et al. 2004, giving the coherence and the phase lag.
+Signals are decimated to the frequency range of interest first, so whole sessions can be used.
+Significance can be estimated by Monte-Carlo with AR(1) red-noise surrogates, in this process by default
+or in a process pool with n_workers>1. Scripts that use n_workers>1 must call it under if __name__ == '__main__':
+(Windows starts workers by re-importing the script).
+"""
+import numpy as np
+from scipy import signal
+from scipy import fft as sp_fft
+from concurrent.futures import ProcessPoolExecutor
+from waveletFunctions import wavelet
+
+def get_decimation_factor(Fs, high_freq, oversample=8):
+    '''Largest integer factor that keeps the sampling rate above oversample*high_freq.'''
+    return max(1, int(Fs // (oversample * high_freq)))
+
+def get_frequencies(freq_range, dj=0.25):
+    '''dj sub-octave frequencies from high to low within freq_range, same order as Calculate_wavelet.'''
+    low_freq, high_freq = freq_range
+    n_scales = int(np.floor(np.log2(high_freq / low_freq) / dj)) + 1
+    return high_freq * 2. ** (-np.arange(n_scales) * dj)
+
+def estimate_lag1(x):
+    '''Lag-1 autocorrelation, used for the red-noise surrogates.'''
+    x = np.asarray(x, dtype=float) - np.mean(x)
+    return np.sum(x[:-1] * x[1:]) / np.sum(x * x)
+
+def smooth_time(W, scale, dt):
+    '''Gaussian smoothing along time with width scale/dt samples for every scale, one batched FFT.'''
+    n = W.shape[-1]
+    npad = sp_fft.next_fast_len(2 * n)
+    k = 2 * np.pi * sp_fft.fftfreq(npad)  # rad/sample
+    kernel = np.exp(-0.5 * ((scale / dt)[:, np.newaxis] * k) ** 2)
+    smoothed = sp_fft.ifft(sp_fft.fft(W, n=npad, axis=-1) * kernel, axis=-1, overwrite_x=True, workers=-1)[..., :n]
+    if np.isrealobj(W):
+        smoothed = smoothed.real
+    return smoothed.astype(W.dtype, copy=False)
+
+def smooth_scale(W, dj, dj0=0.6):
+    '''Boxcar smoothing across scales with width dj0 (in octaves), zero padded like conv2 'same'.'''
+    steps = dj0 / (dj * 2)
+    frac = steps % 1
+    kernel = np.concatenate(([frac], np.ones(2 * int(round(steps)) - 1), [frac]))
+    kernel = kernel / kernel.sum()
+    half = len(kernel) // 2
+    smoothed = np.zeros_like(W)
+    n_scales = W.shape[0]
+    for i, weight in enumerate(kernel):
+        shift = i - half
+        if shift >= 0:
+            smoothed[:n_scales - shift] += weight * W[shift:]
+        else:
+            smoothed[-shift:] += weight * W[:n_scales + shift]
+    return smoothed
+
+def smooth_wavelet_spectrum(W, scale, dt, dj):
+    return smooth_scale(smooth_time(W, scale, dt), dj)
+
+def coherence_from_transforms(wave_x, wave_y, scale, dt, dj):
+    '''Smoothed coherence (0-1) and phase (radians, x leading y is positive) from two CWTs.'''
+    inv_scale = 1 / scale[:, np.newaxis]
+    S_xx = smooth_wavelet_spectrum(np.abs(wave_x) ** 2 * inv_scale, scale, dt, dj)
+    S_yy = smooth_wavelet_spectrum(np.abs(wave_y) ** 2 * inv_scale, scale, dt, dj)
+    S_xy = smooth_wavelet_spectrum(wave_x * np.conj(wave_y) * inv_scale, scale, dt, dj)
+    coherence = np.abs(S_xy) ** 2 / (S_xx * S_yy)
+    phase = np.angle(S_xy)
+    return np.clip(coherence, 0, 1), phase
+
+def wavelet_coherence(x, y, Fs=10000, freq_range=(2, 50), dj=0.25, n_surrogates=0, n_workers=1,
+                      siglvl=0.95, dtype=np.complex64, seed=None):
+    '''Wavelet coherence and phase lag between x and y (e.g. zscore and LFP).
+    Both signals are decimated to ~8x the highest frequency and transformed once.
+    Returns frequency, time, coherence, phase, power_x, power_y and the significance level per frequency
+    (None if n_surrogates=0). Power is in the same units as Calculate_wavelet.
+    n_workers>1 runs the surrogates in a process pool, call it under if __name__ == '__main__': in scripts.'''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    q = get_decimation_factor(Fs, freq_range[1])
+    if q > 1:
+        x = signal.resample_poly(x, 1, q)
+        y = signal.resample_poly(y, 1, q)
+    dt = q / Fs
+    frequency = get_frequencies(freq_range, dj)
+    wave_x, period, scale, coi = wavelet(x, dt, 1, mother='MORLET', freq=frequency, dtype=dtype)
+    wave_y, _, _, _ = wavelet(y, dt, 1, mother='MORLET', freq=frequency, dtype=dtype)
+    coherence, phase = coherence_from_transforms(wave_x, wave_y, scale, dt, dj)
+    'Torrence-Compo power scales with 1/dt, multiply by q to match the power at Fs'
+    power_x = q * np.abs(wave_x) ** 2
+    power_y = q * np.abs(wave_y) ** 2
+    time = np.arange(len(x)) * dt
+    signif = None
+    if n_surrogates > 0:
+        signif = coherence_significance(len(x), estimate_lag1(x), estimate_lag1(y), dt, frequency, dj,
+                                        n_surrogates=n_surrogates, n_workers=n_workers, siglvl=siglvl, seed=seed)
+    return frequency, time, coherence, phase, power_x, power_y, signif
+
+def surrogate_coherence_histogram(n, lag1_x, lag1_y, dt, frequency, dj, n_surrogates, seed, n_bins=300):
+    '''Histogram (scales x n_bins) of the coherence between pairs of AR(1) red-noise surrogates.
+    Top-level function so it can run in a worker process.'''
+    rng = np.random.default_rng(seed)
+    histogram = np.zeros((len(frequency), n_bins), dtype=np.int64)
+    for i in range(n_surrogates):
+        surrogate_x = signal.lfilter([1], [1, -lag1_x], rng.standard_normal(n))
+        surrogate_y = signal.lfilter([1], [1, -lag1_y], rng.standard_normal(n))
+        wave_x, _, scale, _ = wavelet(surrogate_x, dt, 1, mother='MORLET', freq=frequency, dtype=np.complex64)
+        wave_y, _, _, _ = wavelet(surrogate_y, dt, 1, mother='MORLET', freq=frequency, dtype=np.complex64)
+        coherence, _ = coherence_from_transforms(wave_x, wave_y, scale, dt, dj)
+        bin_index = np.minimum((coherence * n_bins).astype(np.int64), n_bins - 1)
+        'Count per scale with one bincount, offset the bins of every scale'
+        offsets = np.arange(len(frequency))[:, np.newaxis] * n_bins
+        histogram += np.bincount((bin_index + offsets).ravel(), minlength=len(frequency) * n_bins).reshape(len(frequency), n_bins)
+    return histogram
+
+def coherence_significance(n, lag1_x, lag1_y, dt, frequency, dj, n_surrogates=300, n_workers=1,
+                           siglvl=0.95, seed=None, max_len=2**15, n_bins=300):
+    '''Monte-Carlo coherence level per frequency exceeded by red noise with probability 1-siglvl.
+    Surrogates run in this process (n_workers=1) or are split over a process pool (needs the __main__ guard in scripts),
+    and are at most max_len samples long since only the distribution per scale is needed.
+    They are drawn in at least 4 seeded jobs, so a seed gives the same level for up to 4 workers.'''
+    n = min(n, max_len)
+    n_workers = n_workers or 1
+    seeds = np.random.SeedSequence(seed).spawn(max(n_workers, 4))
+    counts = np.diff(np.linspace(0, n_surrogates, len(seeds) + 1).astype(int))
+    jobs = [(n, lag1_x, lag1_y, dt, frequency, dj, int(count), seed_i, n_bins)
+            for count, seed_i in zip(counts, seeds) if count > 0]
+    if n_workers <= 1:
+        histograms = [surrogate_coherence_histogram(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            histograms = list(executor.map(surrogate_coherence_histogram, *zip(*jobs)))
+    histogram = np.sum(histograms, axis=0)
+    cdf = np.cumsum(histogram, axis=1) / histogram.sum(axis=1, keepdims=True)
+    bin_edges = np.arange(1, n_bins + 1) / n_bins
+    return bin_edges[np.argmax(cdf >= siglvl, axis=1)]
@@ -19,6 +19,7 @@ dataB.to_csv(dpath+savename, index=False)
 #%%
 import pandas as pd
 import numpy as np
+import TrackingTools as Tracking
 
 # Create a sample DataFrame with X and Y coordinates
 data = {'Time': [1, 2, 3, 4, 5],
@@ -27,14 +28,11 @@ data = {'Time': [1, 2, 3, 4, 5],
 
 df = pd.DataFrame(data)
 
-# Calculate the Euclidean distance (speed) between consecutive points
-dataf = np.sqrt(np.diff(df['X'])**2 + np.diff(df['Y'])**2)
-
-# Add NaN in the first row to match the original DataFrame length
-df['Speed'] = [np.nan] + dataf.tolist()
-
-# Handle missing values (NaN) by filling them with a specific value (e.g., 0)
-df['Speed'].fillna(0, inplace=True)
+# Speed between consecutive points (positions in cm, 1 sample per second here), see TrackingTools.calculate_speed
+_, _, speed = Tracking.calculate_speed(df['X'], df['Y'], tracking_fs=1, scale=1, max_speed=np.inf, smooth=False)
+'calculate_speed back-fills the first sample, the demo keeps 0 for it as before'
+speed[0] = 0
+df['Speed'] = speed
 
 # Print the DataFrame
-print(df)
\ No newline at end of file
+print(df)
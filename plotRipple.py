@@ -7,6 +7,7 @@ Created on Fri Aug 30 12:04:10 2024
 import pandas as pd
 from SyncOECPySessionClass import SyncOEpyPhotometrySession
 import OpenEphysTools as OE
+import EpochTools as Epoch
 import numpy as np
 import os
 import pickle
@@ -17,33 +18,22 @@ import glob
 
 
 def align_ripples (lfps,zscores,start_idx,end_idx,midpoint,Fs=10000):
-    aligned_ripple_band_lfps = np.zeros_like(lfps)
-    aligned_lfps=np.zeros_like(lfps)
-    aligned_zscores=np.zeros_like(lfps)
+    'Filter all epochs in one call (butter_filter works along axis 0), then align every row at once'
+    LFP_ripple_band=OE.band_pass_filter(lfps.T, 130, 250, Fs).T
+    # Find the index of the maximum value in the segment [start_idx:end_idx] of every epoch
+    local_max_idx = np.argmax(LFP_ripple_band[:,start_idx:end_idx],axis=1) + start_idx
+    # Roll every trace so that its max value moves to the midpoint
+    aligned_ripple_band_lfps = Epoch.align_epochs_to_index(LFP_ripple_band,local_max_idx,midpoint)
+    aligned_lfps=Epoch.align_epochs_to_index(lfps,local_max_idx,midpoint)
+    aligned_zscores=Epoch.align_epochs_to_index(zscores,local_max_idx,midpoint)
     fig1, ax1 = plt.subplots(3, 1, figsize=(10, 18))
     fig2, ax2 = plt.subplots(3, 1, figsize=(10, 18))
-    for i in range(lfps.shape[0]):
-        lfp_i=lfps[i]
-        zscore_i=zscores[i]
-        LFP_ripple_band_i=OE.band_pass_filter(lfps[i], 130, 250, Fs)
-        # Find the index of the maximum value in the segment [1000:3000]
-        local_max_idx = np.argmax(LFP_ripple_band_i[start_idx:end_idx]) + start_idx
-        # Calculate the shift needed to align the max value to the midpoint
-        shift = midpoint - local_max_idx  
-        # Roll the trace to align the max value to the center
-        aligned_ripple_lfp_i = np.roll(LFP_ripple_band_i, shift)   
-        aligned_lfp_i=np.roll(lfp_i, shift)   
-        aligned_zscore_i=np.roll(zscore_i, shift)
-        # Store the aligned trace
-        aligned_ripple_band_lfps[i] = aligned_ripple_lfp_i
-        aligned_lfps[i]=aligned_lfp_i
-        aligned_zscores[i]=aligned_zscore_i
-        ax1[0].plot(lfp_i)
-        ax1[1].plot(zscore_i)
-        ax1[2].plot(LFP_ripple_band_i)
-        ax2[0].plot(aligned_lfp_i)
-        ax2[1].plot(aligned_zscore_i)
-        ax2[2].plot(aligned_ripple_lfp_i)
+    ax1[0].plot(lfps.T)
+    ax1[1].plot(zscores.T)
+    ax1[2].plot(LFP_ripple_band.T)
+    ax2[0].plot(aligned_lfps.T)
+    ax2[1].plot(aligned_zscores.T)
+    ax2[2].plot(aligned_ripple_band_lfps.T)
     return aligned_ripple_band_lfps,aligned_lfps,aligned_zscores
     
 def plot_ripple_heatmap(ripple_band_lfps,lfps,zscores,Fs=10000):
@@ -131,7 +121,7 @@ def run_ripple_plot (dpath,LFP_channel,recordingName,savename,Low_thres=0.5):
     '''separate the theta and non-theta parts.
     theta_thres: the theta band power should be bigger than 80% to be defined theta period.
     nonthetha_thres: the theta band power should be smaller than 50% to be defined as theta period.'''
-    theta_part,non_theta_part=Recording1.pynacollada_label_theta (LFP_channel,Low_thres=Low_thres,High_thres=8,save=False,plot_theta=True)
+    theta_ranges,non_theta_ranges=Recording1.pynacollada_label_theta (LFP_channel,Low_thres=Low_thres,High_thres=8,save=False,plot_theta=True)
 
     '''RIPPLE DETECTION
     For a rigid threshold to get larger amplitude ripple events: Low_thres=3, for more ripple events, Low_thres=1'''
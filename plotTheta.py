@@ -8,6 +8,7 @@ Created on Wed Oct 23 12:16:51 2024
 import pandas as pd
 from SyncOECPySessionClass import SyncOEpyPhotometrySession
 import OpenEphysTools as OE
+import EpochTools as Epoch
 import numpy as np
 import os
 import pickle
@@ -16,41 +17,25 @@ import seaborn as sns
 import glob
 
 def align_ripples (lfps,zscores,start_idx,end_idx,midpoint,Fs=10000):
-    ripple_band_lfps_by_phase=np.zeros_like(lfps)
-    aligned_ripple_band_lfps = np.zeros_like(lfps)
-    aligned_lfps=np.zeros_like(lfps)
-    aligned_zscores=np.zeros_like(lfps)
+    'Filter all epochs in one call (butter_filter works along axis 0), then align every row at once'
+    ripple_band_lfps_by_phase=OE.band_pass_filter(lfps.T, 5, 9, Fs).T
+    # # Find the index of the maximum value in the segment [start_idx:end_idx]
+    # local_max_idx = np.argmax(ripple_band_lfps_by_phase[:,start_idx:end_idx],axis=1) + start_idx
+    
+    # Find the index of the minimum value (theta trough) in the segment [start_idx:end_idx] of every epoch
+    local_min_idx = np.argmin(ripple_band_lfps_by_phase[:,start_idx:end_idx],axis=1) + start_idx
+    #Roll every trace so that the trough moves to the midpoint
+    aligned_ripple_band_lfps = Epoch.align_epochs_to_index(ripple_band_lfps_by_phase,local_min_idx,midpoint)
+    aligned_lfps=Epoch.align_epochs_to_index(lfps,local_min_idx,midpoint)
+    aligned_zscores=Epoch.align_epochs_to_index(zscores,local_min_idx,midpoint)
     fig1, ax1 = plt.subplots(3, 1, figsize=(10, 18))
     fig2, ax2 = plt.subplots(3, 1, figsize=(10, 18))
-    for i in range(lfps.shape[0]):
-        lfp_i=lfps[i]
-        zscore_i=zscores[i]
-        LFP_ripple_band_i=OE.band_pass_filter(lfps[i], 5, 9, Fs)
-        # # Find the index of the maximum value in the segment [1000:3000]
-        # local_max_idx = np.argmax(LFP_ripple_band_i[start_idx:end_idx]) + start_idx
-        # # Calculate the shift needed to align the max value to the midpoint
-        # shift = midpoint - local_max_idx  
-        
-        # Find the index of the maximum value in the segment [1000:3000]
-        local_min_idx = np.argmin(LFP_ripple_band_i[start_idx:end_idx]) + start_idx
-        # Calculate the shift needed to align the max value to the midpoint
-        shift = midpoint - local_min_idx  
-        
-        #Roll the trace to align the max value to the center
-        aligned_ripple_lfp_i = np.roll(LFP_ripple_band_i, shift)   
-        aligned_lfp_i=np.roll(lfp_i, shift)   
-        aligned_zscore_i=np.roll(zscore_i, shift)
-        # Store the ripple band and aligned trace
-        ripple_band_lfps_by_phase[i]=LFP_ripple_band_i
-        aligned_ripple_band_lfps[i] = aligned_ripple_lfp_i
-        aligned_lfps[i]=aligned_lfp_i
-        aligned_zscores[i]=aligned_zscore_i
-        ax1[0].plot(lfp_i)
-        ax1[1].plot(zscore_i)
-        ax1[2].plot(LFP_ripple_band_i)
-        ax2[0].plot(aligned_lfp_i)
-        ax2[1].plot(aligned_zscore_i)
-        ax2[2].plot(aligned_ripple_lfp_i)
+    ax1[0].plot(lfps.T)
+    ax1[1].plot(zscores.T)
+    ax1[2].plot(ripple_band_lfps_by_phase.T)
+    ax2[0].plot(aligned_lfps.T)
+    ax2[1].plot(aligned_zscores.T)
+    ax2[2].plot(aligned_ripple_band_lfps.T)
     return aligned_ripple_band_lfps,aligned_lfps,aligned_zscores,ripple_band_lfps_by_phase
     
 def plot_ripple_heatmap(ripple_band_lfps,lfps,zscores,Fs=10000):
@@ -123,20 +108,15 @@ def plot_aligned_ripple_save (save_path,LFP_channel,recordingName,ripple_trigger
     fig_path = os.path.join(save_path, recordingName+LFP_channel+'Theta_aligned_heatmap_300ms.png')
     fig.savefig(fig_path, transparent=True)
     
-    cross_corr_values = []
-    for i in range(len(aligned_lfps)):
-        # segment_z_score=aligned_zscores[i,start_idx:end_idx]
-        # segment_LFP=aligned_lfps[i,start_idx:end_idx]
-        segment_z_score=ripple_triggered_zscores[i,int(midpoint-0.4*Fs):int(midpoint+0.4*Fs)]
-        segment_LFP=ripple_triggered_lfps[i,int(midpoint-0.4*Fs):int(midpoint+0.4*Fs)]
-        lags,cross_corr =OE.calculate_correlation_with_detrend (segment_z_score,segment_LFP)
-        cross_corr_values.append(cross_corr)
-    cross_corr_values = np.array(cross_corr_values,dtype=float)
+    'All events in one batched correlation, lags within +/-0.4s'
+    segment_z_score=ripple_triggered_zscores[:,int(midpoint-0.4*Fs):int(midpoint+0.4*Fs)]
+    segment_LFP=ripple_triggered_lfps[:,int(midpoint-0.4*Fs):int(midpoint+0.4*Fs)]
+    lags,cross_corr_values =OE.calculate_correlation_with_detrend (segment_z_score,segment_LFP,max_lag=int(0.4*Fs))
 
     event_corr_array=cross_corr_values
     mean_cross_corr,std_cross_corr, CI_cross_corr=OE.calculateStatisticNumpy (event_corr_array)
     
-    x = np.linspace((-len(mean_cross_corr)/2)/Fs, (len(mean_cross_corr)/2)/Fs, len(mean_cross_corr))  
+    x = lags/Fs
     fig, ax = plt.subplots(figsize=(5, 3))
     # Plot the mean cross-correlation
     ax.plot(x, mean_cross_corr, color='#404040', label='Mean Cross Correlation')
@@ -259,7 +239,7 @@ def run_theta_plot_all_cycle (dpath,LFP_channel,recordingName,savename,theta_low
     #                                             plot_segment=False,plot_ripple_ep=False)
     
     trough_index=Recording1.plot_theta_correlation(LFP_channel)
-    theta_part=Recording1.theta_part
+    theta_part=Recording1.get_theta_part()
     #theta_part=Recording1.Ephys_tracking_spad_aligned
     theta_zscores_np,theta_lfps_np=OE.get_theta_cycle_value(theta_part, LFP_channel, trough_index, half_window=0.5, fs=Recording1.fs)
     plot_aligned_ripple_save (save_path,LFP_channel,recordingName,theta_lfps_np,theta_zscores_np,Fs=10000)
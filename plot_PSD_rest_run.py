@@ -20,22 +20,22 @@ dpath='F:/2024_OEC_Atlas/1765507_iGlu_Atlas/Day3/'
 recordingName='SavedOpenFieldTrials'
 Recording1=SyncOEpyPhotometrySession(dpath,recordingName,IsTracking=False,read_aligned_data_from_file=True,recordingMode='Atlas',indicator='GECI') 
 LFP_channel='LFP_1'
-theta_part,non_theta_part=Recording1.pynacollada_label_theta (LFP_channel,Low_thres=-1,High_thres=8,save=False,plot_theta=True)
-LFP_theta=Recording1.theta_part[LFP_channel]
+theta_ranges,non_theta_ranges=Recording1.pynacollada_label_theta (LFP_channel,Low_thres=-1,High_thres=8,save=False,plot_theta=True)
+LFP_theta=Recording1.get_theta_part()[LFP_channel]
 
 dpath='F:/2024_OEC_Atlas/1765507_iGlu_Atlas/Day1/'
 recordingName='SavedPreAwakeTrials'
 Recording2=SyncOEpyPhotometrySession(dpath,recordingName,IsTracking=False,read_aligned_data_from_file=True,recordingMode='Atlas',indicator='GECI') 
 LFP_channel='LFP_1'
-theta_part,non_theta_part=Recording2.pynacollada_label_theta (LFP_channel,Low_thres=-1,High_thres=8,save=False,plot_theta=True)
-LFP_nontheta=Recording2.non_theta_part[LFP_channel]
+theta_ranges,non_theta_ranges=Recording2.pynacollada_label_theta (LFP_channel,Low_thres=-1,High_thres=8,save=False,plot_theta=True)
+LFP_nontheta=Recording2.get_non_theta_part()[LFP_channel]
 
 dpath='F:/2024_OEC_Atlas/1765507_iGlu_Atlas/Day3/'
 recordingName='SavedPostSleepTrials'
 Recording3=SyncOEpyPhotometrySession(dpath,recordingName,IsTracking=False,read_aligned_data_from_file=True,recordingMode='Atlas',indicator='GECI') 
 LFP_channel='LFP_1'
-theta_part,non_theta_part=Recording3.pynacollada_label_theta (LFP_channel,Low_thres=-0.5,High_thres=8,save=False,plot_theta=True)
-LFP_sleep=Recording3.non_theta_part[LFP_channel]
+theta_ranges,non_theta_ranges=Recording3.pynacollada_label_theta (LFP_channel,Low_thres=-0.5,High_thres=8,save=False,plot_theta=True)
+LFP_sleep=Recording3.get_non_theta_part()[LFP_channel]
 
 fig, ax = plt.subplots(1, 1, figsize=(3, 6))
 
@@ -43,9 +43,9 @@ OpticalAnlaysis.PSD_plot (LFP_nontheta/1000,fs=Fs,method="welch",color='black',
 OpticalAnlaysis.PSD_plot (LFP_theta/1000,fs=Fs,method="welch",color='black', xlim=[0,100],linewidth=2,linestyle='-',label='LFP-move',ax=ax)
 OpticalAnlaysis.PSD_plot (LFP_sleep/1000,fs=Fs,method="welch",color='black', xlim=[0,100],linewidth=2,linestyle=':',label='LFP-sleep',ax=ax)
 
-optical_theta=Recording1.theta_part['zscore_raw']
-optical_nontheta=Recording2.non_theta_part['zscore_raw']
-optical_sleep=Recording3.non_theta_part['zscore_raw']
+optical_theta=Recording1.get_theta_part()['zscore_raw']
+optical_nontheta=Recording2.get_non_theta_part()['zscore_raw']
+optical_sleep=Recording3.get_non_theta_part()['zscore_raw']
 fig, ax = plt.subplots(1, 1, figsize=(3, 6))
 OpticalAnlaysis.PSD_plot (optical_nontheta,fs=Fs,method="welch",color='tab:green', xlim=[0,100],linewidth=2,linestyle='--',label='iGlu-rest',ax=ax)
 OpticalAnlaysis.PSD_plot (optical_theta,fs=Fs,method="welch",color='tab:green', xlim=[0,100],linewidth=2,linestyle='-',label='iGlu-move',ax=ax)
@@ -57,22 +57,22 @@ dpath='F:/2024_OEC_Atlas/1765010_PVGCaMP8f_Atlas/Day1/'
 recordingName='SavedOpenFieldTrials'
 Recording1=SyncOEpyPhotometrySession(dpath,recordingName,IsTracking=False,read_aligned_data_from_file=True,recordingMode='Atlas',indicator='GECI') 
 LFP_channel='LFP_1'
-theta_part,non_theta_part=Recording1.pynacollada_label_theta (LFP_channel,Low_thres=-1,High_thres=8,save=False,plot_theta=True)
-LFP_theta=Recording1.theta_part[LFP_channel]
+theta_ranges,non_theta_ranges=Recording1.pynacollada_label_theta (LFP_channel,Low_thres=-1,High_thres=8,save=False,plot_theta=True)
+LFP_theta=Recording1.get_theta_part()[LFP_channel]
 
 dpath='F:/2024_OEC_Atlas/1765010_PVGCaMP8f_Atlas/Day1/'
 recordingName='SavedPreAwakeTrials'
 Recording2=SyncOEpyPhotometrySession(dpath,recordingName,IsTracking=False,read_aligned_data_from_file=True,recordingMode='Atlas',indicator='GECI') 
 LFP_channel='LFP_1'
-theta_part,non_theta_part=Recording2.pynacollada_label_theta (LFP_channel,Low_thres=-1,High_thres=8,save=False,plot_theta=True)
-LFP_nontheta=Recording2.non_theta_part[LFP_channel]
+theta_ranges,non_theta_ranges=Recording2.pynacollada_label_theta (LFP_channel,Low_thres=-1,High_thres=8,save=False,plot_theta=True)
+LFP_nontheta=Recording2.get_non_theta_part()[LFP_channel]
 
 dpath='F:/2024_OEC_Atlas/1765010_PVGCaMP8f_Atlas/Day1/'
 recordingName='SavedPostSleepTrials'
 Recording3=SyncOEpyPhotometrySession(dpath,recordingName,IsTracking=False,read_aligned_data_from_file=True,recordingMode='Atlas',indicator='GECI') 
 LFP_channel='LFP_1'
-theta_part,non_theta_part=Recording3.pynacollada_label_theta (LFP_channel,Low_thres=-0.5,High_thres=8,save=False,plot_theta=True)
-LFP_sleep=Recording3.non_theta_part[LFP_channel]
+theta_ranges,non_theta_ranges=Recording3.pynacollada_label_theta (LFP_channel,Low_thres=-0.5,High_thres=8,save=False,plot_theta=True)
+LFP_sleep=Recording3.get_non_theta_part()[LFP_channel]
 
 fig, ax = plt.subplots(1, 1, figsize=(3, 6))
 OpticalAnlaysis.PSD_plot (LFP_sleep/1000,fs=Fs,method="welch",color='black', xlim=[0,100],linewidth=2,linestyle=':',label='LFP-sleep',ax=ax)
@@ -80,9 +80,9 @@ OpticalAnlaysis.PSD_plot (LFP_nontheta/1000,fs=Fs,method="welch",color='black',
 OpticalAnlaysis.PSD_plot (LFP_theta/1000,fs=Fs,method="welch",color='black', xlim=[0,100],linewidth=2,linestyle='-',label='LFP-move',ax=ax)
 
 
-optical_theta=Recording1.theta_part['zscore_raw']
-optical_nontheta=Recording2.non_theta_part['zscore_raw']
-optical_sleep=Recording3.non_theta_part['zscore_raw']
+optical_theta=Recording1.get_theta_part()['zscore_raw']
+optical_nontheta=Recording2.get_non_theta_part()['zscore_raw']
+optical_sleep=Recording3.get_non_theta_part()['zscore_raw']
 fig, ax = plt.subplots(1, 1, figsize=(3, 6))
 OpticalAnlaysis.PSD_plot (optical_nontheta,fs=Fs,method="welch",color='tab:green', xlim=[0,100],linewidth=2,linestyle='--',label='PV-GECI-rest',ax=ax)
 OpticalAnlaysis.PSD_plot (optical_theta,fs=Fs,method="welch",color='tab:green', xlim=[0,100],linewidth=2,linestyle='-',label='PV-GECI-move',ax=ax)
@@ -94,31 +94,31 @@ dpath='F:/2024_OEC_Atlas/1765508_Jedi2p_Atlas/Day3/'
 recordingName='SavedOpenFieldTrials'
 Recording1=SyncOEpyPhotometrySession(dpath,recordingName,IsTracking=False,read_aligned_data_from_file=True,recordingMode='Atlas',indicator='GEVI') 
 LFP_channel='LFP_1'
-theta_part,non_theta_part=Recording1.pynacollada_label_theta (LFP_channel,Low_thres=-1,High_thres=8,save=False,plot_theta=True)
-LFP_theta=Recording1.theta_part[LFP_channel]
+theta_ranges,non_theta_ranges=Recording1.pynacollada_label_theta (LFP_channel,Low_thres=-1,High_thres=8,save=False,plot_theta=True)
+LFP_theta=Recording1.get_theta_part()[LFP_channel]
 
 dpath='F:/2024_OEC_Atlas/1765508_Jedi2p_Atlas/Day3/'
 recordingName='SavedPreAwakeTrials'
 Recording2=SyncOEpyPhotometrySession(dpath,recordingName,IsTracking=False,read_aligned_data_from_file=True,recordingMode='Atlas',indicator='GEVI') 
 LFP_channel='LFP_1'
-theta_part,non_theta_part=Recording2.pynacollada_label_theta (LFP_channel,Low_thres=-1,High_thres=8,save=False,plot_theta=True)
-LFP_nontheta=Recording2.non_theta_part[LFP_channel]
+theta_ranges,non_theta_ranges=Recording2.pynacollada_label_theta (LFP_channel,Low_thres=-1,High_thres=8,save=False,plot_theta=True)
+LFP_nontheta=Recording2.get_non_theta_part()[LFP_channel]
 
 dpath='F:/2024_OEC_Atlas/1765508_Jedi2p_Atlas/Day3/'
 recordingName='SavedPostSleepTrials'
 Recording3=SyncOEpyPhotometrySession(dpath,recordingName,IsTracking=False,read_aligned_data_from_file=True,recordingMode='Atlas',indicator='GEVI') 
 LFP_channel='LFP_1'
-theta_part,non_theta_part=Recording3.pynacollada_label_theta (LFP_channel,Low_thres=-0.5,High_thres=8,save=False,plot_theta=True)
-LFP_sleep=Recording3.non_theta_part[LFP_channel]
+theta_ranges,non_theta_ranges=Recording3.pynacollada_label_theta (LFP_channel,Low_thres=-0.5,High_thres=8,save=False,plot_theta=True)
+LFP_sleep=Recording3.get_non_theta_part()[LFP_channel]
 
 fig, ax = plt.subplots(1, 1, figsize=(3, 6))
 OpticalAnlaysis.PSD_plot (LFP_sleep/1000,fs=Fs,method="welch",color='black', xlim=[0,100],linewidth=2,linestyle=':',label='LFP-sleep',ax=ax)
 OpticalAnlaysis.PSD_plot (LFP_nontheta/1000,fs=Fs,method="welch",color='black', xlim=[0,100],linewidth=2,linestyle='--',label='LFP-rest',ax=ax)
 OpticalAnlaysis.PSD_plot (LFP_theta/1000,fs=Fs,method="welch",color='black', xlim=[0,100],linewidth=2,linestyle='-',label='LFP-move',ax=ax)
 
-optical_theta=Recording1.theta_part['zscore_raw']
-optical_nontheta=Recording2.non_theta_part['zscore_raw']
-optical_sleep=Recording3.non_theta_part['zscore_raw']
+optical_theta=Recording1.get_theta_part()['zscore_raw']
+optical_nontheta=Recording2.get_non_theta_part()['zscore_raw']
+optical_sleep=Recording3.get_non_theta_part()['zscore_raw']
 fig, ax = plt.subplots(1, 1, figsize=(3, 6))
 OpticalAnlaysis.PSD_plot (optical_nontheta,fs=Fs,method="welch",color='tab:green', xlim=[0,100],linewidth=2,linestyle='--',label='GEVI-rest',ax=ax)
 OpticalAnlaysis.PSD_plot (optical_theta,fs=Fs,method="welch",color='tab:green', xlim=[0,100],linewidth=2,linestyle='-',label='GEVI-move',ax=ax)
@@ -130,23 +130,26 @@ dpath='E:/ATLAS_SPAD/1820061_PVcre/Day4/SNR_methods/'
 recordingName='SavedMovingTrials'
 Recording1=SyncOEpyPhotometrySession(dpath,recordingName,IsTracking=False,read_aligned_data_from_file=True,recordingMode='Atlas',indicator='GEVI') 
 LFP_channel='LFP_1'
-theta_part,non_theta_part=Recording1.pynacollada_label_theta (LFP_channel,Low_thres=-0.5,High_thres=8,save=False,plot_theta=True)
-LFP_theta=Recording1.theta_part[LFP_channel]
+theta_ranges,non_theta_ranges=Recording1.pynacollada_label_theta (LFP_channel,Low_thres=-0.5,High_thres=8,save=False,plot_theta=True)
+LFP_theta=Recording1.get_theta_part()[LFP_channel]
 
 dpath='E:/ATLAS_SPAD/1820061_PVcre/Day4/SNR_methods/'
 recordingName='SavedRestTrials'
 Recording2=SyncOEpyPhotometrySession(dpath,recordingName,IsTracking=False,read_aligned_data_from_file=True,recordingMode='Atlas',indicator='GEVI') 
 LFP_channel='LFP_1'
-theta_part,non_theta_part=Recording2.pynacollada_label_theta (LFP_channel,Low_thres=0,High_thres=8,save=False,plot_theta=True)
-LFP_nontheta=Recording2.non_theta_part[LFP_channel]
+theta_ranges,non_theta_ranges=Recording2.pynacollada_label_theta (LFP_channel,Low_thres=0,High_thres=8,save=False,plot_theta=True)
+LFP_nontheta=Recording2.get_non_theta_part()[LFP_channel]
 
-optical_theta=Recording1.theta_part['zscore_raw']
-optical_nontheta=Recording2.non_theta_part['zscore_raw']
+optical_theta=Recording1.get_theta_part()['zscore_raw']
+optical_nontheta=Recording2.get_non_theta_part()['zscore_raw']
 #%%
+'One PSD call per panel, band power of every trace from the same (cached) spectra'
 fig, ax = plt.subplots(1, 1, figsize=(3, 6))
-OpticalAnlaysis.PSD_plot (LFP_nontheta/1000,fs=Fs,method="welch",color='black', xlim=[0,100],linewidth=2,linestyle='--',label='LFP-rest',ax=ax)
-OpticalAnlaysis.PSD_plot (LFP_theta/1000,fs=Fs,method="welch",color='black', xlim=[0,100],linewidth=2,linestyle='-',label='LFP-move',ax=ax)
+fig, ax, LFP_band_power = OpticalAnlaysis.PSD_plot_traces ([LFP_nontheta.values/1000, LFP_theta.values/1000],fs=Fs,
+    labels=['LFP-rest','LFP-move'],colors=['black','black'],linestyles=['--','-'],method="welch",xlim=[0,100],linewidth=2,ax=ax)
 
 fig, ax = plt.subplots(1, 1, figsize=(3, 6))
-OpticalAnlaysis.PSD_plot (optical_nontheta,fs=Fs,method="welch",color='tab:green', xlim=[0,100],linewidth=2,linestyle='--',label='GEVI-rest',ax=ax)
-OpticalAnlaysis.PSD_plot (optical_theta,fs=Fs,method="welch",color='tab:green', xlim=[0,100],linewidth=2,linestyle='-',label='GEVI-move',ax=ax)
+fig, ax, optical_band_power = OpticalAnlaysis.PSD_plot_traces ([optical_nontheta.values, optical_theta.values],fs=Fs,
+    labels=['GEVI-rest','GEVI-move'],colors=['tab:green','tab:green'],linestyles=['--','-'],method="welch",xlim=[0,100],linewidth=2,ax=ax)
+print(pd.concat([LFP_band_power, optical_band_power]))
+OpticalAnlaysis.clear_psd_cache()
@@ -24,7 +24,7 @@ def Ripple_manual_select ():
     '''separate the theta and non-theta parts.
     theta_thres: the theta band power should be bigger than 80% to be defined theta period.
     nonthetha_thres: the theta band power should be smaller than 50% to be defined as theta period.'''
-    theta_part,non_theta_part=Recording1.pynacollada_label_theta (LFP_channel,Low_thres=0.5,High_thres=8,save=False,plot_theta=True)
+    theta_ranges,non_theta_ranges=Recording1.pynacollada_label_theta (LFP_channel,Low_thres=0.5,High_thres=8,save=False,plot_theta=True)
     'Manually input and select ripple'
     Recording1.ManualSelectRipple (lfp_channel=LFP_channel,ep_start=10,ep_end=40,
                                                                               Low_thres=1,High_thres=10,plot_segment=False,
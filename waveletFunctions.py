@@ -36,13 +36,14 @@
 #
 # INPUTS:
 #
-#    Y = the time series of length N.
+#    Y = the time series of length N, or a 2-D array of equal-length
+#        epochs (M,N), which are transformed together.
 #    DT = amount of time between each Y value, i.e. the sampling time.
 #
 # OUTPUTS:
 #
 #    WAVE is the WAVELET transform of Y. This is a complex array
-#    of dimensions (N,J1+1). FLOAT(WAVE) gives the WAVELET amplitude,
+#    of dimensions (J1+1,N), or (M,J1+1,N) for 2-D Y. FLOAT(WAVE) gives the WAVELET amplitude,
 #    ATAN(IMAGINARY(WAVE),FLOAT(WAVE) gives the WAVELET phase.
 #    The WAVELET power spectrum is ABS(WAVE)**2.
 #    Its units are sigma**2 (the time series variance).
@@ -74,6 +75,15 @@
 #            For 'PAUL' this is m (order), default is 4.
 #            For 'DOG' this is m (m-th derivative), default is 2.
 #
+#    DTYPE = complex type of WAVE, e.g. np.complex64 to halve the memory.
+#
+#    SCALE_CHUNK = number of scales transformed per batched inverse FFT.
+#            By default, if all daughter wavelets fit in BASES_CACHE_BYTES
+#            (short epochs, e.g. per-event calls), they are one cached
+#            (scales x n) array and all scales are transformed at once.
+#            Longer recordings build the daughters for 8 scales at a time
+#            and do not cache them, so memory stays bounded.
+#
 #
 # OPTIONAL OUTPUTS:
 #
@@ -88,16 +98,21 @@
 #        at that particular time.
 #        Periods greater than this are subject to edge effects.
 
+from functools import lru_cache
+
 import numpy as np
 
-from scipy.optimize import fminbound
+from scipy import fft as sp_fft
+from scipy.stats import chi2
 from scipy.special._ufuncs import gamma, gammainc
 
 __author__ = 'Evgeniya Predybaylo, Michael von Papen'
 
 
-def wavelet(Y, dt, pad=0, dj=-1, s0=-1, J1=-1, mother=-1, param=-1, freq=None):
-    n1 = len(Y)
+def wavelet(Y, dt, pad=0, dj=-1, s0=-1, J1=-1, mother=-1, param=-1, freq=None,
+            dtype=complex, scale_chunk=None):
+    Y = np.asarray(Y)
+    n1 = Y.shape[-1]
 
     if s0 == -1:
         s0 = 2 * dt
@@ -109,24 +124,15 @@ def wavelet(Y, dt, pad=0, dj=-1, s0=-1, J1=-1, mother=-1, param=-1, freq=None):
         mother = 'MORLET'
 
     # construct time series to analyze, pad if necessary
-    x = Y - np.mean(Y)
+    x = Y - np.mean(Y, axis=-1, keepdims=True)
+    n = n1
     if pad == 1:
         # power of 2 nearest to N
         base2 = np.fix(np.log(n1) / np.log(2) + 0.4999)
-        nzeroes = (2 ** (base2 + 1) - n1).astype(np.int64)
-        x = np.concatenate((x, np.zeros(nzeroes)))
-
-    n = len(x)
-
-    # construct wavenumber array used in transform [Eqn(5)]
-    kplus = np.arange(1, int(n / 2) + 1)
-    kplus = (kplus * 2 * np.pi / (n * dt))
-    kminus = np.arange(1, int((n - 1) / 2) + 1)
-    kminus = np.sort((-kminus * 2 * np.pi / (n * dt)))
-    k = np.concatenate(([0.], kplus, kminus))
+        n = int(2 ** (base2 + 1))
 
-    # compute FFT of the (padded) time series
-    f = np.fft.fft(x)  # [Eqn(3)]
+    # compute FFT of the (padded) time series, zero padding is done by the FFT
+    f = sp_fft.fft(x, n=n, axis=-1).astype(dtype)  # [Eqn(3)]
 
     # construct SCALE array & empty PERIOD & WAVE arrays
     if mother.upper() == 'MORLET':
@@ -152,24 +158,83 @@ def wavelet(Y, dt, pad=0, dj=-1, s0=-1, J1=-1, mother=-1, param=-1, freq=None):
     else:
         scale = 1. / (fourier_factor * freq)
         period = 1. / freq
-    # define the wavelet array
-    wave = np.zeros(shape=(len(scale), n), dtype=complex)
 
-    # loop through all scales and compute transform
-    for a1 in range(0, len(scale)):
-        daughter, fourier_factor, coi, _ = \
-            wave_bases(mother, k, scale[a1], param)
-        wave[a1, :] = np.fft.ifft(f * daughter)  # wavelet transform[Eqn(4)]
+    # small bases: all daughter wavelets as one cached (scales x n) array,
+    # large bases: built per chunk of scales and not cached
+    scale = np.atleast_1d(scale)
+    cached = len(scale) * n * np.dtype(dtype).itemsize <= BASES_CACHE_BYTES
+    if cached:
+        bases, coi = wave_bases_cached(mother, n, dt, tuple(scale), param,
+                                       np.dtype(dtype).str)
+    else:
+        k = wavenumbers(n, dt)
+    if scale_chunk is None:
+        scale_chunk = len(scale) if cached else 8
+
+    # batched transform over scale chunks [Eqn(4)], Y can be (n,) or (epochs x n)
+    wave = np.empty(x.shape[:-1] + (len(scale), n1), dtype=dtype)
+    for a1 in range(0, len(scale), scale_chunk):
+        a2 = min(a1 + scale_chunk, len(scale))
+        if cached:
+            daughter = bases[a1:a2]
+        else:
+            daughter, fourier_factor, coi, dofmin = \
+                wave_bases(mother, k, scale[a1:a2, np.newaxis], param)
+            daughter = bases_as_dtype(daughter, dtype)
+        product = f[..., np.newaxis, :] * daughter
+        wave[..., a1:a2, :] = sp_fft.ifft(product, axis=-1, overwrite_x=True,
+                                          workers=-1)[..., :n1]
 
     # COI [Sec.3g]
     coi = coi * dt * np.concatenate((
         np.insert(np.arange(int((n1 + 1) / 2) - 1), [0], [1E-5]),
         np.insert(np.flipud(np.arange(0, int(n1 / 2) - 1)), [-1], [1E-5])))
-    wave = wave[:, :n1]  # get rid of padding before returning
 
     return wave, period, scale, coi
 
 
+def wavenumbers(n, dt):
+    # construct wavenumber array used in transform [Eqn(5)]
+    kplus = np.arange(1, int(n / 2) + 1)
+    kplus = (kplus * 2 * np.pi / (n * dt))
+    kminus = np.arange(1, int((n - 1) / 2) + 1)
+    kminus = np.sort((-kminus * 2 * np.pi / (n * dt)))
+    k = np.concatenate(([0.], kplus, kminus))
+    return k
+
+
+# --------------------------------------------------------------------------
+# WAVE_BASES_CACHED  Daughter wavelets for all scales, as one 2-D array
+#
+#   DAUGHTER,COI = wave_bases_cached(MOTHER,N,DT,SCALE,PARAM,DTYPE)
+#
+#   SCALE is a tuple of scales and DTYPE a numpy dtype string, so that the
+#   arguments are hashable. Only used by WAVELET for bases up to
+#   BASES_CACHE_BYTES, and the last 4 (N,DT,SCALE,MOTHER,PARAM,DTYPE)
+#   combinations are kept, so the cache stays below 4*BASES_CACHE_BYTES.
+#   Repeated transforms of equal-length epochs reuse the same array.
+#   The returned array is read-only.
+
+BASES_CACHE_BYTES = 2 ** 25
+
+
+@lru_cache(maxsize=4)
+def wave_bases_cached(mother, n, dt, scale, param, dtype):
+    k = wavenumbers(n, dt)
+    daughter, fourier_factor, coi, dofmin = \
+        wave_bases(mother, k, np.asarray(scale)[:, np.newaxis], param)
+    daughter = np.ascontiguousarray(bases_as_dtype(daughter, dtype))
+    daughter.flags.writeable = False
+    return daughter, coi
+
+
+def bases_as_dtype(daughter, dtype):
+    # real bases (Morlet, Paul) stay real numbers, of the precision of dtype
+    if not np.iscomplexobj(daughter):
+        dtype = np.empty(0, dtype=dtype).real.dtype
+    return daughter.astype(dtype, copy=False)
+
+
 # --------------------------------------------------------------------------
 # WAVE_BASES  1D Wavelet functions Morlet, Paul, or DOG
 #
@@ -359,18 +424,19 @@ def wave_signif(Y, dt, scale, sigtest=0, lag1=0.0, siglvl=0.95,
 
     if sigtest == 0:  # no smoothing, DOF=dofmin [Sec.4]
         dof = dofmin
-        chisquare = chisquare_inv(siglvl, dof) / dof
+        chisquare = chisquare_ratio(siglvl, (dof,))[0]
         signif = fft_theor * chisquare  # [Eqn(18)]
     elif sigtest == 1:  # time-averaged significance
         if len(np.atleast_1d(dof)) == 1:
-            dof = np.zeros(J1) + dof
+            dof = np.zeros(J1 + 1) + dof
+        dof = np.array(dof, dtype=float)
         dof[dof < 1] = 1
         # [Eqn(23)]
         dof = dofmin * np.sqrt(1 + (dof * dt / gamma_fac / scale) ** 2)
         dof[dof < dofmin] = dofmin   # minimum DOF is dofmin
-        for a1 in range(0, J1 + 1):
-            chisquare = chisquare_inv(siglvl, dof[a1]) / dof[a1]
-            signif[a1] = fft_theor[a1] * chisquare
+        # all scales at once
+        chisquare = chisquare_ratio(siglvl, tuple(dof))
+        signif = fft_theor * chisquare
     elif sigtest == 2:  # time-averaged significance
         if len(dof) != 2:
             print('ERROR: DOF must be set to [S1,S2],'
@@ -391,7 +457,7 @@ def wave_signif(Y, dt, scale, sigtest=0, lag1=0.0, siglvl=0.95,
         dof = (dofmin * navg * Savg / Smid) * \
             np.sqrt(1 + (navg * dj / dj0) ** 2)  # [Eqn(28)]
         fft_theor = Savg * np.sum(fft_theor[avg] / scale[avg])  # [Eqn(27)]
-        chisquare = chisquare_inv(siglvl, dof) / dof
+        chisquare = chisquare_ratio(siglvl, (dof,))[0]
         signif = (dj * dt / Cdelta / Savg) * fft_theor * chisquare  # [Eqn(26)]
     else:
         print('ERROR: sigtest must be either 0, 1, or 2')
@@ -407,36 +473,38 @@ def wave_signif(Y, dt, scale, sigtest=0, lag1=0.0, siglvl=0.95,
 #   This means that P*100 percent of the distribution lies between 0 and X.
 #
 #   To check, the answer should satisfy:   P==gammainc(X/2,V/2)
+#
+#   V can be a vector, all degrees of freedom are evaluated at once.
 
-# Uses FMIN and CHISQUARE_SOLVE
+# Uses scipy.stats.chi2.ppf instead of the FMIN root-finding in CHISQUARE_SOLVE
 
 def chisquare_inv(P, V):
 
     if (1 - P) < 1E-4:
         print('P must be < 0.9999')
 
-    if P == 0.95 and V == 2:  # this is a no-brainer
-        X = 5.9915
-        return X
+    X = chi2.ppf(P, V)
 
-    MINN = 0.01  # hopefully this is small enough
-    MAXX = 1  # actually starts at 10 (see while loop below)
-    X = 1
-    TOLERANCE = 1E-4  # this should be accurate enough
+    return X  # end of code
 
-    while (X + TOLERANCE) >= MAXX:  # should only need to loop thru once
-        MAXX = MAXX * 10.
-    # this calculates value for X, NORMALIZED by V
-        X = fminbound(chisquare_solve, MINN, MAXX, args=(P, V), xtol=TOLERANCE)
-        MINN = MAXX
 
-    X = X * V  # put back in the goofy V factor
+# --------------------------------------------------------------------------
+# CHISQUARE_RATIO  chisquare_inv(P,V)/V, cached
+#
+#   RATIO = chisquare_ratio(P,V) with V a tuple of degrees of freedom.
+#   Repeated significance tests with the same (SIGLVL,DOF) reuse the
+#   result, e.g. significance masks for every detected event.
 
-    return X  # end of code
+@lru_cache(maxsize=64)
+def chisquare_ratio(P, V):
+    V = np.asarray(V, dtype=float)
+    ratio = chisquare_inv(P, V) / V
+    ratio.flags.writeable = False
+    return ratio
 
 
 # --------------------------------------------------------------------------
-# CHISQUARE_SOLVE  Internal function used by CHISQUARE_INV
+# CHISQUARE_SOLVE  Internal function used by the original CHISQUARE_INV
     #
     #   PDIFF=chisquare_solve(XGUESS,P,V)  Given XGUESS, a percentile P,
     #   and degrees-of-freedom V, return the difference between